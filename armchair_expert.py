@@ -2,16 +2,23 @@ import argparse
 import logging
 import signal
 import sys
+from collections import deque
 from enum import Enum, unique
 from multiprocessing import Event
+from typing import List, Iterator, Union, Optional
 
-from common.nlp import create_nlp_instance, SpacyPreprocessor
+from common.nlp import create_nlp_instance, ParsedDoc, parse_docs, parser_signature
 from config.armchair_expert import ARMCHAIR_EXPERT_LOGLEVEL
-from config.ml import USE_GPU, STRUCTURE_MODEL_PATH, MARKOV_DB_PATH, STRUCTURE_MODEL_TRAINING_MAX_SIZE
-from markov_engine import MarkovTrieDb, MarkovTrainer, MarkovFilters
+from config.ml import USE_GPU, STRUCTURE_MODEL_PATH, MARKOV_DB_PATH, STRUCTURE_MODEL_TRAINING_MAX_SIZE, \
+    MARKOV_TRAINING_PROCESSES, SPACY_PIPE_BATCH_SIZE, SPACY_PIPE_PROCESSES, CAPITALIZATION_COMPOUND_RULES, \
+    ML_INFERENCE_ONLY, STRUCTURE_MODEL_TRAINING_STREAM, STRUCTURE_MODEL_SEQUENCES_PATH
+from markov_engine import MarkovTrainer, MarkovBulkTrainer, MarkovParallelTrainer, MarkovFilters, create_markov_db
+from models.inference import inference_path
 from models.structure import StructureModelScheduler, StructurePreprocessor
 from storage.armchair_expert import InputTextStatManager
 from storage.imported import ImportTrainingDataManager
+from storage.parse_cache import ParseCache
+from storage.storage_common import TrainingDataManager, TrainingData
 
 
 @unique
@@ -33,6 +40,7 @@ class ArmchairExpert(object):
         self._connectors_event = Event()
         self._twitter_connector = None
         self._discord_connector = None
+        self._parse_caches = {}
         self._logger = logging.getLogger(self.__class__.__name__)
 
     def _set_status(self, status: AEStatus):
@@ -44,7 +52,7 @@ class ArmchairExpert(object):
         self._set_status(AEStatus.STARTING_UP)
 
         # Initialize backends and models
-        self._markov_model = MarkovTrieDb()
+        self._markov_model = create_markov_db()
         if not retrain_markov:
             try:
                 self._markov_model.load(MARKOV_DB_PATH)
@@ -56,7 +64,8 @@ class ArmchairExpert(object):
         structure_model_trained = None
         if not retrain_structure is None:
             try:
-                open(STRUCTURE_MODEL_PATH, 'rb')
+                # Serving only workers load the exported weights instead
+                open(inference_path(STRUCTURE_MODEL_PATH) if ML_INFERENCE_ONLY else STRUCTURE_MODEL_PATH, 'rb')
                 self._structure_scheduler.load(STRUCTURE_MODEL_PATH)
                 structure_model_trained = True
             except FileNotFoundError:
@@ -93,12 +102,19 @@ class ArmchairExpert(object):
         self._logger.info("Loading spaCy model")
         self._nlp = create_nlp_instance()
 
+        if ML_INFERENCE_ONLY and (retrain_structure or not structure_model_trained):
+            self._structure_scheduler.shutdown()
+            raise RuntimeError("The structure model can't be trained with ML_INFERENCE_ONLY set")
+
         # Catch up on training now that everything is initialized but not yet started
         if retrain_structure or not structure_model_trained:
             self.train(retrain_structure=True, retrain_markov=retrain_markov)
         else:
             self.train(retrain_structure=False, retrain_markov=retrain_markov)
 
+        # Only this process appends real-time learning to the model's journal
+        self._markov_model.open_journal(MARKOV_DB_PATH)
+
         # Give the connectors the NLP object and start them
         for connector in self._connectors:
             connector.give_nlp(self._nlp)
@@ -108,20 +124,43 @@ class ArmchairExpert(object):
         # Handle events
         self._main()
 
+    def _parse_cache(self, manager: TrainingDataManager) -> ParseCache:
+        path = manager.parse_cache_path
+        if path not in self._parse_caches:
+            self._parse_caches[path] = ParseCache(path, parser_signature(self._nlp, CAPITALIZATION_COMPOUND_RULES))
+        return self._parse_caches[path]
+
+    def _parse(self, rows: TrainingData, manager: TrainingDataManager) -> Iterator[ParsedDoc]:
+        def parse(items: Iterator[Union[bytes, ParsedDoc]]) -> Iterator[ParsedDoc]:
+            # Only rows missing from the parse cache are filtered and parsed
+            texts = (MarkovFilters.filter_input(item.decode()) if isinstance(item, bytes) else item for item in items)
+            return parse_docs(self._nlp, texts, batch_size=SPACY_PIPE_BATCH_SIZE, processes=SPACY_PIPE_PROCESSES,
+                              compound_rules=CAPITALIZATION_COMPOUND_RULES)
+
+        return self._parse_cache(manager).parse(rows, parse)
+
+    @staticmethod
+    def _structure_preprocessor() -> StructurePreprocessor:
+        # Streamed training keeps every sequence on disk instead of the newest ones in memory
+        if STRUCTURE_MODEL_TRAINING_STREAM:
+            return StructurePreprocessor(path=STRUCTURE_MODEL_SEQUENCES_PATH)
+        return StructurePreprocessor()
+
     def _preprocess_structure_data(self):
-        structure_preprocessor = StructurePreprocessor()
+        structure_preprocessor = self._structure_preprocessor()
+        limit = None if STRUCTURE_MODEL_TRAINING_STREAM else STRUCTURE_MODEL_TRAINING_MAX_SIZE
 
         self._logger.info("Training_Preprocessing_Structure(Import)")
-        imported_messages = ImportTrainingDataManager().all_training_data(limit=STRUCTURE_MODEL_TRAINING_MAX_SIZE,
-                                                                          order_by='id', order='desc')
-        for message_idx, message in enumerate(imported_messages):
+        import_manager = ImportTrainingDataManager()
+        imported_messages = import_manager.all_training_data(limit=limit,
+                                                             order_by='id', order='desc')
+        for message_idx, doc in enumerate(self._parse(imported_messages, import_manager)):
             # Print Progress
             if message_idx % 100 == 0:
                 self._logger.info(
                     "Training_Preprocessing_Structure(Import): %f%%" % (
-                            message_idx / min(STRUCTURE_MODEL_TRAINING_MAX_SIZE, len(imported_messages)) * 100))
+                            message_idx / len(imported_messages) * 100))
 
-            doc = self._nlp(MarkovFilters.filter_input(message[0].decode()))
             if not structure_preprocessor.preprocess(doc):
                 return structure_preprocessor
 
@@ -130,16 +169,16 @@ class ArmchairExpert(object):
             self._logger.info("Training_Preprocessing_Structure(Twitter)")
             from storage.twitter import TwitterTrainingDataManager
 
-            tweets = TwitterTrainingDataManager().all_training_data(limit=STRUCTURE_MODEL_TRAINING_MAX_SIZE,
-                                                                    order_by='timestamp', order='desc')
-            for tweet_idx, tweet in enumerate(tweets):
+            twitter_manager = TwitterTrainingDataManager()
+            tweets = twitter_manager.all_training_data(limit=limit,
+                                                       order_by='timestamp', order='desc')
+            for tweet_idx, doc in enumerate(self._parse(tweets, twitter_manager)):
                 # Print Progress
                 if tweet_idx % 100 == 0:
                     self._logger.info(
                         "Training_Preprocessing_Structure(Twitter): %f%%" % (
-                                tweet_idx / min(STRUCTURE_MODEL_TRAINING_MAX_SIZE, len(tweets)) * 100))
+                                tweet_idx / len(tweets) * 100))
 
-                doc = self._nlp(MarkovFilters.filter_input(tweet[0].decode()))
                 if not structure_preprocessor.preprocess(doc):
                     return structure_preprocessor
 
@@ -148,110 +187,131 @@ class ArmchairExpert(object):
             self._logger.info("Training_Preprocessing_Structure(Discord)")
             from storage.discord import DiscordTrainingDataManager
 
-            discord_messages = DiscordTrainingDataManager().all_training_data(limit=STRUCTURE_MODEL_TRAINING_MAX_SIZE,
-                                                                              order_by='timestamp', order='desc')
-            for message_idx, message in enumerate(discord_messages):
+            discord_manager = DiscordTrainingDataManager()
+            discord_messages = discord_manager.all_training_data(limit=limit,
+                                                                 order_by='timestamp', order='desc')
+            for message_idx, doc in enumerate(self._parse(discord_messages, discord_manager)):
                 # Print Progress
                 if message_idx % 100 == 0:
                     self._logger.info(
                         "Training_Preprocessing_Structure(Discord): %f%%" % (
-                                message_idx / min(STRUCTURE_MODEL_TRAINING_MAX_SIZE, len(discord_messages)) * 100))
+                                message_idx / len(discord_messages) * 100))
 
-                doc = self._nlp(MarkovFilters.filter_input(message[0].decode()))
                 if not structure_preprocessor.preprocess(doc):
                     return structure_preprocessor
 
         return structure_preprocessor
 
-    def _preprocess_markov_data(self, all_training_data: bool = False):
-        spacy_preprocessor = SpacyPreprocessor()
-
-        self._logger.info("Training_Preprocessing_Markov(Import)")
-        if not all_training_data:
-            imported_messages = ImportTrainingDataManager().new_training_data()
-        else:
-            imported_messages = ImportTrainingDataManager().all_training_data()
-        for message_idx, message in enumerate(imported_messages):
-            # Print Progress
-            if message_idx % 100 == 0:
-                self._logger.info(
-                    "Training_Preprocessing_Markov(Import): %f%%" % (message_idx / len(imported_messages) * 100))
-
-            doc = self._nlp(MarkovFilters.filter_input(message[0].decode()))
-            spacy_preprocessor.preprocess(doc)
-
-        tweets = None
+    def _markov_training_data(self, all_training_data: bool = False, newest_first: bool = False) -> List[tuple]:
+        # (source name, manager, rows) of every source of training data
+        managers = [('Import', ImportTrainingDataManager(), 'id')]
         if self._twitter_connector is not None:
-            self._logger.info("Training_Preprocessing_Markov(Twitter)")
             from storage.twitter import TwitterTrainingDataManager
-
-            if not all_training_data:
-                tweets = TwitterTrainingDataManager().new_training_data()
-            else:
-                tweets = TwitterTrainingDataManager().all_training_data()
-            for tweet_idx, tweet in enumerate(tweets):
-                # Print Progress
-                if tweet_idx % 100 == 0:
-                    self._logger.info("Training_Preprocessing_Markov(Twitter): %f%%" % (tweet_idx / len(tweets) * 100))
-
-                doc = self._nlp(MarkovFilters.filter_input(tweet[0].decode()))
-                spacy_preprocessor.preprocess(doc)
-
-        discord_messages = None
+            managers.append(('Twitter', TwitterTrainingDataManager(), 'timestamp'))
         if self._discord_connector is not None:
-            self._logger.info("Training_Preprocessing_Markov(Discord)")
             from storage.discord import DiscordTrainingDataManager
+            managers.append(('Discord', DiscordTrainingDataManager(), 'timestamp'))
 
+        training_data = []
+        for name, manager, order_by in managers:
             if not all_training_data:
-                discord_messages = DiscordTrainingDataManager().new_training_data()
+                rows = manager.new_training_data()
+            elif newest_first:
+                rows = manager.all_training_data(order_by=order_by, order='desc')
             else:
-                discord_messages = DiscordTrainingDataManager().all_training_data()
-
-            for message_idx, message in enumerate(discord_messages):
+                rows = manager.all_training_data()
+            training_data.append((name, manager, rows))
+        return training_data
+
+    def _markov_training_docs(self, all_training_data: bool = False,
+                              newest_first: bool = False) -> Iterator[ParsedDoc]:
+        for name, manager, rows in self._markov_training_data(all_training_data, newest_first):
+            self._logger.info("Training_Preprocessing_Markov(%s)" % name)
+            for message_idx, doc in enumerate(self._parse(rows, manager)):
                 # Print Progress
                 if message_idx % 100 == 0:
                     self._logger.info(
-                        "Training_Preprocessing_Markov(Discord): %f%%" % (message_idx / len(discord_messages) * 100))
+                        "Training_Preprocessing_Markov(%s): %f%%" % (name, message_idx / len(rows) * 100))
+
+                yield doc
+
+    def _markov_training_items(self, training_data: list, misses: deque) -> Iterator[Union[str, ParsedDoc]]:
+        # The cached parse of each training row, or its filtered text if it still needs to be parsed
+        for name, manager, rows in training_data:
+            parse_cache = self._parse_cache(manager)
+            for text, row_id in rows:
+                doc = parse_cache.get(row_id, text)
+                if doc is not None:
+                    yield doc
+                else:
+                    misses.append((parse_cache, row_id, text))
+                    yield MarkovFilters.filter_input(text.decode())
+
+    def _train_markov_parallel(self, input_text_stats_manager: InputTextStatManager,
+                               retrain: bool = False) -> int:
+        training_data = self._markov_training_data(all_training_data=retrain)
+        total = sum([len(rows) for _, _, rows in training_data])
+        misses = deque()
+
+        self._logger.info("Training(Markov): %d processes" % MARKOV_TRAINING_PROCESSES)
+        markov_trainer = MarkovParallelTrainer(self._markov_model, self._nlp)
+        learned = 0
+        for sentence_counts, parsed in markov_trainer.learn(self._markov_training_items(training_data, misses)):
+            for sents in sentence_counts:
+                input_text_stats_manager.log_length(length=sents)
+
+            # Cache the rows the shard had to parse
+            for payload in parsed:
+                parse_cache, row_id, text = misses.popleft()
+                parse_cache.put_bytes(row_id, text, payload)
 
-                doc = self._nlp(MarkovFilters.filter_input(message[0].decode()))
-                spacy_preprocessor.preprocess(doc)
+            # Print Progress
+            learned += len(sentence_counts)
+            self._logger.info("Training(Markov): %f%%" % (learned / total * 100))
 
-        return spacy_preprocessor
+        for parse_cache in self._parse_caches.values():
+            parse_cache.flush()
 
-    def _train_markov(self, retrain: bool = False):
+        return learned
 
-        spacy_preprocessor = self._preprocess_markov_data(all_training_data=retrain)
+    def _train_markov(self, retrain: bool = False, structure_preprocessor: Optional[StructurePreprocessor] = None):
 
-        self._logger.info("Training(Markov)")
         input_text_stats_manager = InputTextStatManager()
         if retrain:
             # Reset stats if we are retraining
             input_text_stats_manager.reset()
 
-        markov_trainer = MarkovTrainer(self._markov_model)
-        docs, _ = spacy_preprocessor.get_preprocessed_data()
-        for doc_idx, doc in enumerate(docs):
-            # Print Progress
-            if doc_idx % 100 == 0:
-                self._logger.info("Training(Markov): %f%%" % (doc_idx / len(docs) * 100))
-
-            markov_trainer.learn(doc)
-
-            sents = 0
-            for sent in doc.sents:
-                sents += 1
-            input_text_stats_manager.log_length(length=sents)
-
-        if len(docs) > 0:
+        if MARKOV_TRAINING_PROCESSES > 1:
+            learned = self._train_markov_parallel(input_text_stats_manager, retrain)
+        else:
+            # Docs are learned as they are parsed, the bulk trainer only buffers a bounded number of n-grams
+            self._logger.info("Training(Markov)")
+            markov_trainer = MarkovBulkTrainer(self._markov_model)
+            learned = 0
+
+            # The structure model is trained on the newest messages, so visit them first when sharing the parse
+            structure_full = structure_preprocessor is None
+            for doc in self._markov_training_docs(all_training_data=retrain, newest_first=not structure_full):
+                markov_trainer.learn(doc)
+                input_text_stats_manager.log_length(length=len(doc.sents))
+                learned += 1
+
+                if not structure_full:
+                    structure_full = not structure_preprocessor.preprocess(doc)
+            markov_trainer.flush()
+
+        # Always snapshot a retrained model so real-time learning has a journal to append to
+        if learned > 0 or retrain:
             self._markov_model.save(MARKOV_DB_PATH)
             input_text_stats_manager.commit()
 
-    def _train_structure(self, retrain: bool = False):
+    def _train_structure(self, retrain: bool = False, structure_preprocessor: Optional[StructurePreprocessor] = None):
 
         if not retrain:
             return
 
-        structure_preprocessor = self._preprocess_structure_data()
+        if structure_preprocessor is None:
+            structure_preprocessor = self._preprocess_structure_data()
 
         self._logger.info("Training(Structure)")
         structure_data, structure_labels = structure_preprocessor.get_preprocessed_data()
@@ -264,14 +324,25 @@ class ArmchairExpert(object):
             epochs = max(5, epochs)
             epochs = min(60, epochs)
 
-            self._structure_scheduler.train(structure_data, structure_labels, epochs=epochs)
+            if structure_preprocessor.path is not None:
+                self._structure_scheduler.train_stream(structure_preprocessor.path, epochs=epochs)
+            else:
+                self._structure_scheduler.train(structure_data, structure_labels, epochs=epochs)
             self._structure_scheduler.save(STRUCTURE_MODEL_PATH)
 
     def train(self, retrain_structure: bool = False, retrain_markov: bool = False):
 
         self._logger.info("Training begin")
-        self._train_markov(retrain_markov)
-        self._train_structure(retrain_structure)
+
+        # When retraining both models every message is parsed once and shared with the structure model.
+        # Parallel markov training parses in its worker processes instead, but leaves every message in the parse cache
+        # for the structure model to read.
+        structure_preprocessor = None
+        if retrain_structure and retrain_markov and MARKOV_TRAINING_PROCESSES <= 1:
+            structure_preprocessor = self._structure_preprocessor()
+
+        self._train_markov(retrain_markov, structure_preprocessor)
+        self._train_structure(retrain_structure, structure_preprocessor)
 
         # Mark data as trained
         if self._twitter_connector is not None:
@@ -297,7 +368,7 @@ class ArmchairExpert(object):
                     if message is not None:
                         doc = self._nlp(MarkovFilters.filter_input(message.text))
                         if message.learn:
-                            MarkovTrainer(self._markov_model).learn(doc)
+                            MarkovTrainer(self._markov_model, journal=True).learn(doc)
                             connector.send(None)
                         if message.reply:
                             reply = connector.generate(message, doc=doc)
@@ -318,6 +389,7 @@ class ArmchairExpert(object):
 
         # Shutdown models
         self._structure_scheduler.shutdown()
+        self._markov_model.close_journal()
 
     def handle_shutdown(self):
         # Shutdown main()
@@ -1,9 +1,19 @@
+import json
 import pickle
-from typing import Tuple
+import struct
+import tempfile
+from contextlib import contextmanager
+from typing import Tuple, Iterable, Iterator
 from spacy.tokens import Doc
 import numpy as np
 import os
 
+ARRAY_FILE_MAGIC = b'AEAF'
+ARRAY_FILE_HEADER = struct.Struct('<4sI')
+ARRAY_FILE_ALIGNMENT = 64
+# Shared arrays live in memory rather than on disk where the platform allows it
+SHARED_ARRAY_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
 
 def temp(p, temperature=1.0):
     preds = np.asarray(p).astype('float64')
@@ -21,6 +31,114 @@ def one_hot(idx: int, size: int):
     return ret
 
 
+def batches(items: Iterable, batch_size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def array_batches(data: np.ndarray, labels: np.ndarray, batch_size: int,
+                  block_size: int = 64) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Endless (data, labels) batches for fit_generator, shuffled each epoch. Only a block of block_size batches is read at
+    a time. Blocks are visited in a random order and shuffled within, so reads from a memory map stay mostly sequential.
+    """
+    block_rows = batch_size * block_size
+    while True:
+        for block_start in np.random.permutation(np.arange(0, len(data), block_rows)):
+            order = np.random.permutation(min(block_rows, len(data) - block_start))
+            block_data = np.asarray(data[block_start:block_start + block_rows])[order]
+            block_labels = np.asarray(labels[block_start:block_start + block_rows])[order]
+            for batch_start in range(0, len(order), batch_size):
+                yield block_data[batch_start:batch_start + batch_size], block_labels[batch_start:batch_start + batch_size]
+
+
+def _align(offset: int) -> int:
+    return (offset + ARRAY_FILE_ALIGNMENT - 1) // ARRAY_FILE_ALIGNMENT * ARRAY_FILE_ALIGNMENT
+
+
+def write_array_file(path: str, arrays: dict, meta: dict = None):
+    # Layout: magic, JSON header length, JSON header, then each array's raw bytes at an aligned offset
+    header = {'meta': meta if meta is not None else {}, 'arrays': {}}
+    offset = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = [array.dtype.str, list(array.shape), offset]
+        offset = _align(offset + array.nbytes)
+    encoded_header = json.dumps(header).encode()
+    data_start = _align(ARRAY_FILE_HEADER.size + len(encoded_header))
+
+    with open(path, 'wb') as f:
+        f.write(ARRAY_FILE_HEADER.pack(ARRAY_FILE_MAGIC, len(encoded_header)))
+        f.write(encoded_header)
+        for name, array in arrays.items():
+            f.seek(data_start + header['arrays'][name][2])
+            # Written straight from the array's memory rather than through a bytes copy of it
+            np.ascontiguousarray(array).tofile(f)
+        f.truncate(data_start + offset)
+
+
+def read_array_file(path: str) -> Tuple[dict, dict]:
+    # Arrays are read-only views of a shared memory map, pages are only read from disk when touched
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    magic, header_length = ARRAY_FILE_HEADER.unpack(data[:ARRAY_FILE_HEADER.size].tobytes())
+    if magic != ARRAY_FILE_MAGIC:
+        raise ValueError("%s is not an array file" % path)
+    header = json.loads(data[ARRAY_FILE_HEADER.size:ARRAY_FILE_HEADER.size + header_length].tobytes().decode())
+    data_start = _align(ARRAY_FILE_HEADER.size + header_length)
+
+    arrays = {}
+    for name, (dtype, shape, offset) in header['arrays'].items():
+        dtype = np.dtype(dtype)
+        start = data_start + offset
+        end = start + int(np.prod(shape)) * dtype.itemsize
+        arrays[name] = data[start:end].view(dtype).reshape(shape)
+    return header['meta'], arrays
+
+
+@contextmanager
+def atomic_write(path: str) -> Iterator[str]:
+    """
+    Yields a temporary path to write the file to instead, which replaces path only once the with block completes, so
+    a crash while writing never leaves a partly written file behind in place of the old one.
+    """
+    tmp_path = path + '.tmp'
+    try:
+        yield tmp_path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+class SharedArrays(object):
+    """
+    Array file for handing large arrays to a model worker process, so only its path has to go through the queue rather
+    than pickling the arrays through the pipe. The worker maps them straight from the file with read_array_file.
+    The file is removed when leaving the with block.
+    """
+
+    def __init__(self, arrays: dict):
+        fd, self.path = tempfile.mkstemp(suffix='.bin', dir=SHARED_ARRAY_DIR)
+        os.close(fd)
+        try:
+            write_array_file(self.path, arrays)
+        except BaseException:
+            os.remove(self.path)
+            raise
+
+    def __enter__(self) -> str:
+        return self.path
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        os.remove(self.path)
+
+
 class MLDataPreprocessor(object):
     def __init__(self, name: str):
         self.name = name
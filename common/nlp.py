@@ -1,7 +1,11 @@
-from typing import Optional, List, Tuple
+from typing import Optional, List, Iterable, Iterator, Union
+from collections import deque
 from enum import Enum, unique
-from common.ml import one_hot, MLDataPreprocessor
+from multiprocessing import Pool
+from common.ml import one_hot, batches
+import json
 import re
+import struct
 from spacy.tokens import Token, Doc
 
 
@@ -34,6 +38,13 @@ def create_nlp_instance():
     return nlp
 
 
+def parser_signature(nlp, compound_rules: Optional[List[str]] = None) -> str:
+    # Identifies everything that affects a ParsedDoc besides the text itself
+    import spacy
+    return json.dumps([spacy.about.__version__, nlp.meta.get('lang'), nlp.meta.get('name'), nlp.meta.get('version'),
+                       nlp.pipe_names, compound_rules])
+
+
 @unique
 class Pos(Enum):
     NONE = 0
@@ -185,13 +196,117 @@ class CapitalizationMode(Enum):
         return ret_word
 
 
-class SpacyPreprocessor(MLDataPreprocessor):
-    def __init__(self):
-        MLDataPreprocessor.__init__(self, 'SpacyPreprocessor')
+class ParsedToken(object):
+    def __init__(self, text: str, pos: Pos, mode: CapitalizationMode):
+        self.text = text
+        self.pos = pos
+        self.mode = mode
+
+    def __repr__(self):
+        return self.text
+
+    @staticmethod
+    def from_token(token: Token, compound_rules: Optional[List[str]] = None) -> 'ParsedToken':
+        return ParsedToken(token.text, Pos.from_token(token), CapitalizationMode.from_token(token, compound_rules))
+
 
-    def preprocess(self, doc: Doc) -> bool:
-        self.data.append(doc)
-        return True
+class ParsedDoc(object):
+    """The parts of a spaCy Doc which the trainers use: token text, Pos and CapitalizationMode split by sentence"""
+    # Counts and lengths are 32 bit, so no message a connector receives is too long to encode
+    COUNT = struct.Struct('<I')
+    # Pos, CapitalizationMode, text length
+    TOKEN = struct.Struct('<BBI')
 
-    def get_preprocessed_data(self) -> Tuple[List, List]:
-        return self.data, self.labels
+    def __init__(self, sents: List[List[ParsedToken]]):
+        self.sents = sents
+
+    def __iter__(self):
+        for sentence in self.sents:
+            for token in sentence:
+                yield token
+
+    def __len__(self):
+        return sum([len(sentence) for sentence in self.sents])
+
+    @staticmethod
+    def from_doc(doc: Doc, compound_rules: Optional[List[str]] = None) -> 'ParsedDoc':
+        return ParsedDoc([[ParsedToken.from_token(token, compound_rules) for token in sentence]
+                          for sentence in doc.sents])
+
+    def to_bytes(self) -> bytes:
+        parts = [ParsedDoc.COUNT.pack(len(self.sents))]
+        for sentence in self.sents:
+            parts.append(ParsedDoc.COUNT.pack(len(sentence)))
+            for token in sentence:
+                text = token.text.encode()
+                parts.append(ParsedDoc.TOKEN.pack(token.pos.value, token.mode.value, len(text)))
+                parts.append(text)
+        return b''.join(parts)
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'ParsedDoc':
+        sents = []
+        offset = ParsedDoc.COUNT.size
+        for _ in range(0, ParsedDoc.COUNT.unpack_from(data, 0)[0]):
+            sentence = []
+            num_tokens = ParsedDoc.COUNT.unpack_from(data, offset)[0]
+            offset += ParsedDoc.COUNT.size
+            for _ in range(0, num_tokens):
+                pos, mode, length = ParsedDoc.TOKEN.unpack_from(data, offset)
+                offset += ParsedDoc.TOKEN.size
+                text = bytes(data[offset:offset + length]).decode()
+                offset += length
+                sentence.append(ParsedToken(text, Pos(pos), CapitalizationMode(mode)))
+            sents.append(sentence)
+        return ParsedDoc(sents)
+
+
+# spaCy instance of a parse_docs pool process
+_pipe_nlp = None
+
+
+def _init_pipe_process(nlp):
+    global _pipe_nlp
+    _pipe_nlp = nlp
+
+
+def _parse_batch(nlp, texts: List[str], compound_rules: Optional[List[str]]) -> List[ParsedDoc]:
+    if len(texts) == 0:
+        return []
+    return [ParsedDoc.from_doc(doc, compound_rules) for doc in nlp.pipe(texts, batch_size=len(texts))]
+
+
+def _parse_pool_batch(texts: List[str], compound_rules: Optional[List[str]]) -> List[ParsedDoc]:
+    return _parse_batch(_pipe_nlp, texts, compound_rules)
+
+
+def _merge_batch(batch: list, docs: List[ParsedDoc]) -> List[ParsedDoc]:
+    docs = iter(docs)
+    return [item if isinstance(item, ParsedDoc) else next(docs) for item in batch]
+
+
+def parse_docs(nlp, items: Iterable[Union[str, ParsedDoc]], batch_size: int = 1000, processes: int = 1,
+               compound_rules: Optional[List[str]] = None) -> Iterator[ParsedDoc]:
+    """
+    Streams texts through nlp.pipe in batches, yielding a ParsedDoc for each one in order. Items which are already a
+    ParsedDoc are passed through as they are.
+    With more than one process, batches are parsed in a pool and only a couple of batches per process are in flight,
+    so items are consumed lazily either way.
+    """
+    if processes <= 1:
+        for batch in batches(items, batch_size):
+            texts = [item for item in batch if not isinstance(item, ParsedDoc)]
+            yield from _merge_batch(batch, _parse_batch(nlp, texts, compound_rules))
+        return
+
+    with Pool(processes, initializer=_init_pipe_process, initargs=(nlp,)) as pool:
+        pending = deque()
+        for batch in batches(items, batch_size):
+            texts = [item for item in batch if not isinstance(item, ParsedDoc)]
+            pending.append((batch, pool.apply_async(_parse_pool_batch, (texts, compound_rules))))
+            if len(pending) >= processes * 2:
+                batch, result = pending.popleft()
+                yield from _merge_batch(batch, result.get())
+        while len(pending) > 0:
+            batch, result = pending.popleft()
+            yield from _merge_batch(batch, result.get())
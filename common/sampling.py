@@ -0,0 +1,46 @@
+import numpy as np
+
+
+def tempered(p, temperature=1.0) -> np.ndarray:
+    # Unnormalized weights of the same distribution temp() draws from, p ** (1 / temperature)
+    weights = np.asarray(p, dtype=np.float64)
+    if temperature != 1.0:
+        weights = np.power(weights, 1.0 / temperature)
+    return weights
+
+
+class CumulativeSampler(object):
+    """
+    Cumulative table of a categorical distribution at a temperature. Building it is O(n) and each draw after that is a
+    binary search, so distributions which are sampled more than once should be kept around as one of these.
+    """
+
+    def __init__(self, p, temperature=1.0):
+        self._cdf = np.cumsum(tempered(p, temperature))
+        # Otherwise every draw would land past the last index
+        if len(self._cdf) == 0 or not self._cdf[-1] > 0:
+            raise ValueError("Can't sample from a distribution without any probability")
+
+    def __len__(self):
+        return len(self._cdf)
+
+    def sample(self) -> int:
+        return int(np.searchsorted(self._cdf, np.random.random() * self._cdf[-1], side='right'))
+
+    def sample_n(self, n: int) -> np.ndarray:
+        return np.searchsorted(self._cdf, np.random.random(n) * self._cdf[-1], side='right')
+
+
+def sample_rows(p, temperature=1.0) -> np.ndarray:
+    """Draws one index from each row of p at a temperature"""
+    cdf = np.cumsum(tempered(p, temperature), axis=1)
+    if not np.all(cdf[:, -1] > 0):
+        raise ValueError("Can't sample from a row without any probability")
+    thresholds = np.random.random(len(cdf)) * cdf[:, -1]
+    # Same as searching each row with side='right'
+    return np.sum(cdf <= thresholds[:, None], axis=1)
+
+
+def sample(p, temperature=1.0) -> int:
+    """Draws one index of p at a temperature, a drop in replacement for temp()"""
+    return CumulativeSampler(p, temperature).sample()
@@ -14,3 +14,6 @@ IMPORT_TRAINING_DB_PATH = 'db/import.db'
 
 # Store statistics here
 STATISTICS_DB_PATH = 'db/statistics.db'
+
+# Training data is streamed from the DBs in batches of this many rows
+TRAINING_DATA_BATCH_SIZE = 1000
@@ -8,16 +8,61 @@ USE_GPU = True
 # --- Technical Stuff Section ---
 # -------------------------------
 
+# Serve the structure and reaction models with NumPy alone, so TensorFlow / Keras are only imported to train them.
+# Saving a model also exports its weights next to it for this, e.g. weights/structure-model.bin.
+# Weights saved before exports existed can be exported with scripts/export_models.py
+ML_INFERENCE_ONLY = False
+
+# Predictions reaching a model worker within this many seconds of the first waiting one are run together in a single
+# batch of at most ML_PREDICT_BATCH_MAX_SIZE, so no prediction waits longer than this for others to join it.
+# 0 only batches predictions which are already waiting.
+ML_PREDICT_BATCH_WINDOW = 0.005
+ML_PREDICT_BATCH_MAX_SIZE = 64
+
+# Markov storage engine
+# 'trie' keeps neighbors as JSON serializable dicts, 'csr' keeps them in compact numpy arrays and uses far less memory
+MARKOV_DB_ENGINE = 'trie'
+
+# Messages are parsed by spaCy in batches of this size when training, using this many processes
+SPACY_PIPE_BATCH_SIZE = 1000
+SPACY_PIPE_PROCESSES = 1
+
 # Paths
+# The csr engine stores its model in a memory mappable binary format, e.g. 'weights/markov.bin'
 MARKOV_DB_PATH = 'weights/markov.json.zlib'
 REACTION_MODEL_PATH = "weights/aol-reaction-model.h5"
 STRUCTURE_MODEL_PATH = "weights/structure-model.h5"
 
 MARKOV_GENERATE_SUBJECT_MAX = 2
+# Candidate replies to generate per message, the first complete one is sent
+MARKOV_GENERATE_CANDIDATES = 3
 # Greatest to least
 MARKOV_GENERATE_SUBJECT_POS_PRIORITY = [Pos.HASHTAG, Pos.PROPN, Pos.NOUN, Pos.VERB, Pos.EMOJI, Pos.URL, Pos.ADJ,
                                         Pos.ADV, Pos.NUM, Pos.X, Pos.INTJ]
 
+# Real-time learning is journaled next to MARKOV_DB_PATH, once the journal grows past this many bytes it is compacted
+# into a new snapshot of the whole model
+MARKOV_JOURNAL_COMPACT_SIZE = 4 * 1024 * 1024
+
+# Number of words to keep stacked neighbor matrices cached for, speeds up projecting frequently used words
+MARKOV_PROJECTION_CACHE_SIZE = 1024
+
+# Number of word / neighbor pairs to buffer when retraining before writing them to the DB, about 9 bytes each
+MARKOV_BULK_LEARN_MAX_PAIRS = 5000000
+
+# Processes to parse and learn training data with when training the markov model, 1 trains in the main process.
+# Each process learns shards of this many messages into its own model, which are then merged in order.
+MARKOV_TRAINING_PROCESSES = 1
+MARKOV_TRAINING_SHARD_SIZE = 10000
+
+# Budget of word / neighbor pairs the markov model may hold, 0 is unlimited. Once training or real-time learning grows
+# the model past it, every count is multiplied by MARKOV_PRUNE_DECAY (rounded down) and the pairs with the lowest counts
+# are pruned until MARKOV_PRUNE_TARGET_RATIO of the budget remains. Words left without any neighbors are dropped.
+# A pair takes roughly 300 bytes with the 'trie' engine and 50 bytes with the 'csr' engine.
+MARKOV_PRUNE_MAX_NEIGHBORS = 0
+MARKOV_PRUNE_TARGET_RATIO = 0.8
+MARKOV_PRUNE_DECAY = 1.0
+
 # Weights for generating replies
 MARKOV_GENERATION_WEIGHT_COUNT = 1
 MARKOV_GENERATION_WEIGHT_RATING = 10
@@ -31,6 +76,16 @@ CAPITALIZATION_COMPOUND_RULES = ['RT']
 # Maximum number of sequences to train the structure model on
 STRUCTURE_MODEL_TRAINING_MAX_SIZE = 250000
 
+# Write the structure model's training sequences to STRUCTURE_MODEL_SEQUENCES_PATH and stream them from there while
+# training instead of holding them in memory, so it can train on every message rather than just the newest
+# STRUCTURE_MODEL_TRAINING_MAX_SIZE sequences. Each sequence takes 17 bytes on disk.
+STRUCTURE_MODEL_TRAINING_STREAM = False
+STRUCTURE_MODEL_SEQUENCES_PATH = "weights/structure-sequences.bin"
+
 # Lower values make things more predictable, higher ones more random
 STRUCTURE_MODEL_TEMPERATURE = 0.7
 MARKOV_MODEL_TEMPERATURE = 0.7
+
+# Structures the structure model samples ahead of time while idle for each number of sentences requested so far,
+# so replies don't wait on it. 0 samples on demand only.
+STRUCTURE_MODEL_POOL_SIZE = 8
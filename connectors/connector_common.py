@@ -1,6 +1,7 @@
 from markov_engine import MarkovTrieDb, MarkovFilters, MarkovGenerator
 from models.structure import StructureModelScheduler
 from common.nlp import CapitalizationMode
+from common.sampling import CumulativeSampler
 from typing import Optional, List
 from multiprocessing import Process, Queue, Event
 from threading import Thread
@@ -23,6 +24,8 @@ class ConnectorReplyGenerator(object):
         self._markov_model = markov_model
         self._structure_scheduler = structure_scheduler
         self._nlp = None
+        # Sentence count stats only change when training, so they are loaded once
+        self._sentence_counts = None
 
     def give_nlp(self, nlp):
         self._nlp = nlp
@@ -43,20 +46,21 @@ class ConnectorReplyGenerator(object):
         if len(subjects) == 0:
             return "I wasn't trained on that!"
 
-        def structure_generator():
-            sentence_stats_manager = InputTextStatManager()
-            while True:
-                choices, p_values = sentence_stats_manager.probabilities()
-                if len(choices) > 0:
-                    num_sentences = np.random.choice(choices, p=p_values)
-                else:
-                    num_sentences = np.random.randint(1, 5)
-                yield self._structure_scheduler.predict(num_sentences=num_sentences)
+        if self._sentence_counts is None:
+            choices, p_values = InputTextStatManager().probabilities()
+            self._sentence_counts = choices, CumulativeSampler(p_values) if len(choices) > 0 else None
 
-        generator = MarkovGenerator(structure_generator=structure_generator(), subjects=subjects)
+        def sample_structures(count: int) -> list:
+            choices, sampler = self._sentence_counts
+            if sampler is not None:
+                num_sentences = [choices[choice] for choice in sampler.sample_n(count).tolist()]
+            else:
+                num_sentences = np.random.randint(1, 5, count).tolist()
+            return self._structure_scheduler.predict_batch(num_sentences)
 
         reply_words = []
-        sentences = generator.generate(db=self._markov_model)
+        sentences = MarkovGenerator.generate_candidates(sample_structures=sample_structures, subjects=subjects,
+                                                        db=self._markov_model)
         if sentences is None:
             return "Huh?"
         for sentence in sentences:
@@ -49,19 +49,20 @@ class DiscordClient(discord.Client):
 
         filtered_content = DiscordHelper.filter_content(message)
 
+        # Messages learned in real-time are journaled by the markov model, so they are stored as already trained
         learn = False
         # Learn from private messages
         if message.server is None and DISCORD_LEARN_FROM_DIRECT_MESSAGE:
-            DiscordTrainingDataManager().store(message)
+            DiscordTrainingDataManager().store(message, trained=True)
             learn = True
         # Learn from all server messages
         elif message.server is not None and DISCORD_LEARN_FROM_ALL:
             if str(message.channel) not in DISCORD_LEARN_CHANNEL_EXCEPTIONS:
-                DiscordTrainingDataManager().store(message)
+                DiscordTrainingDataManager().store(message, trained=True)
                 learn = True
         # Learn from User
         elif str(message.author) == DISCORD_LEARN_FROM_USER:
-            DiscordTrainingDataManager().store(message)
+            DiscordTrainingDataManager().store(message, trained=True)
             learn = True
 
         # real-time learning
@@ -51,9 +51,10 @@ class TwitterReplyListener(tweepy.StreamListener):
             return
         self._logger.debug("Direct Message(%s): %s" % (direct_message['sender']['screen_name'], direct_message['text']))
 
+        # Messages learned in real-time are journaled by the markov model, so they are stored as already trained
         learn = False
         if TWITTER_LEARN_TIMELINE:
-            TwitterTrainingDataManager().store(status)
+            TwitterTrainingDataManager().store(status, trained=True)
             learn = True
 
         # real-time learning
@@ -76,9 +77,10 @@ class TwitterReplyListener(tweepy.StreamListener):
         if status.author.screen_name == TWITTER_SCREEN_NAME:
             return
 
+        # Messages learned in real-time are journaled by the markov model, so they are stored as already trained
         learn = False
         if TWITTER_LEARN_TIMELINE:
-            TwitterTrainingDataManager().store(status)
+            TwitterTrainingDataManager().store(status, trained=True)
             learn = True
 
         # real-time learning
@@ -1,19 +1,37 @@
 import json
+from multiprocessing import Pool
 import random
 import re
+import struct
 import time
 import zlib
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
 from enum import unique, Enum
-from typing import Optional, List
+from typing import Optional, List, Iterator, Iterable, Union, Tuple, Callable
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where journals aren't locked
+    fcntl = None
 
 import numpy as np
-from spacy.tokens import Doc, Span, Token
+from spacy.tokens import Doc, Token
 
 from config.ml import MARKOV_WINDOW_SIZE, MARKOV_GENERATION_WEIGHT_COUNT, MARKOV_GENERATION_WEIGHT_RATING, \
     MARKOV_GENERATE_SUBJECT_POS_PRIORITY, MARKOV_GENERATE_SUBJECT_MAX, \
-    CAPITALIZATION_COMPOUND_RULES, MARKOV_MODEL_TEMPERATURE
-from common.ml import one_hot, temp
-from common.nlp import Pos, CapitalizationMode
+    CAPITALIZATION_COMPOUND_RULES, MARKOV_MODEL_TEMPERATURE, MARKOV_DB_ENGINE, MARKOV_JOURNAL_COMPACT_SIZE, \
+    MARKOV_PROJECTION_CACHE_SIZE, MARKOV_BULK_LEARN_MAX_PAIRS, MARKOV_TRAINING_PROCESSES, MARKOV_TRAINING_SHARD_SIZE, \
+    SPACY_PIPE_BATCH_SIZE, MARKOV_PRUNE_MAX_NEIGHBORS, MARKOV_PRUNE_TARGET_RATIO, MARKOV_PRUNE_DECAY, \
+    MARKOV_GENERATE_CANDIDATES
+from common.ml import one_hot, batches, write_array_file, read_array_file, atomic_write
+from common.sampling import CumulativeSampler
+from common.nlp import Pos, CapitalizationMode, ParsedToken, ParsedDoc, parse_docs
+
+
+# Pos(value) is slow enough to matter when converting whole neighbor matrices
+POS_BY_VALUE = {pos.value: pos for pos in Pos}
 
 
 class WordKey(object):
@@ -51,13 +69,17 @@ class MarkovNeighbor(object):
 
     @staticmethod
     def from_token(token: Token) -> 'MarkovNeighbor':
+        return MarkovNeighbor.from_parsed_token(ParsedToken.from_token(token, CAPITALIZATION_COMPOUND_RULES))
+
+    @staticmethod
+    def from_parsed_token(token: ParsedToken) -> 'MarkovNeighbor':
         key = token.text.lower()
         text = token.text
-        if CapitalizationMode.from_token(token, CAPITALIZATION_COMPOUND_RULES) == CapitalizationMode.COMPOUND:
+        if token.mode == CapitalizationMode.COMPOUND:
             compound = True
         else:
             compound = False
-        pos = Pos.from_token(token)
+        pos = token.pos
         values = [0, 0]
         dist = [0] * (MARKOV_WINDOW_SIZE * 2 + 1)
         return MarkovNeighbor(key, text, pos, compound, values, dist)
@@ -147,11 +169,15 @@ class MarkovWordProjectionCollection(object):
 
 
 class MarkovWord(object):
-    def __init__(self, text: str, pos: Pos, compound: bool, neighbors: dict):
+    def __init__(self, text: str, pos: Pos, compound: bool, neighbors: dict,
+                 projections: Optional['MarkovProjectionCache'] = None, pos_index: Optional[dict] = None):
         self.text = text
         self.pos = pos
         self.compound = compound
         self.neighbors = neighbors
+        self.projections = projections
+        # Pos value -> keys of the neighbors with that Pos, None if the neighbors are not indexed
+        self.pos_index = pos_index
 
     def __repr__(self):
         return self.text
@@ -161,20 +187,37 @@ class MarkovWord(object):
             MarkovTrieDb.NEIGHBORS_KEY: self.neighbors}
 
     @staticmethod
-    def from_db_format(row: dict) -> 'MarkovWord':
+    def from_db_format(row: dict, projections: Optional['MarkovProjectionCache'] = None) -> 'MarkovWord':
+        # The Pos index is not saved, so build it the first time a word is selected after loading
+        if MarkovTrieDb.POS_INDEX_KEY not in row:
+            row[MarkovTrieDb.POS_INDEX_KEY] = MarkovWord.index_neighbors(row[MarkovTrieDb.NEIGHBORS_KEY])
+
         word = MarkovWord(row[MarkovTrieDb.WORD_KEY][WordKey.TEXT],
                           Pos(row[MarkovTrieDb.WORD_KEY][WordKey.POS]),
                           row[MarkovTrieDb.WORD_KEY][WordKey.COMPOUND],
-                          row[MarkovTrieDb.NEIGHBORS_KEY])
+                          row[MarkovTrieDb.NEIGHBORS_KEY],
+                          projections=projections,
+                          pos_index=row[MarkovTrieDb.POS_INDEX_KEY])
         return word
 
+    @staticmethod
+    def index_neighbors(neighbors: dict) -> dict:
+        pos_index = {}
+        for key, row in neighbors.items():
+            pos_index.setdefault(row[NeighborIdx.POS.value], []).append(key)
+        return pos_index
+
     @staticmethod
     def from_token(token: Token) -> 'MarkovWord':
-        if CapitalizationMode.from_token(token, CAPITALIZATION_COMPOUND_RULES) == CapitalizationMode.COMPOUND:
+        return MarkovWord.from_parsed_token(ParsedToken.from_token(token, CAPITALIZATION_COMPOUND_RULES))
+
+    @staticmethod
+    def from_parsed_token(token: ParsedToken) -> 'MarkovWord':
+        if token.mode == CapitalizationMode.COMPOUND:
             compound = True
         else:
             compound = False
-        return MarkovWord(token.text, Pos.from_token(token), compound=compound, neighbors={})
+        return MarkovWord(token.text, token.pos, compound=compound, neighbors={}, pos_index={})
 
     def get_neighbor(self, key: str) -> Optional[MarkovNeighbor]:
         if key in self.neighbors:
@@ -184,154 +227,1133 @@ class MarkovWord(object):
 
     def set_neighbor(self, neighbor: MarkovNeighbor):
         key, row = neighbor.to_db_format()
+        if self.pos_index is not None and key not in self.neighbors:
+            self.pos_index.setdefault(row[NeighborIdx.POS.value], []).append(key)
         self.neighbors[key] = row
+        if self.projections is not None:
+            self.projections.set_neighbor(self.text, key, row)
 
     def select_neighbors(self, pos: Optional[Pos], exclude_key: Optional[str] = None) -> MarkovNeighbors:
+        # Only visit the neighbors with a matching Pos when the neighbors are partitioned by it
+        if pos is None:
+            items = self.neighbors.items()
+        elif isinstance(self.neighbors, MarkovCSRNeighbors) and not self.neighbors.materialized:
+            items = self.neighbors.pos_items(pos)
+        elif self.pos_index is not None:
+            items = [(key, self.neighbors[key]) for key in self.pos_index.get(pos.value, [])]
+        else:
+            items = self.neighbors.items()
+
         results = []
-        for key in self.neighbors:
-            neighbor = self.get_neighbor(key)
-            if exclude_key is not None and exclude_key == neighbor.key:
+        for key, row in items:
+            if exclude_key is not None and exclude_key == key:
                 continue
-            elif pos == neighbor.pos or pos is None:
-                results.append(neighbor)
+            elif pos is None or pos.value == row[NeighborIdx.POS.value]:
+                results.append(MarkovNeighbor.from_db_format(key, row))
 
         return MarkovNeighbors(results)
 
+    def neighbor_matrix(self) -> 'MarkovNeighborMatrix':
+        if self.projections is not None:
+            return self.projections.get(self.text, self.neighbors)
+        return MarkovProjectionCache.build(self.neighbors)
+
     def project(self, idx_in_sentence: int, sentence_length: int, pos: Pos,
                 exclude_key: Optional[str] = None) -> MarkovWordProjection:
-
-        # Get all neighbors
+        matrix = self.projections.get(self.text, self.neighbors, lazy=True) if self.projections is not None else None
+        if matrix is None:
+            return self._project_neighbors(idx_in_sentence, sentence_length, pos, exclude_key=exclude_key)
+        return matrix.project(idx_in_sentence, sentence_length, pos, exclude_key=exclude_key)
+
+    def _project_neighbors(self, idx_in_sentence: int, sentence_length: int, pos: Pos,
+                           exclude_key: Optional[str] = None) -> MarkovWordProjection:
+        # Only visits the neighbors with a matching Pos, which is cheaper than stacking every neighbor into a matrix
+        # for a word which is only projected once
         neighbors = self.select_neighbors(pos, exclude_key=exclude_key)
+        dist = np.array([neighbor.dist for neighbor in neighbors]).reshape((len(neighbors), MARKOV_WINDOW_SIZE * 2 + 1))
+        magnitudes = np.array([neighbor.values[NeighborValueIdx.COUNT.value] * MARKOV_GENERATION_WEIGHT_COUNT +
+                               neighbor.values[NeighborValueIdx.RATING.value] * MARKOV_GENERATION_WEIGHT_RATING
+                               for neighbor in neighbors], dtype=np.float64).reshape((len(neighbors), 1))
 
-        neighbor_keys = []
-        neighbor_pos = []
-
-        # Setup matrices
-        distance_distributions = np.zeros((len(neighbors), sentence_length))
-        neighbor_magnitudes = np.zeros((len(neighbors), 1))
-
-        for neighbor_idx, neighbor in enumerate(neighbors):
+        return MarkovWordProjection(magnitudes, project_distances(dist, idx_in_sentence, sentence_length),
+                                    [neighbor.text for neighbor in neighbors], [neighbor.pos for neighbor in neighbors])
 
-            # Save Key
-            neighbor_keys.append(neighbor.text)
-            neighbor_pos.append(neighbor.pos)
 
-            # Project dist values onto matrix space
-            for dist_idx, dist_value in enumerate(neighbor.dist):
+class GeneratedWord(MarkovWord):
+    def __init__(self, text: str, pos: Pos, compound: bool, neighbors: dict, mode: CapitalizationMode,
+                 projections: Optional['MarkovProjectionCache'] = None, pos_index: Optional[dict] = None):
+        MarkovWord.__init__(self, text, pos, compound, neighbors, projections=projections, pos_index=pos_index)
+        self.mode = mode
 
-                # The actual index of this dist value within our matrix space
-                dist_space_index = (dist_idx - MARKOV_WINDOW_SIZE) + idx_in_sentence
+    @staticmethod
+    def from_markov_word(word: MarkovWord, mode: CapitalizationMode):
+        return GeneratedWord(word.text, word.pos, word.compound, word.neighbors, mode=mode,
+                             projections=word.projections, pos_index=word.pos_index)
+
+
+class MarkovJournal(object):
+    """
+    Append-only log of the docs learned since the last snapshot of a Markov DB was saved. Each doc is stored as its
+    token text, Pos and CapitalizationMode, which is all that is needed to learn its bigrams again on replay.
+    """
+    # Magic, id of the snapshot the journal applies on top of
+    FILE_HEADER = struct.Struct('<4sq')
+    # Payload length, payload CRC32
+    RECORD_HEADER = struct.Struct('<II')
+    MAGIC = b'MKJ2'
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.path = db_path + '.journal'
+        self._file = None
 
-                # Bounds check
-                if not (dist_space_index >= 0 and dist_space_index < sentence_length):
-                    continue
+    @staticmethod
+    def new_snapshot_id() -> int:
+        return random.randint(1, 2 ** 63 - 1)
 
-                distance_distributions[neighbor_idx][dist_space_index] = dist_value
+    @staticmethod
+    def encode(doc: ParsedDoc) -> bytes:
+        return doc.to_bytes()
 
-            # Calculate strength
-            neighbor_magnitudes[neighbor_idx] = neighbor.values[
-                                                    NeighborValueIdx.COUNT.value] * MARKOV_GENERATION_WEIGHT_COUNT \
-                                                + \
-                                                neighbor.values[
-                                                    NeighborValueIdx.RATING.value] * MARKOV_GENERATION_WEIGHT_RATING
+    @staticmethod
+    def decode(payload: bytes) -> ParsedDoc:
+        return ParsedDoc.from_bytes(payload)
+
+    def size(self) -> int:
+        return self._file.tell() if self._file is not None else 0
+
+    def read(self, snapshot_id: int) -> Tuple[List[ParsedDoc], int]:
+        """
+        Reads the docs journaled on top of the snapshot without modifying the journal. Returns them and the end of the
+        last intact record, which is 0 if the journal doesn't apply to the snapshot.
+        """
+        try:
+            data = open(self.path, 'rb').read()
+        except FileNotFoundError:
+            data = b''
+
+        # A journal written on top of a different snapshot has already been compacted into it
+        if len(data) < MarkovJournal.FILE_HEADER.size or \
+                MarkovJournal.FILE_HEADER.unpack_from(data, 0) != (MarkovJournal.MAGIC, snapshot_id):
+            return [], 0
+
+        docs = []
+        offset = MarkovJournal.FILE_HEADER.size
+        while offset + MarkovJournal.RECORD_HEADER.size <= len(data):
+            length, crc = MarkovJournal.RECORD_HEADER.unpack_from(data, offset)
+            start = offset + MarkovJournal.RECORD_HEADER.size
+            payload = data[start:start + length]
+
+            # Stop at a record torn by a crash in the middle of a write. Every doc encodes to at least its sentence
+            # count, so an empty record can only be torn, and the CRC of one is 0 just like the zeroed header's.
+            if length == 0 or len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            try:
+                docs.append(MarkovJournal.decode(payload))
+            except (struct.error, ValueError):
+                break
+            offset = start + length
 
-        return MarkovWordProjection(neighbor_magnitudes, distance_distributions, neighbor_keys, neighbor_pos)
+        return docs, offset
 
+    def open(self, snapshot_id: int) -> List[ParsedDoc]:
+        """
+        Opens the journal for appending, dropping any torn record at its end. Returns the docs journaled on top of the
+        snapshot. Only one process at a time can have a journal open.
+        """
+        self._file = open(self.path, 'a+b')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self.close()
+                raise RuntimeError("%s is already open in another process" % self.path)
+
+        docs, offset = self.read(snapshot_id)
+        if offset == 0:
+            self.reset(snapshot_id)
+        else:
+            self._file.truncate(offset)
+            self._file.seek(offset)
+        return docs
+
+    def reset(self, snapshot_id: int):
+        self._file.seek(0)
+        self._file.truncate(0)
+        self._file.write(MarkovJournal.FILE_HEADER.pack(MarkovJournal.MAGIC, snapshot_id))
+        self._file.flush()
+
+    def append(self, doc: ParsedDoc):
+        payload = MarkovJournal.encode(doc)
+        self._file.write(MarkovJournal.RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        self._file.flush()
+
+    def close(self):
+        # Closing the file releases its lock
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class MarkovDb(object):
+    """Journaling shared by the Markov storage engines"""
+
+    def __init__(self):
+        self._journal = None
+        self._snapshot_id = 0
+        # Docs learned from the journal of the current snapshot
+        self._journal_replayed = 0
+        self._projections = MarkovProjectionCache(MARKOV_PROJECTION_CACHE_SIZE)
+
+    def _replay_journal(self, path: str):
+        # Loading only reads the journal, so any number of processes can load the same model
+        docs, _ = MarkovJournal(path).read(self._snapshot_id)
+        trainer = MarkovTrainer(self)
+        for doc in docs:
+            trainer.learn(doc)
+        self._journal_replayed = len(docs)
+
+    def _saved(self, path: str):
+        # The journal of the old snapshot no longer applies
+        self._journal_replayed = 0
+        if self._journal is not None and self._journal.db_path == path:
+            self._journal.reset(self._snapshot_id)
+
+    def open_journal(self, path: str):
+        """
+        Journals the docs learned with MarkovTrainer(journal=True) next to the snapshot saved at path. The journal is
+        compacted into a new snapshot there once it grows past MARKOV_JOURNAL_COMPACT_SIZE.
+        """
+        self.close_journal()
+        journal = MarkovJournal(path)
+
+        # Catch up on anything journaled since the snapshot was loaded
+        trainer = MarkovTrainer(self)
+        for doc in journal.open(self._snapshot_id)[self._journal_replayed:]:
+            trainer.learn(doc)
+        self._journal = journal
+
+    def close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def journal(self, doc: ParsedDoc):
+        if self._journal is None:
+            return
+
+        self._journal.append(doc)
+
+        # Compact the journal into a new snapshot
+        if self._journal.size() >= MARKOV_JOURNAL_COMPACT_SIZE:
+            self.enforce_budget()
+            self.save(self._journal.db_path)
 
-class GeneratedWord(MarkovWord):
-    def __init__(self, text: str, pos: Pos, compound: bool, neighbors: dict, mode: CapitalizationMode):
-        MarkovWord.__init__(self, text, pos, compound, neighbors)
-        self.mode = mode
+    def save(self, path: str):
+        pass
+
+    def merge(self, other: 'MarkovDb'):
+        """Adds the counts and distances of every neighbor in other to this DB"""
+        for other_word in other.words():
+            word = self.select(other_word.text)
+            if word is None:
+                word = MarkovWord(other_word.text, other_word.pos, other_word.compound, {}, pos_index={})
+
+            for key, row in other_word.neighbors.items():
+                other_neighbor = MarkovNeighbor.from_db_format(key, row)
+                neighbor = word.get_neighbor(key)
+                if neighbor is None:
+                    neighbor = MarkovNeighbor(key, other_neighbor.text, other_neighbor.pos, other_neighbor.compound,
+                                              [0] * len(other_neighbor.values), [0] * len(other_neighbor.dist))
+
+                neighbor.values = [value + added for value, added in zip(neighbor.values, other_neighbor.values)]
+                neighbor.dist = [value + added for value, added in zip(neighbor.dist, other_neighbor.dist)]
+                word.set_neighbor(neighbor)
+
+            if self.update(word) is None:
+                self.insert(word)
+
+    def neighbor_count(self) -> int:
+        return 0
+
+    def prune(self, max_neighbors: int, decay: float = 1.0) -> int:
+        """
+        Keeps the max_neighbors word / neighbor pairs with the highest counts after multiplying every count by decay,
+        and drops the words left without any neighbors along with every pair pointing to them. Returns the number of
+        pairs removed.
+        """
+        return 0
+
+    def enforce_budget(self) -> int:
+        # Prune well below the budget so it is not exceeded again right away
+        if MARKOV_PRUNE_MAX_NEIGHBORS <= 0 or self.neighbor_count() <= MARKOV_PRUNE_MAX_NEIGHBORS:
+            return 0
+        return self.prune(int(MARKOV_PRUNE_MAX_NEIGHBORS * MARKOV_PRUNE_TARGET_RATIO), MARKOV_PRUNE_DECAY)
 
     @staticmethod
-    def from_markov_word(word: MarkovWord, mode: CapitalizationMode):
-        return GeneratedWord(word.text, word.pos, word.compound, word.neighbors, mode=mode)
+    def _prune_mask(counts: np.ndarray, max_neighbors: int) -> np.ndarray:
+        # Least frequently used pairs go first, the earliest pairs win ties
+        keep = np.zeros(len(counts), dtype=bool)
+        keep[np.argsort(-counts, kind='stable')[:max_neighbors]] = True
+        return keep & (counts > 0)
 
 
-class MarkovTrieDb(object):
+class MarkovTrieDb(MarkovDb):
     WORD_KEY = '_W'
     NEIGHBORS_KEY = '_N'
+    VERSION_KEY = '_V'
+    WORDS_KEY = '_D'
+    SNAPSHOT_KEY = '_S'
+    # Held in memory only, see MarkovWord.from_db_format
+    POS_INDEX_KEY = '_I'
+
+    # Version 1 was a character trie, version 2 is a flat index keyed by the lowercased word
+    VERSION = 2
 
     def __init__(self, path: str = None):
+        MarkovDb.__init__(self)
         np.random.seed(int(time.time()))
-        self._trie = {}
+        self._words = {}
         if path is not None:
             self.load(path)
 
     def load(self, path: str):
-        data = zlib.decompress(open(path, 'rb').read()).decode()
-        self._trie = json.loads(data)
+        data = json.loads(zlib.decompress(open(path, 'rb').read()).decode())
+        if MarkovTrieDb.VERSION_KEY in data:
+            self._words = data[MarkovTrieDb.WORDS_KEY]
+            self._snapshot_id = data.get(MarkovTrieDb.SNAPSHOT_KEY, 0)
+        else:
+            self._words = MarkovTrieDb._migrate_trie(data)
+            self._snapshot_id = 0
+        self._replay_journal(path)
 
     def save(self, path: str):
-        data = zlib.compress(json.dumps(self._trie, separators=(',', ':')).encode())
-        open(path, 'wb').write(data)
+        self._snapshot_id = MarkovJournal.new_snapshot_id()
+        words = {key: {MarkovTrieDb.WORD_KEY: node[MarkovTrieDb.WORD_KEY],
+                       MarkovTrieDb.NEIGHBORS_KEY: node[MarkovTrieDb.NEIGHBORS_KEY]}
+                 for key, node in self._words.items()}
+        data = {MarkovTrieDb.VERSION_KEY: MarkovTrieDb.VERSION, MarkovTrieDb.SNAPSHOT_KEY: self._snapshot_id,
+                MarkovTrieDb.WORDS_KEY: words}
+        data = zlib.compress(json.dumps(data, separators=(',', ':')).encode())
+
+        with atomic_write(path) as tmp_path:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+        self._saved(path)
+
+    @staticmethod
+    def _migrate_trie(trie: dict) -> dict:
+        # Trie nodes are keyed by single characters, so they can never collide with the word / neighbor keys
+        words = {}
+        nodes = [trie]
+        while len(nodes) > 0:
+            node = nodes.pop()
+            for key in node:
+                if key == MarkovTrieDb.WORD_KEY:
+                    words[node[key][WordKey.TEXT].lower()] = {
+                        MarkovTrieDb.WORD_KEY: node[MarkovTrieDb.WORD_KEY],
+                        MarkovTrieDb.NEIGHBORS_KEY: node[MarkovTrieDb.NEIGHBORS_KEY]}
+                elif key != MarkovTrieDb.NEIGHBORS_KEY:
+                    nodes.append(node[key])
+        return words
 
-    def _getnode(self, word: str) -> Optional[dict]:
+    def _select(self, word: str) -> Optional[dict]:
+        return self._words.get(word.lower())
+
+    def select(self, word: str) -> MarkovWord:
+        row = self._select(word)
+        return MarkovWord.from_db_format(row, self._projections) if row is not None else None
+
+    def _insert(self, word: str, pos: int, compound: bool, neighbors: dict, pos_index: dict) -> Optional[dict]:
         if len(word) == 0:
             return None
 
-        node = self._trie
-        for c in word:
-            try:
-                node = node[c.lower()]
-            except KeyError:
-                return None
-
+        node = {MarkovTrieDb.WORD_KEY: {WordKey.TEXT: word, WordKey.POS: pos, WordKey.COMPOUND: compound},
+                MarkovTrieDb.NEIGHBORS_KEY: neighbors, MarkovTrieDb.POS_INDEX_KEY: pos_index}
+        self._words[word.lower()] = node
         return node
 
-    def _select(self, word: str) -> Optional[dict]:
-        node = self._getnode(word)
+    @staticmethod
+    def _word_pos_index(word: MarkovWord) -> dict:
+        if word.pos_index is None:
+            word.pos_index = MarkovWord.index_neighbors(word.neighbors)
+        return word.pos_index
+
+    def insert(self, word: MarkovWord) -> MarkovWord:
+        if word.projections is not self._projections:
+            self._projections.invalidate(word.text)
+        row = self._insert(word.text, word.pos.value, word.compound, word.neighbors, self._word_pos_index(word))
+        return MarkovWord.from_db_format(row, self._projections) if row is not None else None
+
+    def _update(self, word: str, pos: int, compound: bool, neighbors: dict, pos_index: dict) -> Optional[dict]:
+        node = self._select(word)
         if node is None:
             return None
 
-        if MarkovTrieDb.WORD_KEY in node:
-            return node
+        node[MarkovTrieDb.WORD_KEY] = {WordKey.TEXT: word, WordKey.POS: pos, WordKey.COMPOUND: compound}
+        node[MarkovTrieDb.NEIGHBORS_KEY] = neighbors
+        node[MarkovTrieDb.POS_INDEX_KEY] = pos_index
+        return node
+
+    def update(self, word: MarkovWord) -> Optional[MarkovWord]:
+        if word.projections is not self._projections:
+            self._projections.invalidate(word.text)
+        node = self._update(word.text, word.pos.value, word.compound, word.neighbors, self._word_pos_index(word))
+        return MarkovWord.from_db_format(node, self._projections) if node is not None else None
+
+    def words(self) -> Iterator[MarkovWord]:
+        for node in self._words.values():
+            yield MarkovWord.from_db_format(node, self._projections)
+
+    def neighbor_count(self) -> int:
+        return sum(len(node[MarkovTrieDb.NEIGHBORS_KEY]) for node in self._words.values())
+
+    def prune(self, max_neighbors: int, decay: float = 1.0) -> int:
+        nodes = list(self._words.items())
+        if decay < 1.0:
+            for _, node in nodes:
+                for row in node[MarkovTrieDb.NEIGHBORS_KEY].values():
+                    values = row[NeighborIdx.VALUE_MATRIX.value]
+                    values[NeighborValueIdx.COUNT.value] = int(values[NeighborValueIdx.COUNT.value] * decay)
+                    row[NeighborIdx.DISTANCE_MATRIX.value] = [int(value * decay) for value in
+                                                              row[NeighborIdx.DISTANCE_MATRIX.value]]
+
+        counts = np.fromiter((row[NeighborIdx.VALUE_MATRIX.value][NeighborValueIdx.COUNT.value]
+                              for _, node in nodes for row in node[MarkovTrieDb.NEIGHBORS_KEY].values()),
+                             dtype=np.int64)
+        keep = MarkovDb._prune_mask(counts, max_neighbors)
+        removed = len(keep) - int(np.count_nonzero(keep))
+        keep = keep.tolist()
+
+        dropped = set()
+        start = 0
+        for key, node in nodes:
+            neighbors = node[MarkovTrieDb.NEIGHBORS_KEY]
+            node_keep = keep[start:start + len(neighbors)]
+            start += len(neighbors)
+            if len(neighbors) > 0 and all(node_keep):
+                continue
+
+            neighbors = {neighbor_key: row for (neighbor_key, row), kept in zip(neighbors.items(), node_keep) if kept}
+            if len(neighbors) == 0:
+                del self._words[key]
+                dropped.add(key)
+                continue
+
+            # The Pos index is rebuilt the next time the word is selected
+            node[MarkovTrieDb.NEIGHBORS_KEY] = neighbors
+            node.pop(MarkovTrieDb.POS_INDEX_KEY, None)
+
+        # Neighbors of dropped words can't be selected anymore, which can leave more words without any neighbors
+        while len(dropped) > 0:
+            newly_dropped = set()
+            for key, node in list(self._words.items()):
+                neighbors = node[MarkovTrieDb.NEIGHBORS_KEY]
+                if not any(neighbor_key in dropped for neighbor_key in neighbors):
+                    continue
+
+                neighbors = {neighbor_key: row for neighbor_key, row in neighbors.items() if neighbor_key not in dropped}
+                removed += len(node[MarkovTrieDb.NEIGHBORS_KEY]) - len(neighbors)
+                if len(neighbors) == 0:
+                    del self._words[key]
+                    newly_dropped.add(key)
+                    continue
+
+                node[MarkovTrieDb.NEIGHBORS_KEY] = neighbors
+                node.pop(MarkovTrieDb.POS_INDEX_KEY, None)
+            dropped = newly_dropped
+
+        self._projections.clear()
+        return removed
+
+
+def project_distances(dist: np.ndarray, idx_in_sentence: int, sentence_length: int) -> np.ndarray:
+    # Shift the window centered on idx_in_sentence into sentence space, clipping anything out of bounds
+    distances = np.zeros((len(dist), sentence_length))
+    start = max(0, idx_in_sentence - MARKOV_WINDOW_SIZE)
+    end = min(sentence_length, idx_in_sentence + MARKOV_WINDOW_SIZE + 1)
+    if start < end:
+        offset = MARKOV_WINDOW_SIZE - idx_in_sentence
+        distances[:, start:end] = dist[:, start + offset:end + offset]
+    return distances
+
+
+class MarkovNeighborMatrix(object):
+    """
+    A word's neighbors stacked into arrays, row n holding the neighbor with id ids[n] in vocab.
+    Rows are sorted by Pos, so the neighbors with a given Pos are a contiguous slice, until set_neighbor writes one
+    out of order.
+    """
+
+    def __init__(self, vocab: 'MarkovVocabulary', ids: np.ndarray, pos: np.ndarray, values: np.ndarray,
+                 dist: np.ndarray):
+        self.vocab = vocab
+        self.ids = ids
+        self.pos = pos
+        self.dist = dist
+        self.magnitudes = (values[:, NeighborValueIdx.COUNT.value] * MARKOV_GENERATION_WEIGHT_COUNT +
+                           values[:, NeighborValueIdx.RATING.value] * MARKOV_GENERATION_WEIGHT_RATING).astype(
+            np.float64)
+        self._size = len(ids)
+        self._sorted = True
+        # Whether the arrays and vocab belong to this matrix, rather than to the word's neighbors or a MarkovCSRDb
+        self._owned = False
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def from_neighbors(neighbors: dict) -> 'MarkovNeighborMatrix':
+        rows = list(neighbors.values())
+        vocab = MarkovVocabulary.from_unique_texts([row[NeighborIdx.TEXT.value] for row in rows])
+        pos = np.array([row[NeighborIdx.POS.value] for row in rows], dtype=np.uint8)
+        values = np.array([row[NeighborIdx.VALUE_MATRIX.value] for row in rows], dtype=np.int64).reshape(
+            (len(rows), len(NeighborValueIdx)))
+        dist = np.array([row[NeighborIdx.DISTANCE_MATRIX.value] for row in rows], dtype=np.int64).reshape(
+            (len(rows), MARKOV_WINDOW_SIZE * 2 + 1))
+
+        # Stable, so neighbors sharing a Pos keep their insertion order
+        order = np.argsort(pos, kind='stable')
+        return MarkovNeighborMatrix(vocab, order, pos[order], values[order], dist[order])
+
+    @staticmethod
+    def pos_range(pos: np.ndarray, value: int) -> tuple:
+        start, end = np.searchsorted(pos, [value, value + 1])
+        return int(start), int(end)
+
+    def _own(self, capacity: int):
+        # Copy the rows into arrays with room to grow, renumbering them so row n is neighbor id n in a vocab of its own
+        size = self._size
+        texts = self.vocab.texts(self.ids[:size])
+        self.vocab = MarkovVocabulary.from_unique_texts(texts)
+        self.ids = np.arange(capacity, dtype=np.int64)
+
+        pos = np.zeros(capacity, dtype=np.uint8)
+        pos[:size] = self.pos[:size]
+        dist = np.zeros((capacity, self.dist.shape[1]), dtype=self.dist.dtype)
+        dist[:size] = self.dist[:size]
+        magnitudes = np.zeros(capacity, dtype=np.float64)
+        magnitudes[:size] = self.magnitudes[:size]
+        self.pos, self.dist, self.magnitudes = pos, dist, magnitudes
+        self._owned = True
+
+    def set_neighbor(self, key: str, row: list):
+        """Writes a neighbor's row in place, appending it if it is new, so the matrix can stay cached as a word learns"""
+        if not self._owned:
+            self._own(max(self._size * 2, 16))
+
+        neighbor_id = self.vocab.get(key)
+        if neighbor_id is None:
+            if self._size == len(self.ids):
+                self._own(self._size * 2)
+            neighbor_id = self.vocab.intern(row[NeighborIdx.TEXT.value])
+            self._size += 1
+        elif self.vocab.text(neighbor_id) != row[NeighborIdx.TEXT.value]:
+            self.vocab.set_text(neighbor_id, row[NeighborIdx.TEXT.value])
+
+        pos = row[NeighborIdx.POS.value]
+        if (neighbor_id > 0 and pos < self.pos[neighbor_id - 1]) or \
+                (neighbor_id < self._size - 1 and pos > self.pos[neighbor_id + 1]):
+            self._sorted = False
+        self.pos[neighbor_id] = pos
+        self.dist[neighbor_id] = row[NeighborIdx.DISTANCE_MATRIX.value]
+        values = row[NeighborIdx.VALUE_MATRIX.value]
+        self.magnitudes[neighbor_id] = values[NeighborValueIdx.COUNT.value] * MARKOV_GENERATION_WEIGHT_COUNT + \
+                                       values[NeighborValueIdx.RATING.value] * MARKOV_GENERATION_WEIGHT_RATING
+
+    def project(self, idx_in_sentence: int, sentence_length: int, pos: Optional[Pos],
+                exclude_key: Optional[str] = None) -> MarkovWordProjection:
+
+        if pos is None:
+            rows = slice(0, self._size)
+        elif self._sorted:
+            rows = slice(*MarkovNeighborMatrix.pos_range(self.pos[:self._size], pos.value))
         else:
+            rows = np.flatnonzero(self.pos[:self._size] == pos.value)
+        ids = self.ids[rows]
+        pos_values = self.pos[rows]
+        dist = self.dist[rows]
+        magnitudes = self.magnitudes[rows]
+
+        if exclude_key is not None:
+            exclude_id = self.vocab.get(exclude_key)
+            if exclude_id is not None and exclude_id in ids:
+                keep = ids != exclude_id
+                ids, pos_values, dist, magnitudes = ids[keep], pos_values[keep], dist[keep], magnitudes[keep]
+
+        distance_distributions = project_distances(dist, idx_in_sentence, sentence_length)
+        neighbor_magnitudes = magnitudes.reshape((len(ids), 1))
+        neighbor_keys = self.vocab.texts(ids)
+        neighbor_pos = [POS_BY_VALUE[value] for value in pos_values.tolist()]
+
+        return MarkovWordProjection(neighbor_magnitudes, distance_distributions, neighbor_keys, neighbor_pos)
+
+
+class MarkovProjectionCache(object):
+    """
+    Neighbor matrices of the most recently projected words. Neighbors set on a word selected with the cache are written
+    through to its matrix, a word written any other way has its matrix dropped.
+    Misses are looked up in the parent cache, if there is one, before the matrix is built.
+    """
+
+    def __init__(self, size: int, parent: Optional['MarkovProjectionCache'] = None):
+        self._size = size
+        self._parent = parent
+        self._matrices = OrderedDict()
+        # Words which have missed once without their matrix being built
+        self._missed = OrderedDict()
+
+    @staticmethod
+    def build(neighbors: dict) -> MarkovNeighborMatrix:
+        # Matrix backed neighbors can be sliced directly without deserializing each one
+        if isinstance(neighbors, MarkovCSRNeighbors) and not neighbors.materialized:
+            return neighbors.matrix()
+        return MarkovNeighborMatrix.from_neighbors(neighbors)
+
+    def get(self, text: str, neighbors: dict, lazy: bool = False) -> Optional[MarkovNeighborMatrix]:
+        """
+        Returns the word's matrix, building it on a miss. With lazy, a word's matrix is only built once it misses for a
+        second time, None is returned the first time so words projected only once don't pay for building it.
+        """
+        key = text.lower()
+        matrix = self._matrices.get(key)
+        if matrix is not None:
+            self._matrices.move_to_end(key)
+            return matrix
+
+        if self._parent is not None:
+            matrix = self._parent.get(text, neighbors, lazy=lazy)
+        elif lazy and key not in self._missed and not (isinstance(neighbors, MarkovCSRNeighbors) and
+                                                        not neighbors.materialized):
+            self._missed[key] = True
+            if len(self._missed) > self._size:
+                self._missed.popitem(last=False)
+        else:
+            self._missed.pop(key, None)
+            matrix = MarkovProjectionCache.build(neighbors)
+
+        if matrix is None:
             return None
+        elif self._size > 0:
+            self._matrices[key] = matrix
+            if len(self._matrices) > self._size:
+                self._matrices.popitem(last=False)
+        return matrix
 
-    def select(self, word: str) -> MarkovWord:
-        row = self._select(word)
-        return MarkovWord.from_db_format(row) if row is not None else None
+    def set_neighbor(self, text: str, key: str, row: list):
+        matrix = self._matrices.get(text.lower())
+        if matrix is not None:
+            matrix.set_neighbor(key, row)
+
+    def invalidate(self, text: str):
+        self._matrices.pop(text.lower(), None)
 
-    def _insert(self, word: str, pos: int, compound: bool, neighbors: dict) -> Optional[dict]:
+    def clear(self):
+        self._matrices.clear()
+        self._missed.clear()
+
+
+class MarkovVocabulary(object):
+    def __init__(self, texts: List[str] = None):
+        self._texts = []
+        self._ids = {}
+        if texts is not None:
+            for text in texts:
+                self.intern(text)
+
+    def __len__(self):
+        return len(self._texts)
+
+    @staticmethod
+    def hash(key: str) -> int:
+        # Stable across processes, unlike hash()
+        return zlib.crc32(key.encode())
 
-        node = self._trie
-        for c in word:
-            if c.lower() in node:
-                node = node[c.lower()]
+    def text(self, word_id: int) -> str:
+        return self._texts[word_id]
+
+    def texts(self, word_ids: np.ndarray) -> List[str]:
+        return [self.text(word_id) for word_id in word_ids.tolist()]
+
+    def set_text(self, word_id: int, text: str):
+        self._texts[word_id] = text
+
+    @staticmethod
+    def from_unique_texts(texts: List[str]) -> 'MarkovVocabulary':
+        # Skips building the lookup table until something is looked up
+        vocab = MarkovVocabulary()
+        vocab._texts = texts
+        vocab._ids = None
+        return vocab
+
+    def get(self, text: str) -> Optional[int]:
+        if self._ids is None:
+            self._ids = {text.lower(): word_id for word_id, text in enumerate(self._texts)}
+        return self._ids.get(text.lower())
+
+    def intern(self, text: str) -> int:
+        word_id = self.get(text)
+        if word_id is None:
+            word_id = len(self)
+            self._ids[text.lower()] = word_id
+            self._texts.append(text)
+        return word_id
+
+    def to_arrays(self) -> tuple:
+        encoded = [self.text(word_id).encode() for word_id in range(0, len(self))]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(text) for text in encoded])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+        # Open addressing hash table of word ids with linear probing, kept at most half full
+        table_size = 2
+        while table_size < len(encoded) * 2:
+            table_size *= 2
+        table = [-1] * table_size
+        for word_id in range(0, len(encoded)):
+            slot = MarkovVocabulary.hash(self.text(word_id).lower()) & (table_size - 1)
+            while table[slot] != -1:
+                slot = (slot + 1) & (table_size - 1)
+            table[slot] = word_id
+
+        return blob, offsets, np.array(table, dtype=np.int32)
+
+
+class MarkovMappedVocabulary(MarkovVocabulary):
+    """
+    Vocabulary queried in place from the arrays written by MarkovVocabulary.to_arrays, so loading it does no parsing.
+    Words interned after loading are kept in memory.
+    """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray, table: np.ndarray):
+        MarkovVocabulary.__init__(self)
+        self._blob = memoryview(blob)
+        self._offsets = offsets
+        self._table = table
+        self._mapped_size = len(offsets) - 1
+        self._overrides = {}
+
+    def __len__(self):
+        return self._mapped_size + len(self._texts)
+
+    def text(self, word_id: int) -> str:
+        if word_id >= self._mapped_size:
+            return self._texts[word_id - self._mapped_size]
+        elif word_id in self._overrides:
+            return self._overrides[word_id]
+        return str(self._blob[self._offsets[word_id]:self._offsets[word_id + 1]], 'utf-8')
+
+    def texts(self, word_ids: np.ndarray) -> List[str]:
+        if self._mapped_size == 0:
+            return MarkovVocabulary.texts(self, word_ids)
+
+        mapped_ids = np.minimum(word_ids, self._mapped_size - 1)
+        starts = self._offsets[mapped_ids].tolist()
+        ends = self._offsets[mapped_ids + 1].tolist()
+
+        texts = []
+        for word_id, start, end in zip(word_ids.tolist(), starts, ends):
+            if word_id >= self._mapped_size or word_id in self._overrides:
+                texts.append(self.text(word_id))
             else:
-                node[c.lower()] = {}
-                node = node[c.lower()]
+                texts.append(str(self._blob[start:end], 'utf-8'))
+        return texts
 
-        node[MarkovTrieDb.WORD_KEY] = {WordKey.TEXT: word, WordKey.POS: pos, WordKey.COMPOUND: compound}
-        node[MarkovTrieDb.NEIGHBORS_KEY] = neighbors
-        return node
+    def set_text(self, word_id: int, text: str):
+        if word_id >= self._mapped_size:
+            self._texts[word_id - self._mapped_size] = text
+        else:
+            self._overrides[word_id] = text
 
-    def insert(self, word: MarkovWord) -> MarkovWord:
-        row = self._insert(word.text, word.pos.value, word.compound, word.neighbors)
-        return MarkovWord.from_db_format(row) if row is not None else None
+    def get(self, text: str) -> Optional[int]:
+        key = text.lower()
+        if key in self._ids:
+            return self._ids[key]
 
-    def _update(self, word: str, pos: int, compound: bool, neighbors: dict) -> Optional[dict]:
-        node = self._select(word)
-        if node is None:
+        mask = len(self._table) - 1
+        slot = MarkovVocabulary.hash(key) & mask
+        while True:
+            word_id = int(self._table[slot])
+            if word_id < 0:
+                return None
+            elif self.text(word_id).lower() == key:
+                return word_id
+            slot = (slot + 1) & mask
+
+
+class MarkovCSRNeighbors(MutableMapping):
+    """
+    Neighbor mapping backed by a single row of a MarkovCSRDb.
+    Reads come straight from the shared arrays. The first write converts the row into the regular dict format, which
+    MarkovCSRDb.update then holds as a pending row until its next compaction.
+    """
+
+    def __init__(self, db: 'MarkovCSRDb', row: int):
+        self._db = db
+        self._row = row
+        self._dict = None
+
+    @property
+    def materialized(self) -> bool:
+        return self._dict is not None
+
+    def _bounds(self) -> tuple:
+        return int(self._db._indptr[self._row]), int(self._db._indptr[self._row + 1])
+
+    def _find(self, key: str) -> Optional[int]:
+        neighbor_id = self._db._vocab.get(key)
+        if neighbor_id is None:
             return None
+        start, end = self._bounds()
+        matches = np.flatnonzero(self._db._indices[start:end] == neighbor_id)
+        return start + int(matches[0]) if len(matches) > 0 else None
+
+    def to_dict(self) -> dict:
+        if self._dict is None:
+            start, end = self._bounds()
+            self._dict = dict(self._db._entry_to_db_format(idx) for idx in range(start, end))
+        return self._dict
+
+    def __getitem__(self, key: str) -> list:
+        if self._dict is not None:
+            return self._dict[key]
+        idx = self._find(key)
+        if idx is None:
+            raise KeyError(key)
+        return self._db._entry_to_db_format(idx)[1]
+
+    def __setitem__(self, key: str, value: list):
+        self.to_dict()[key] = value
+
+    def __delitem__(self, key: str):
+        del self.to_dict()[key]
+
+    def __contains__(self, key) -> bool:
+        if self._dict is not None:
+            return key in self._dict
+        return self._find(key) is not None
+
+    def __iter__(self):
+        if self._dict is not None:
+            return iter(self._dict)
+        start, end = self._bounds()
+        return iter([text.lower() for text in self._db._vocab.texts(self._db._indices[start:end])])
 
-        node[MarkovTrieDb.WORD_KEY] = {WordKey.TEXT: word, WordKey.POS: pos, WordKey.COMPOUND: compound}
-        node[MarkovTrieDb.NEIGHBORS_KEY] = neighbors
-        return node
+    def __len__(self):
+        if self._dict is not None:
+            return len(self._dict)
+        start, end = self._bounds()
+        return end - start
+
+    def items(self):
+        if self._dict is not None:
+            return self._dict.items()
+        start, end = self._bounds()
+        return [self._db._entry_to_db_format(idx) for idx in range(start, end)]
+
+    def pos_items(self, pos: Pos) -> list:
+        # Rows are sorted by Pos, see MarkovCSRDb.compact
+        start, end = self._bounds()
+        pos_start, pos_end = MarkovNeighborMatrix.pos_range(self._db._pos[start:end], pos.value)
+        return [self._db._entry_to_db_format(idx) for idx in range(start + pos_start, start + pos_end)]
+
+    def matrix(self) -> MarkovNeighborMatrix:
+        db = self._db
+        start, end = self._bounds()
+        return MarkovNeighborMatrix(db._vocab, db._indices[start:end], db._pos[start:end], db._values[start:end],
+                                    db._dist[start:end])
+
+
+class MarkovCSRDb(MarkovDb):
+    """
+    Alternative to MarkovTrieDb which interns words to integer ids and keeps every neighbor in compressed sparse row
+    arrays, one row per word. Words written through insert / update are held in the regular dict format until
+    enough of them accumulate to be compacted back into the arrays.
+    Saved models are memory mapped on load and queried in place, so processes loading the same model share its pages.
+    """
+    COMPACT_THRESHOLD = 10000
+
+    def __init__(self, path: str = None):
+        MarkovDb.__init__(self)
+        np.random.seed(int(time.time()))
+        self._vocab = MarkovVocabulary()
+
+        # Word attributes indexed by id, POS is -1 for ids which have only been seen as a neighbor
+        self._word_pos = np.zeros(0, dtype=np.int8)
+        self._word_compound = np.zeros(0, dtype=bool)
+
+        # Neighbors of word id n are stored in [_indptr[n], _indptr[n+1])
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._indices = np.zeros(0, dtype=np.int32)
+        self._pos = np.zeros(0, dtype=np.uint8)
+        self._compound = np.zeros(0, dtype=bool)
+        self._values = np.zeros((0, len(NeighborValueIdx)), dtype=np.int32)
+        self._dist = np.zeros((0, MARKOV_WINDOW_SIZE * 2 + 1), dtype=np.int32)
+
+        # Rows written since the last compaction: id -> (pos, compound, neighbors, pos_index)
+        self._pending = {}
+
+        if path is not None:
+            self.load(path)
+
+    def load(self, path: str):
+        meta, arrays = read_array_file(path)
+        self._vocab = MarkovMappedVocabulary(arrays['vocab_blob'], arrays['vocab_offsets'], arrays['vocab_table'])
+        self._word_pos = arrays['word_pos']
+        self._word_compound = arrays['word_compound']
+        self._indptr = arrays['indptr']
+        self._indices = arrays['indices']
+        self._pos = arrays['pos']
+        self._compound = arrays['compound']
+        self._values = arrays['values']
+        self._dist = arrays['dist']
+        self._snapshot_id = meta['snapshot_id']
+        self._pending = {}
+        self._replay_journal(path)
+
+    def save(self, path: str):
+        self.compact()
+        self._snapshot_id = MarkovJournal.new_snapshot_id()
+        vocab_blob, vocab_offsets, vocab_table = self._vocab.to_arrays()
+
+        with atomic_write(path) as tmp_path:
+            write_array_file(tmp_path, {'vocab_blob': vocab_blob, 'vocab_offsets': vocab_offsets,
+                                        'vocab_table': vocab_table, 'word_pos': self._word_pos,
+                                        'word_compound': self._word_compound, 'indptr': self._indptr,
+                                        'indices': self._indices, 'pos': self._pos, 'compound': self._compound,
+                                        'values': self._values, 'dist': self._dist},
+                             meta={'snapshot_id': self._snapshot_id})
+        self._saved(path)
+
+    def _is_word(self, row: int) -> bool:
+        if row in self._pending:
+            return True
+        return row < len(self._word_pos) and self._word_pos[row] >= 0
+
+    def _entry_to_db_format(self, idx: int) -> tuple:
+        text = self._vocab.text(int(self._indices[idx]))
+        return text.lower(), [text, int(self._pos[idx]), bool(self._compound[idx]), self._values[idx].tolist(),
+                              self._dist[idx].tolist()]
+
+    def select(self, word: str) -> Optional[MarkovWord]:
+        if len(word) == 0:
+            return None
+
+        row = self._vocab.get(word)
+        if row is None:
+            return None
+
+        if row in self._pending:
+            pos, compound, neighbors, pos_index = self._pending[row]
+            return MarkovWord(self._vocab.text(row), Pos(pos), compound, neighbors, projections=self._projections,
+                              pos_index=pos_index)
+        elif self._is_word(row):
+            return MarkovWord(self._vocab.text(row), Pos(int(self._word_pos[row])), bool(self._word_compound[row]),
+                              MarkovCSRNeighbors(self, row), projections=self._projections)
+
+        return None
+
+    def _stage(self, word: MarkovWord) -> int:
+        if word.projections is not self._projections:
+            self._projections.invalidate(word.text)
+        row = self._vocab.intern(word.text)
+        if self._vocab.text(row) != word.text:
+            self._vocab.set_text(row, word.text)
+
+        neighbors = word.neighbors
+        if isinstance(neighbors, MarkovCSRNeighbors):
+            neighbors = neighbors.to_dict()
+
+        # Index the row once when it is first staged, the word keeps it up to date from then on
+        if word.pos_index is None:
+            word.pos_index = MarkovWord.index_neighbors(neighbors)
+
+        self._pending[row] = (word.pos.value, word.compound, neighbors, word.pos_index)
+        return row
+
+    def insert(self, word: MarkovWord) -> MarkovWord:
+        self._stage(word)
+        if len(self._pending) >= MarkovCSRDb.COMPACT_THRESHOLD:
+            self.compact()
+        return self.select(word.text)
 
     def update(self, word: MarkovWord) -> Optional[MarkovWord]:
-        node = self._update(word.text, word.pos.value, word.compound, word.neighbors)
-        return MarkovWord.from_db_format(node) if node is not None else None
+        row = self._vocab.get(word.text)
+        if row is None or not self._is_word(row):
+            return None
+        return self.insert(word)
+
+    def words(self) -> Iterator[MarkovWord]:
+        for row in range(0, len(self._vocab)):
+            word = self.select(self._vocab.text(row))
+            if word is not None:
+                yield word
+
+    def compact(self):
+        if len(self._pending) == 0:
+            return
+
+        # Drop the stale copy of every pending row
+        rows = np.repeat(np.arange(len(self._indptr) - 1, dtype=np.int32), np.diff(self._indptr))
+        keep = ~np.isin(rows, np.fromiter(self._pending.keys(), dtype=np.int32, count=len(self._pending)))
+
+        # Flatten pending rows into coordinate form
+        pending_rows = []
+        pending_indices = []
+        pending_pos = []
+        pending_compound = []
+        pending_values = []
+        pending_dist = []
+        for row, (_, _, neighbors, _) in self._pending.items():
+            for neighbor in neighbors.values():
+                pending_rows.append(row)
+                pending_indices.append(self._vocab.intern(neighbor[NeighborIdx.TEXT.value]))
+                pending_pos.append(neighbor[NeighborIdx.POS.value])
+                pending_compound.append(neighbor[NeighborIdx.COMPOUND.value])
+                pending_values.append(neighbor[NeighborIdx.VALUE_MATRIX.value])
+                pending_dist.append(neighbor[NeighborIdx.DISTANCE_MATRIX.value])
+
+        rows = np.concatenate((rows[keep], np.array(pending_rows, dtype=np.int32)))
+        indices = np.concatenate((self._indices[keep], np.array(pending_indices, dtype=np.int32)))
+        pos = np.concatenate((self._pos[keep], np.array(pending_pos, dtype=np.uint8)))
+        compound = np.concatenate((self._compound[keep], np.array(pending_compound, dtype=bool)))
+        values = np.concatenate((self._values[keep],
+                                 np.array(pending_values, dtype=np.int32).reshape((-1, self._values.shape[1]))))
+        dist = np.concatenate((self._dist[keep],
+                               np.array(pending_dist, dtype=np.int32).reshape((-1, self._dist.shape[1]))))
+
+        # Sort into row order, then by Pos within each row so MarkovWord.select_neighbors can slice by Pos
+        order = np.lexsort((indices, pos, rows))
+        size = len(self._vocab)
+        self._indptr = np.zeros(size + 1, dtype=np.int64)
+        self._indptr[1:] = np.cumsum(np.bincount(rows, minlength=size))
+        self._indices = indices[order]
+        self._pos = pos[order]
+        self._compound = compound[order]
+        self._values = values[order]
+        self._dist = dist[order]
+
+        # Grow word attributes to cover any newly interned ids
+        word_pos = np.full(size, -1, dtype=np.int8)
+        word_pos[:len(self._word_pos)] = self._word_pos
+        word_compound = np.zeros(size, dtype=bool)
+        word_compound[:len(self._word_compound)] = self._word_compound
+        for row, (row_pos, row_compound, _, _) in self._pending.items():
+            word_pos[row] = row_pos
+            word_compound[row] = row_compound
+        self._word_pos = word_pos
+        self._word_compound = word_compound
+
+        self._pending = {}
+
+        # Cached matrices of compacted rows are views of the old arrays, which would otherwise be kept alive by them
+        self._projections.clear()
+
+    def neighbor_count(self) -> int:
+        count = len(self._indices)
+        for row, (_, _, neighbors, _) in self._pending.items():
+            if row < len(self._indptr) - 1:
+                count -= int(self._indptr[row + 1] - self._indptr[row])
+            count += len(neighbors)
+        return count
+
+    def prune(self, max_neighbors: int, decay: float = 1.0) -> int:
+        self.compact()
+
+        values = self._values
+        dist = self._dist
+        if decay < 1.0:
+            values = values.copy()
+            values[:, NeighborValueIdx.COUNT.value] = values[:, NeighborValueIdx.COUNT.value] * decay
+            dist = (dist * decay).astype(np.int32)
+
+        keep = MarkovDb._prune_mask(values[:, NeighborValueIdx.COUNT.value], max_neighbors)
+        size = len(self._word_pos)
+        all_rows = np.repeat(np.arange(size), np.diff(self._indptr))
+
+        # Words left without any neighbors are dropped along with the neighbors referring to them, which can leave
+        # more words without any neighbors
+        word_pos = self._word_pos.copy()
+        while True:
+            word_pos[np.bincount(all_rows[keep], minlength=size) == 0] = -1
+            dangling = keep & (word_pos[self._indices] < 0)
+            if not dangling.any():
+                break
+            keep &= ~dangling
+        rows = all_rows[keep]
+        indices = self._indices[keep]
+
+        # Then ids nothing refers to anymore are renumbered away
+        used = word_pos >= 0
+        used[indices] = True
+        remap = np.cumsum(used) - 1
+        self._vocab = MarkovVocabulary.from_unique_texts(self._vocab.texts(np.flatnonzero(used)))
+        self._word_pos = word_pos[used]
+        self._word_compound = self._word_compound[used]
+
+        # Rows stay sorted, remapping preserves the order of ids
+        size = len(self._word_pos)
+        self._indptr = np.zeros(size + 1, dtype=np.int64)
+        self._indptr[1:] = np.cumsum(np.bincount(remap[rows], minlength=size))
+        self._indices = remap[indices].astype(np.int32)
+        self._pos = self._pos[keep]
+        self._compound = self._compound[keep]
+        self._values = values[keep]
+        self._dist = dist[keep]
+
+        self._projections.clear()
+        return len(keep) - int(np.count_nonzero(keep))
+
+    @staticmethod
+    def from_trie_db(trie_db: MarkovTrieDb) -> 'MarkovCSRDb':
+        db = MarkovCSRDb()
+        for word in trie_db.words():
+            db._stage(word)
+        db.compact()
+        return db
+
+
+def create_markov_db(path: str = None):
+    if MARKOV_DB_ENGINE == 'csr':
+        return MarkovCSRDb(path)
+    return MarkovTrieDb(path)
+
+
+class MarkovGenerationView(object):
+    """
+    Read only view of a DB shared by the candidates of one reply. Each word is selected from the DB once and its
+    neighbor matrix built once, however many candidates use it.
+    """
+
+    def __init__(self, db: MarkovDb):
+        self._db = db
+        self._words = {}
+        self._projections = MarkovProjectionCache(MARKOV_PROJECTION_CACHE_SIZE, parent=db._projections)
+
+    def select(self, word: str) -> Optional[MarkovWord]:
+        key = word.lower()
+        if key not in self._words:
+            markov_word = self._db.select(word)
+            if markov_word is not None:
+                markov_word.projections = self._projections
+            self._words[key] = markov_word
+        return self._words[key]
 
 
 class MarkovGenerator(object):
-    def __init__(self, structure_generator, subjects: List[MarkovWord]):
+    # Sentence structures to try matching the subjects to before giving up
+    STRUCTURE_ATTEMPTS = 10
+
+    def __init__(self, structure_generator, subjects: List[MarkovWord], samplers: Optional[dict] = None):
         self.structure_generator = structure_generator
         self.subjects = subjects
+        # Word choice distributions, which candidates generated from the same view can share
+        self._samplers = samplers if samplers is not None else {}
 
         self.sentence_generations = []
         self.sentence_structures = []
+        # Whether the last generation filled every word rather than returning an approximation
+        self.complete = False
 
     def _reset_data(self):
         self.sentence_generations = []
@@ -346,11 +1368,44 @@ class MarkovGenerator(object):
                     sorted_subjects.append(subject)
         self.subjects = sorted_subjects
 
-    def generate(self, db: MarkovTrieDb) -> Optional[List[List[GeneratedWord]]]:
+    @staticmethod
+    def generate_candidates(sample_structures: Callable[[int], list], subjects: List[MarkovWord], db: MarkovDb,
+                            candidates: int = MARKOV_GENERATE_CANDIDATES) -> Optional[List[List[GeneratedWord]]]:
+        """
+        Generates up to candidates replies from one view of the DB, returning the first complete one or else the
+        approximation with the most words. The structure attempts are split between the candidates, and the structures
+        for all of them are sampled up front with a single call to sample_structures(count).
+        """
+        view = MarkovGenerationView(db)
+        samplers = {}
+        attempts = -(-MarkovGenerator.STRUCTURE_ATTEMPTS // candidates)
+        structures = sample_structures(candidates * attempts)
+
+        best = None
+        best_length = 0
+        for candidate in range(0, candidates):
+            generator = MarkovGenerator(iter(structures[candidate * attempts:(candidate + 1) * attempts]), subjects,
+                                        samplers=samplers)
+            sentences = generator.generate(view, attempts=attempts)
+            if sentences is None:
+                continue
+            elif generator.complete:
+                return sentences
+
+            length = sum([len(sentence) for sentence in sentences])
+            if length > best_length:
+                best = sentences
+                best_length = length
+
+        return best
+
+    def generate(self, db: MarkovTrieDb, attempts: int = STRUCTURE_ATTEMPTS) -> Optional[List[List[GeneratedWord]]]:
+
+        self.complete = False
 
         # Try to much subject to a variety of sentence structures
         subjects_assigned = False
-        for i in range(0, 10):
+        for i in range(0, attempts):
             self._split_sentences()
             self._sort_subjects()
             if self._assign_subjects():
@@ -372,6 +1427,7 @@ class MarkovGenerator(object):
             else:
                 return None
 
+        self.complete = True
         return self.sentence_generations
 
     # Split into individual sentences and populate generation arrays
@@ -449,31 +1505,36 @@ class MarkovGenerator(object):
                     if blank_idx is None or len(project_idx) == 0:
                         return False
 
-                    projections = []
                     blank_pos = self.sentence_structures[sentence_idx][blank_idx].pos
-                    for word_idx in project_idx:
-                        projecting_word = self.sentence_generations[sentence_idx][word_idx]
-                        projection = projecting_word.project(word_idx, sentence_length, blank_pos,
-                                                             exclude_key=exclude_key)
-                        projections.append(projection)
-
-                    # Concatenate all projections and create p-value matrix
-                    projection_collection = MarkovWordProjectionCollection(projections)
-                    if len(projection_collection) == 0:
-                        return False
-
-                    all_p_values = projection_collection.probability_matrix()
-
-                    # We just want the p-values for the blank word
-                    p_values = all_p_values[:, blank_idx]
 
-                    # Choose an index based on the probability
-                    choices = np.arange(len(projection_collection))
-
-                    word_choice_idx = temp(p_values, temperature=MARKOV_MODEL_TEMPERATURE)
+                    # The same words projecting onto the same blank always give the same distribution
+                    sampler_key = (tuple((self.sentence_generations[sentence_idx][word_idx].text.lower(), word_idx)
+                                         for word_idx in project_idx), sentence_length, blank_idx, blank_pos,
+                                   exclude_key)
+                    if sampler_key not in self._samplers:
+                        projections = []
+                        for word_idx in project_idx:
+                            projecting_word = self.sentence_generations[sentence_idx][word_idx]
+                            projection = projecting_word.project(word_idx, sentence_length, blank_pos,
+                                                                 exclude_key=exclude_key)
+                            projections.append(projection)
+
+                        # Concatenate all projections and create p-value matrix
+                        projection_collection = MarkovWordProjectionCollection(projections)
+                        if len(projection_collection) == 0:
+                            self._samplers[sampler_key] = None
+                        else:
+                            # We just want the p-values for the blank word
+                            p_values = projection_collection.probability_matrix()[:, blank_idx]
+                            self._samplers[sampler_key] = (projection_collection.keys,
+                                                           CumulativeSampler(p_values, MARKOV_MODEL_TEMPERATURE))
+
+                    if self._samplers[sampler_key] is None:
+                        return False
+                    keys, sampler = self._samplers[sampler_key]
 
                     # Select the word from the database and assign it to the blank space
-                    select_word = projection_collection.keys[word_choice_idx]
+                    select_word = keys[sampler.sample()]
                     word = GeneratedWord.from_markov_word(db.select(select_word),
                                                           self.sentence_structures[sentence_idx][blank_idx].mode)
                     self.sentence_generations[sentence_idx][blank_idx] = word
@@ -550,66 +1611,273 @@ class MarkovFilters(object):
         return smoothed
 
 
-class MarkovTrainer(object):
-    def __init__(self, engine: MarkovTrieDb):
-        self.engine = engine
+class MarkovNgramCounter(object):
+    """
+    (word, neighbor, distance) occurrences of any number of docs, held as arrays of token form ids.
+    Repeated pairs are aggregated before anything is written, so apply writes each pair and each word once.
+    Counters are small to pickle once compacted, and can be merged, so docs can be counted in other processes.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # Distinct (text, Pos, CapitalizationMode) tokens and the id of their lowercased text
+        self._forms = []
+        self._form_ids = {}
+        self._form_words = []
+        self._word_ids = {}
 
-    def learn(self, doc: Doc):
-        bi_grams = []
-        for sentence in doc.sents:
-            bi_grams += MarkovTrainer.span_to_bigram(sentence)
+        self._sources = []
+        self._neighbors = []
+        self._dists = []
+        # Occurrences each row stands for once compacted, None for chunks of single occurrences
+        self._weights = []
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _form_id(self, token: ParsedToken) -> int:
+        key = (token.text, token.pos, token.mode)
+        form_id = self._form_ids.get(key)
+        if form_id is None:
+            form_id = len(self._forms)
+            self._form_ids[key] = form_id
+            self._forms.append(token)
+            self._form_words.append(self._word_ids.setdefault(token.text.lower(), len(self._word_ids)))
+        return form_id
+
+    def add(self, doc: ParsedDoc):
+        tokens = [token for sentence in doc.sents for token in sentence]
+        token_forms = np.array([self._form_id(token) for token in tokens], dtype=np.int32)
+        sentence_ids = np.repeat(np.arange(len(doc.sents)), [len(sentence) for sentence in doc.sents])
+
+        sources, neighbors, dists = MarkovTrainer.window_ngrams(sentence_ids)
+        self._sources.append(token_forms[sources])
+        self._neighbors.append(token_forms[neighbors])
+        self._dists.append(dists.astype(np.int8))
+        self._weights.append(None)
+        self._size += len(sources)
+
+    def _arrays(self) -> tuple:
+        weights = [np.ones(len(sources), dtype=np.int64) if chunk_weights is None else chunk_weights
+                   for sources, chunk_weights in zip(self._sources, self._weights)]
+        return (np.concatenate(self._sources), np.concatenate(self._neighbors),
+                np.concatenate(self._dists).astype(np.int64), np.concatenate(weights))
+
+    def compact(self):
+        # Repeated (word form, neighbor form, distance) occurrences become one weighted row, kept in the order they
+        # first occur
+        if self._size == 0:
+            return
+
+        sources, neighbors, dists, weights = self._arrays()
+        window = MARKOV_WINDOW_SIZE * 2 + 1
+        row_ids = (sources.astype(np.int64) * len(self._forms) + neighbors) * window + dists + MARKOV_WINDOW_SIZE
+        _, first, inverse = np.unique(row_ids, return_index=True, return_inverse=True)
+        weights = np.bincount(inverse, weights=weights, minlength=len(first)).astype(np.int64)
+
+        order = np.argsort(first)
+        self._sources = [sources[first[order]]]
+        self._neighbors = [neighbors[first[order]]]
+        self._dists = [dists[first[order]].astype(np.int8)]
+        self._weights = [weights[order]]
+        self._size = len(first)
+
+    def merge(self, other: 'MarkovNgramCounter'):
+        """Adds the occurrences counted by other, as if its docs had been added after this counter's"""
+        if other._size == 0:
+            return
+
+        remap = np.array([self._form_id(form) for form in other._forms], dtype=np.int32)
+        sources, neighbors, dists, weights = other._arrays()
+        self._sources.append(remap[sources])
+        self._neighbors.append(remap[neighbors])
+        self._dists.append(dists.astype(np.int8))
+        self._weights.append(weights)
+        self._size += len(sources)
+
+    def apply(self, engine: MarkovDb):
+        if self._size == 0:
+            return
+
+        sources, neighbors, dists, weights = self._arrays()
+
+        # Aggregate every occurrence of the same (word, neighbor) pair
+        form_words = np.array(self._form_words, dtype=np.int64)
+        pair_ids = form_words[sources] * len(self._word_ids) + form_words[neighbors]
+        _, first, inverse = np.unique(pair_ids, return_index=True, return_inverse=True)
+        counts = np.bincount(inverse, weights=weights, minlength=len(first)).astype(np.int64)
+        window = MARKOV_WINDOW_SIZE * 2 + 1
+        histograms = np.bincount(inverse * window + dists + MARKOV_WINDOW_SIZE, weights=weights,
+                                 minlength=len(first) * window).astype(np.int64).reshape((len(first), window))
+
+        # Apply pairs in the order they first occur, so new words and neighbors take the text of their first token
+        order = np.argsort(first)
+        first_sources = sources[first[order]].tolist()
+        first_neighbors = neighbors[first[order]].tolist()
 
         row_cache = {}
-        for ngram in bi_grams:
-            if ngram[0].text in row_cache:
-                word = row_cache[ngram[0].text]
-            else:
+        for source_form, neighbor_form, count, histogram in zip(first_sources, first_neighbors,
+                                                                counts[order].tolist(), histograms[order].tolist()):
+            source = self._forms[source_form]
+            word = row_cache.get(source.text.lower())
+            if word is None:
                 # Attempt to load from DB
-                word = self.engine.select(ngram[0].text)
+                word = engine.select(source.text)
                 if word is None:
                     # If not already in the DB, create a new word object
-                    word = MarkovWord.from_token(ngram[0])
+                    word = MarkovWord.from_parsed_token(source)
+                row_cache[source.text.lower()] = word
 
             # Handle neighbor
-            neighbor_lookup_key = ngram[1].text.lower()
-
-            neighbor = word.get_neighbor(neighbor_lookup_key)
+            neighbor_token = self._forms[neighbor_form]
+            neighbor = word.get_neighbor(neighbor_token.text.lower())
             if neighbor is None:
-                neighbor = MarkovNeighbor.from_token(ngram[1])
+                neighbor = MarkovNeighbor.from_parsed_token(neighbor_token)
+
+            # Increase count and add distances
+            neighbor.values[NeighborValueIdx.COUNT.value] += count
+            neighbor.dist = [value + added for value, added in zip(neighbor.dist, histogram)]
+
+            # Convert to db format and store in word, indexing it by Pos if it is new
+            word.set_neighbor(neighbor)
 
-            # Increase Count
-            neighbor.values[NeighborValueIdx.COUNT.value] += 1
+        # Write each word to the DB once
+        for word in row_cache.values():
+            if engine.update(word) is None:
+                engine.insert(word)
 
-            # Add distance
-            dist_one_hot_base = np.array(neighbor.dist)
-            dist_one_hot_add = np.array(MarkovNeighbor.distance_one_hot(ngram[2]))
+        self.clear()
 
-            neighbor.dist = (dist_one_hot_base + dist_one_hot_add).tolist()
 
-            # Convert to db format and store in word
-            key, neighbor_db = neighbor.to_db_format()
-            word.neighbors[key] = neighbor_db
+class MarkovTrainer(object):
+    def __init__(self, engine: MarkovDb, journal: bool = False):
+        self.engine = engine
+        self.journal = journal
+
+    def learn(self, doc: Union[Doc, ParsedDoc]):
+        if not isinstance(doc, ParsedDoc):
+            doc = ParsedDoc.from_doc(doc, CAPITALIZATION_COMPOUND_RULES)
 
-            # Write word to DB
-            if self.engine.update(word) is None:
-                self.engine.insert(word)
+        counter = MarkovNgramCounter()
+        counter.add(doc)
+        counter.apply(self.engine)
 
-            # Cache word
-            row_cache[ngram[0].text] = word
+        if self.journal:
+            self.engine.journal(doc)
 
     @staticmethod
-    def span_to_bigram(span: Span) -> list:
+    def window_ngrams(sentence_ids: np.ndarray) -> tuple:
+        """
+        Pairs every token with the tokens of the same sentence within MARKOV_WINDOW_SIZE of it, given the sentence id
+        of each token. Returns (source, neighbor, distance) arrays ordered by source then neighbor position.
+        """
+        offsets = np.concatenate((np.arange(-MARKOV_WINDOW_SIZE, 0), np.arange(1, MARKOV_WINDOW_SIZE + 1)))
+        sources = np.repeat(np.arange(len(sentence_ids)), len(offsets))
+        neighbors = sources + np.tile(offsets, len(sentence_ids))
+
+        in_doc = (neighbors >= 0) & (neighbors < len(sentence_ids))
+        sources, neighbors = sources[in_doc], neighbors[in_doc]
+        same_sentence = sentence_ids[sources] == sentence_ids[neighbors]
+        sources, neighbors = sources[same_sentence], neighbors[same_sentence]
+
+        return sources, neighbors, neighbors - sources
+
+
+class MarkovBulkTrainer(object):
+    """
+    Learns large batches of docs at once when retraining. The n-grams of many docs are counted together and only
+    written to the DB every MARKOV_BULK_LEARN_MAX_PAIRS pairs, call flush once all docs have been learned.
+    The DB is pruned back under MARKOV_PRUNE_MAX_NEIGHBORS after every write.
+    """
+
+    def __init__(self, engine: MarkovDb, max_pairs: int = MARKOV_BULK_LEARN_MAX_PAIRS):
+        self.engine = engine
+        self.max_pairs = max_pairs
+        self._counter = MarkovNgramCounter()
 
-        grams = []
+    def learn(self, doc: Union[Doc, ParsedDoc]):
+        if not isinstance(doc, ParsedDoc):
+            doc = ParsedDoc.from_doc(doc, CAPITALIZATION_COMPOUND_RULES)
 
-        for a_idx, a in enumerate(span):
-            for b_idx, b in enumerate(span):
+        self._counter.add(doc)
+        if len(self._counter) >= self.max_pairs:
+            self.flush()
 
-                dist = b_idx - a_idx
-                if dist == 0:
-                    continue
+    def learn_batch(self, docs: Iterable[Union[Doc, ParsedDoc]]):
+        for doc in docs:
+            self.learn(doc)
+        self.flush()
+
+    def learn_counts(self, counter: MarkovNgramCounter):
+        # N-grams of docs counted elsewhere, such as by the processes of a MarkovParallelTrainer
+        self._counter.merge(counter)
+        if len(self._counter) >= self.max_pairs:
+            self.flush()
+
+    def flush(self):
+        self._counter.apply(self.engine)
+        self.engine.enforce_budget()
+
+
+# spaCy instance of a MarkovParallelTrainer pool process
+_shard_nlp = None
 
-                elif abs(dist) <= MARKOV_WINDOW_SIZE:
-                    grams.append([a, b, dist])
 
-        return grams
+def _init_shard_process(nlp):
+    global _shard_nlp
+    _shard_nlp = nlp
+
+
+def _learn_shard(items: List[Union[str, ParsedDoc]]) -> tuple:
+    counter = MarkovNgramCounter()
+    sentence_counts = []
+    parsed = []
+    docs = parse_docs(_shard_nlp, items, batch_size=SPACY_PIPE_BATCH_SIZE, compound_rules=CAPITALIZATION_COMPOUND_RULES)
+    for item, doc in zip(items, docs):
+        counter.add(doc)
+        sentence_counts.append(len(doc.sents))
+        if not isinstance(item, ParsedDoc):
+            parsed.append(doc.to_bytes())
+    counter.compact()
+    return counter, sentence_counts, parsed
+
+
+class MarkovParallelTrainer(object):
+    """
+    Parses and counts the n-grams of messages in a pool of processes. Messages are split into contiguous shards whose
+    compacted counts are merged in order and learned like MarkovBulkTrainer does, giving the same model as bulk
+    learning every message in the main process.
+    """
+
+    def __init__(self, engine: MarkovDb, nlp, processes: int = MARKOV_TRAINING_PROCESSES,
+                 shard_size: int = MARKOV_TRAINING_SHARD_SIZE):
+        self.engine = engine
+        self.nlp = nlp
+        self.processes = processes
+        self.shard_size = shard_size
+        self._trainer = MarkovBulkTrainer(engine)
+
+    def learn(self, items: Iterable[Union[str, ParsedDoc]]) -> Iterator[tuple]:
+        """
+        Learns filtered message texts, or docs which have already been parsed. Once each shard has been merged,
+        yields the number of sentences of each of its items and the encoded ParsedDoc of each text it parsed.
+        Items are read lazily, only a couple of shards per process are in flight at once. Everything has been written
+        to engine once the generator is exhausted.
+        """
+        with Pool(self.processes, initializer=_init_shard_process, initargs=(self.nlp,)) as pool:
+            pending = deque()
+            for shard in batches(items, self.shard_size):
+                pending.append(pool.apply_async(_learn_shard, (shard,)))
+                if len(pending) >= self.processes * 2:
+                    yield self._merge(pending.popleft().get())
+            while len(pending) > 0:
+                yield self._merge(pending.popleft().get())
+        self._trainer.flush()
+
+    def _merge(self, result: tuple) -> tuple:
+        counter, sentence_counts, parsed = result
+        self._trainer.learn_counts(counter)
+        return sentence_counts, parsed
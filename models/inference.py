@@ -0,0 +1,108 @@
+import os
+from typing import List
+
+import numpy as np
+
+from common.ml import write_array_file, read_array_file, atomic_write
+
+
+def softmax(x: np.ndarray) -> np.ndarray:
+    exp_x = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return exp_x / np.sum(exp_x, axis=-1, keepdims=True)
+
+
+# Keras activations by the name in their layer config
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0.),
+    'tanh': np.tanh,
+    'sigmoid': lambda x: 1. / (1. + np.exp(-x)),
+    # Piecewise linear approximation used by Keras
+    'hard_sigmoid': lambda x: np.clip(0.2 * x + 0.5, 0., 1.),
+    'softmax': softmax,
+}
+
+
+class DenseInference(object):
+    def __init__(self, kernel: np.ndarray, bias: np.ndarray, activation: str = 'linear'):
+        self._kernel = kernel
+        self._bias = bias
+        self._activation = ACTIVATIONS[activation]
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        return self._activation(np.dot(x, self._kernel) + self._bias)
+
+
+class LSTMInference(object):
+    """
+    Steps a Keras LSTM fed by an Embedding layer one timestep at a time for a batch of sequences.
+    The embedding, input kernel and bias are folded into a single table, so a step is one recurrent matrix product.
+    """
+
+    def __init__(self, embeddings: np.ndarray, kernel: np.ndarray, recurrent_kernel: np.ndarray, bias: np.ndarray,
+                 activation: str = 'tanh', recurrent_activation: str = 'hard_sigmoid'):
+        self.units = recurrent_kernel.shape[0]
+        self._inputs = np.dot(embeddings, kernel) + bias
+        self._recurrent_kernel = recurrent_kernel
+        self._activation = ACTIVATIONS[activation]
+        self._recurrent_activation = ACTIVATIONS[recurrent_activation]
+
+    def zero_state(self, batch_size: int = 1) -> tuple:
+        return (np.zeros((batch_size, self.units), dtype=self._inputs.dtype),
+                np.zeros((batch_size, self.units), dtype=self._inputs.dtype))
+
+    def step(self, tokens, state: tuple) -> tuple:
+        h, c = state
+        z = self._inputs[tokens] + np.dot(h, self._recurrent_kernel)
+
+        # Gates are packed input, forget, cell, output
+        units = self.units
+        i = self._recurrent_activation(z[:, :units])
+        f = self._recurrent_activation(z[:, units:units * 2])
+        o = self._recurrent_activation(z[:, units * 3:])
+        c = f * c + i * self._activation(z[:, units * 2:units * 3])
+        h = o * self._activation(c)
+        return h, c
+
+    def run(self, sequences: np.ndarray, state: tuple = None) -> tuple:
+        # sequences is (batch, timesteps) of token ids
+        if state is None:
+            state = self.zero_state(len(sequences))
+        for timestep in range(0, sequences.shape[1]):
+            state = self.step(sequences[:, timestep], state)
+        return state
+
+
+def inference_path(path: str) -> str:
+    # Exported weights are kept next to the Keras weights, e.g. weights/structure-model.bin
+    return os.path.splitext(path)[0] + '.bin'
+
+
+def keras_layers(model) -> List[tuple]:
+    # (spec, weights) of each layer of a Keras Sequential model
+    layers = []
+    for layer in model.layers:
+        config = layer.get_config()
+        spec = {'type': type(layer).__name__}
+        for key in ['activation', 'recurrent_activation']:
+            if key in config:
+                spec[key] = config[key]
+        layers.append((spec, layer.get_weights()))
+    return layers
+
+
+def export_layers(path: str, layers: List[tuple]):
+    arrays = {}
+    for layer_idx, (spec, weights) in enumerate(layers):
+        spec['weights'] = len(weights)
+        for weight_idx, weight in enumerate(weights):
+            arrays['%d_%d' % (layer_idx, weight_idx)] = weight
+
+    with atomic_write(path) as tmp_path:
+        write_array_file(tmp_path, arrays, meta={'layers': [spec for spec, _ in layers]})
+
+
+def import_layers(path: str) -> List[tuple]:
+    meta, arrays = read_array_file(path)
+    return [(spec, [np.array(arrays['%d_%d' % (layer_idx, weight_idx)]) for weight_idx in range(spec['weights'])])
+            for layer_idx, spec in enumerate(meta['layers'])]
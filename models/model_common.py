@@ -1,61 +1,227 @@
+import itertools
+import logging
+import pickle
+import time
+import traceback
+from concurrent.futures import Future
 from enum import unique, Enum
 from multiprocessing import Queue, Process
+from queue import Empty
+from threading import Thread, Lock
+from typing import List, Optional, Tuple
+
+from config.ml import ML_PREDICT_BATCH_WINDOW, ML_PREDICT_BATCH_MAX_SIZE
 
 
 class MLModelScheduler(object):
+    """
+    Sends commands to a model worker process and hands back futures of their results. Every request is tagged with an
+    id, so any number of them can be in flight at once. Predictions go through a separate priority lane which the
+    worker serves even while it is busy training, saving or loading on the normal lane.
+    """
+
     def __init__(self):
         self._read_queue = Queue()
         self._write_queue = Queue()
+        self._priority_queue = Queue()
         self._worker = None
 
+        self._request_ids = itertools.count()
+        self._lock = Lock()
+        # Request id -> (future, command, priority, time sent)
+        self._requests = {}
+        # Command -> [count, total seconds, max seconds]
+        self._latencies = {}
+        self._dispatcher = Thread(target=self._dispatch, daemon=True)
+
     def start(self):
         self._worker.start()
+        self._dispatcher.start()
 
     def shutdown(self):
-        self._write_queue.put([MLWorkerCommands.SHUTDOWN, None])
+        self._write_queue.put([None, MLWorkerCommands.SHUTDOWN, None])
+        self._priority_queue.put([None, MLWorkerCommands.SHUTDOWN, None])
+
+    def _dispatch(self):
+        while True:
+            request_id, result, failed = self._read_queue.get()
+            # The worker's last message once it has shut down
+            if request_id is None:
+                return
+
+            with self._lock:
+                future, command, _, sent = self._requests.pop(request_id)
+                latency = time.time() - sent
+                stats = self._latencies.setdefault(command, [0, 0., 0.])
+                stats[0] += 1
+                stats[1] += latency
+                stats[2] = max(stats[2], latency)
+
+            if failed:
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _submit(self, command: 'MLWorkerCommands', data: tuple, priority: bool = False) -> Future:
+        future = Future()
+        with self._lock:
+            request_id = next(self._request_ids)
+            self._requests[request_id] = (future, command, priority, time.time())
+
+        queue = self._priority_queue if priority else self._write_queue
+        queue.put([request_id, command, data])
+        return future
+
+    def metrics(self) -> dict:
+        """Requests in flight on each lane, and the latency of each command in seconds"""
+        with self._lock:
+            priority = len([request for request in self._requests.values() if request[2]])
+            return {'queue_depth': {'priority': priority, 'normal': len(self._requests) - priority},
+                    'latency': {command.name: {'count': count, 'mean': total / count, 'max': latency_max}
+                                for command, (count, total, latency_max) in self._latencies.items()}}
+
+    def _predict_async(self, *data) -> Future:
+        return self._submit(MLWorkerCommands.PREDICT, data, priority=True)
 
     def _predict(self, *data):
-        self._write_queue.put([MLWorkerCommands.PREDICT, data])
-        return self._read_queue.get()
+        return self._predict_async(*data).result()
 
     def _train(self, *data):
-        self._write_queue.put([MLWorkerCommands.TRAIN, data])
-        return self._read_queue.get()
+        return self._submit(MLWorkerCommands.TRAIN, data).result()
 
     def _save(self, *data):
-        self._write_queue.put([MLWorkerCommands.SAVE, data])
-        return self._read_queue.get()
+        return self._submit(MLWorkerCommands.SAVE, data).result()
 
     def _load(self, *data):
-        self._write_queue.put([MLWorkerCommands.LOAD, data])
-        return self._read_queue.get()
+        return self._submit(MLWorkerCommands.LOAD, data).result()
 
 
 class MLModelWorker(Process):
-    def __init__(self, name, read_queue: Queue, write_queue: Queue, use_gpu: bool):
+    def __init__(self, name, read_queue: Queue, write_queue: Queue, use_gpu: bool, priority_queue: Queue = None):
         Process.__init__(self, name=name)
         self._read_queue = read_queue
         self._write_queue = write_queue
+        self._priority_queue = priority_queue if priority_queue is not None else Queue()
         self._use_gpu = use_gpu
         self._model = None
 
     def run(self):
+        # The normal lane is served on its own thread, so a long command there never holds up the priority lane
+        lane = Thread(target=self._serve_lane)
+        lane.start()
+
+        # Command which ended the last batch of predictions
+        pending = None
         while True:
-            command, data = self._read_queue.get()
+            # Commands come first, the worker only does idle work while there are none waiting
+            if pending is not None:
+                request_id, command, data = pending
+            else:
+                try:
+                    request_id, command, data = self._priority_queue.get_nowait()
+                except Empty:
+                    if self._idle():
+                        continue
+                    request_id, command, data = self._priority_queue.get()
+            pending = None
+
             if command == MLWorkerCommands.SHUTDOWN:
+                lane.join()
+                self._write_queue.put([None, None, False])
                 return
             elif command == MLWorkerCommands.PREDICT:
-                self._write_queue.put(self.predict(data))
-            elif command == MLWorkerCommands.TRAIN:
-                self._write_queue.put(self.train(data))
-            elif command == MLWorkerCommands.SAVE:
-                self._write_queue.put(self.save(data))
-            elif command == MLWorkerCommands.LOAD:
-                self._write_queue.put(self.load(data))
+                batch, pending = self._gather([request_id, command, data])
+                self._handle_batch(batch)
+            else:
+                self._handle(request_id, command, data)
+
+    def _gather(self, first: list) -> Tuple[List[list], Optional[list]]:
+        """
+        Collects the predictions reaching the priority lane within ML_PREDICT_BATCH_WINDOW of the first one. Returns
+        them along with the command which ended the batch early, if any.
+        """
+        batch = [first]
+        deadline = time.time() + ML_PREDICT_BATCH_WINDOW
+        while len(batch) < ML_PREDICT_BATCH_MAX_SIZE:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    request = self._priority_queue.get(timeout=timeout)
+                else:
+                    request = self._priority_queue.get_nowait()
+            except Empty:
+                break
+
+            if request[1] != MLWorkerCommands.PREDICT:
+                return batch, request
+            batch.append(request)
+        return batch, None
+
+    def _handle_batch(self, batch: List[list]):
+        if len(batch) == 1:
+            self._handle(*batch[0])
+            return
+
+        try:
+            results = self.predict_batch([data for _, _, data in batch])
+        except Exception:
+            # Predict them one at a time so the error is only raised by the futures of the requests causing it
+            for request in batch:
+                self._handle(*request)
+            return
+
+        for (request_id, _, _), result in zip(batch, results):
+            self._write_queue.put([request_id, result, False])
+
+    def _serve_lane(self):
+        while True:
+            request_id, command, data = self._read_queue.get()
+            if command == MLWorkerCommands.SHUTDOWN:
+                return
+            self._handle(request_id, command, data)
+
+    def _handle(self, request_id: int, command: 'MLWorkerCommands', data: tuple):
+        handlers = {MLWorkerCommands.PREDICT: self.predict,
+                    MLWorkerCommands.TRAIN: self.train,
+                    MLWorkerCommands.SAVE: self.save,
+                    MLWorkerCommands.LOAD: self.load}
+
+        # Errors are raised by the future of the request rather than taking down the worker
+        try:
+            self._write_queue.put([request_id, handlers[command](data), False])
+        except Exception as e:
+            self._write_queue.put([request_id, MLModelWorker._picklable(e), True])
+
+    @staticmethod
+    def _picklable(e: Exception) -> Exception:
+        # The queue pickles in a background thread, where a failure would be lost and the request never answered.
+        # Some exceptions pickle but can't be rebuilt from their args, which would take down the scheduler's dispatcher.
+        try:
+            pickle.loads(pickle.dumps(e))
+            return e
+        except Exception:
+            return RuntimeError("%s: %s\n%s" % (type(e).__name__, e,
+                                                ''.join(traceback.format_exception(type(e), e, e.__traceback__))))
+
+    def _idle(self) -> bool:
+        # A failure stops the idle work until the next command rather than the priority lane
+        try:
+            return self.idle()
+        except Exception:
+            logging.getLogger(self.name).exception("Idle work failed")
+            return False
+
+    def idle(self) -> bool:
+        # Does one unit of background work, returns False once there is nothing left to do
+        return False
 
     def predict(self, *data):
         pass
 
+    def predict_batch(self, batch: List[tuple]) -> list:
+        # Workers whose model can predict many requests at once override this
+        return [self.predict(data) for data in batch]
+
     def train(self, *data):
         pass
 
@@ -72,4 +238,4 @@ class MLWorkerCommands(Enum):
     TRAIN = 1
     PREDICT = 2
     SAVE = 3
-    LOAD = 4
\ No newline at end of file
+    LOAD = 4
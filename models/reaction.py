@@ -1,8 +1,12 @@
 import re
+from concurrent.futures import Future
 from multiprocessing import Queue
+from typing import List
 
 import numpy as np
 
+from config.ml import ML_INFERENCE_ONLY
+from models.inference import DenseInference, inference_path, keras_layers, export_layers, import_layers
 from models.model_common import MLModelScheduler, MLModelWorker
 
 
@@ -145,9 +149,45 @@ class AOLReactionFeatureAnalyzer(object):
         return len(chars) / len(line)
 
 
-class AOLReactionModel(object):
+class AOLReactionInferenceModel(object):
+    """Predicts reactions from the weights AOLReactionModel exports using NumPy alone, so it can't be trained"""
     PREDICT_THRESHOLD = 0.50
 
+    def __init__(self):
+        # Exported (spec, weights) of each layer, and the NumPy copy of the Dense stack built from them
+        self._layers = None
+        self._inference = None
+
+    @staticmethod
+    def _from_layers(layers: List[tuple]) -> List[DenseInference]:
+        return [DenseInference(*weights, activation=spec['activation']) for spec, weights in layers]
+
+    def _inference_layers(self) -> List[DenseInference]:
+        return self._inference
+
+    def train(self, data, labels, epochs=1):
+        raise RuntimeError("The reaction model can't be trained with ML_INFERENCE_ONLY set")
+
+    def predict(self, text: str):
+        return self.predict_batch([text])[0]
+
+    def predict_batch(self, texts: List[str]) -> List[bool]:
+        prediction = np.array([AOLReactionFeatureAnalyzer.analyze(text) for text in texts])
+        for layer in self._inference_layers():
+            prediction = layer(prediction)
+        return [bool(reaction) for reaction in prediction[:, 0] >= AOLReactionInferenceModel.PREDICT_THRESHOLD]
+
+    def load(self, path):
+        self._layers = import_layers(inference_path(path))
+        self._inference = AOLReactionInferenceModel._from_layers(self._layers)
+
+    def save(self, path):
+        if self._layers is None:
+            raise RuntimeError("The reaction model has no weights to save until it is loaded")
+        export_layers(inference_path(path), self._layers)
+
+
+class AOLReactionModel(AOLReactionInferenceModel):
     def __init__(self, path: str = None, use_gpu=False):
 
         import tensorflow as tf
@@ -155,6 +195,8 @@ class AOLReactionModel(object):
         from keras.layers import Dense
         from keras.backend import set_session
 
+        AOLReactionInferenceModel.__init__(self)
+
         self.model = Sequential()
         self.model.add(Dense(AOLReactionFeatureAnalyzer.NUM_FEATURES, activation='relu',
                              input_dim=AOLReactionFeatureAnalyzer.NUM_FEATURES))
@@ -169,36 +211,43 @@ class AOLReactionModel(object):
             config.gpu_options.allow_growth = True
             set_session(tf.Session(config=config))
 
+        self._update_inference()
+
+    def _update_inference(self):
+        self._inference = AOLReactionInferenceModel._from_layers(keras_layers(self.model))
+
     def train(self, data, labels, epochs=1):
         self.model.fit(np.array(data), np.array(labels), epochs=epochs, batch_size=32)
-
-    def predict(self, text: str):
-        features = np.array([AOLReactionFeatureAnalyzer.analyze(text)])
-        prediction = self.model.predict(features)[0]
-        if prediction >= AOLReactionModel.PREDICT_THRESHOLD:
-            return True
-        else:
-            return False
+        self._update_inference()
 
     def load(self, path):
         self.model.load_weights(path)
+        self._update_inference()
 
     def save(self, path):
         self.model.save_weights(path)
+        # Serving only deployments load these with AOLReactionInferenceModel
+        export_layers(inference_path(path), keras_layers(self.model))
 
 
 class AOLReactionModelWorker(MLModelWorker):
-    def __init__(self, read_queue: Queue, write_queue: Queue, use_gpu: bool = False):
+    def __init__(self, read_queue: Queue, write_queue: Queue, use_gpu: bool = False, priority_queue: Queue = None):
         MLModelWorker.__init__(self, name='AOLReactionModelWorker', read_queue=read_queue, write_queue=write_queue,
-                               use_gpu=use_gpu)
+                               use_gpu=use_gpu, priority_queue=priority_queue)
 
     def run(self):
-        self._model = AOLReactionModel(use_gpu=self._use_gpu)
+        if ML_INFERENCE_ONLY:
+            self._model = AOLReactionInferenceModel()
+        else:
+            self._model = AOLReactionModel(use_gpu=self._use_gpu)
         MLModelWorker.run(self)
 
     def predict(self, *data):
         return self._model.predict(text=data[0][0])
 
+    def predict_batch(self, batch: List[tuple]) -> List[bool]:
+        return self._model.predict_batch([data[0] for data in batch])
+
     def train(self, *data):
         return self._model.train(data=data[0][0], labels=data[0][1], epochs=data[0][2])
 
@@ -213,11 +262,14 @@ class AOLReactionModelScheduler(MLModelScheduler):
     def __init__(self, path, use_gpu: bool = False):
         MLModelScheduler.__init__(self)
         self._worker = AOLReactionModelWorker(read_queue=self._write_queue, write_queue=self._read_queue,
-                                              use_gpu=use_gpu)
+                                              use_gpu=use_gpu, priority_queue=self._priority_queue)
 
     def predict(self, text: str):
         return self._predict(text)
 
+    def predict_async(self, text: str) -> Future:
+        return self._predict_async(text)
+
     def train(self, data, labels, epochs=1):
         return self._train(data, labels, epochs)
 
@@ -1,66 +1,119 @@
+import os
+from collections import deque
+from concurrent.futures import Future
 from multiprocessing import Queue
-from typing import List, Tuple
+from typing import List, Tuple, Union
 
 import numpy as np
 from spacy.tokens import Token, Doc
 
-from common.ml import MLDataPreprocessor, temp
-from common.nlp import Pos, CapitalizationMode
+from common.ml import MLDataPreprocessor, SharedArrays, read_array_file, array_batches
+from common.nlp import Pos, CapitalizationMode, ParsedToken, ParsedDoc
+from common.sampling import sample_rows
 from config.ml import CAPITALIZATION_COMPOUND_RULES, STRUCTURE_MODEL_TRAINING_MAX_SIZE, \
-    STRUCTURE_MODEL_TEMPERATURE
+    STRUCTURE_MODEL_TEMPERATURE, STRUCTURE_MODEL_POOL_SIZE, ML_INFERENCE_ONLY
+from models.inference import LSTMInference, DenseInference, inference_path, keras_layers, export_layers, import_layers
 from models.model_common import MLModelScheduler, MLModelWorker
 
 
 class StructurePreprocessor(MLDataPreprocessor):
-    def __init__(self):
+    # Rows buffered at a time before they are appended to the sequence file when streaming
+    CHUNK_SIZE = 65536
+
+    def __init__(self, path: str = None):
+        """
+        Sequences are kept in memory, up to STRUCTURE_MODEL_TRAINING_MAX_SIZE of them. Given a path there is no limit,
+        they are appended to a sequence file there instead, see read_sequences.
+        """
         MLDataPreprocessor.__init__(self, 'StructurePreprocessor')
+        self.path = path
 
-    def get_preprocessed_data(self) -> Tuple:
-        from keras.preprocessing.sequence import pad_sequences
-        structure_data = pad_sequences(self.data, StructureModel.SEQUENCE_LENGTH, padding='post')
-        structure_labels = np.array(self.labels)
-        return structure_data, structure_labels
+        # Sequences are written straight into preallocated rows, post padded with zeros like pad_sequences would
+        dtype = StructurePreprocessor._dtype()
+        rows = STRUCTURE_MODEL_TRAINING_MAX_SIZE if path is None else StructurePreprocessor.CHUNK_SIZE
+        self.data = np.zeros((rows, StructureModel.SEQUENCE_LENGTH), dtype=dtype)
+        self.labels = np.zeros(rows, dtype=dtype)
+        self._size = 0
 
-    def preprocess(self, doc: Doc) -> bool:
-        if len(self.data) >= STRUCTURE_MODEL_TRAINING_MAX_SIZE:
-            return False
+        self._file = open(path, 'wb') if path is not None else None
 
-        sequence = []
-        previous_item = None
-        for sentence_idx, sentence in enumerate(doc.sents):
-            if len(self.data) >= STRUCTURE_MODEL_TRAINING_MAX_SIZE:
+        # Latest SEQUENCE_LENGTH items of the doc being preprocessed
+        self._window = np.zeros(StructureModel.SEQUENCE_LENGTH, dtype=dtype)
+        self._window_length = 0
+
+    @staticmethod
+    def _dtype() -> np.dtype:
+        # Smallest type holding every embedding
+        return np.min_scalar_type(StructureFeatureAnalyzer.NUM_FEATURES - 1)
+
+    @staticmethod
+    def read_sequences(path: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Maps the data and labels of a sequence file, each row is a sequence followed by its label"""
+        if os.path.getsize(path) == 0:
+            return np.zeros((0, StructureModel.SEQUENCE_LENGTH), dtype=StructurePreprocessor._dtype()), \
+                   np.zeros(0, dtype=StructurePreprocessor._dtype())
+        rows = np.memmap(path, dtype=StructurePreprocessor._dtype(), mode='r').reshape(
+            -1, StructureModel.SEQUENCE_LENGTH + 1)
+        return rows[:, :-1], rows[:, -1]
+
+    def _flush(self):
+        rows = np.empty((self._size, StructureModel.SEQUENCE_LENGTH + 1), dtype=self.data.dtype)
+        rows[:, :-1] = self.data[:self._size]
+        rows[:, -1] = self.labels[:self._size]
+        self._file.write(rows.tobytes())
+        self._size = 0
+
+    def get_preprocessed_data(self) -> Tuple:
+        if self._file is not None:
+            self._flush()
+            self._file.close()
+            self._file = None
+        if self.path is not None:
+            return StructurePreprocessor.read_sequences(self.path)
+        return self.data[:self._size], self.labels[:self._size]
+
+    def _append(self, item: int, label: int) -> bool:
+        if self._size >= len(self.data):
+            if self._file is None:
                 return False
+            self._flush()
+
+        if self._window_length < len(self._window):
+            self._window[self._window_length] = item
+            self._window_length += 1
+        else:
+            self._window[:-1] = self._window[1:]
+            self._window[-1] = item
+
+        self.data[self._size] = self._window
+        self.labels[self._size] = label
+        self._size += 1
+        return True
 
-            for token_idx, token in enumerate(sentence):
-                item = StructureFeatureAnalyzer.analyze(
-                    token, CapitalizationMode.from_token(token, CAPITALIZATION_COMPOUND_RULES))
-                label = item
+    def preprocess(self, doc: Union[Doc, ParsedDoc]) -> bool:
+        if self._size >= len(self.data) and self._file is None:
+            return False
 
-                if len(sequence) == 0:
-                    # Offset data by one, making label point to the next data item
-                    sequence.append(PoSCapitalizationMode(Pos.NONE, CapitalizationMode.NONE).to_embedding())
-                else:
-                    sequence.append(previous_item)
+        if not isinstance(doc, ParsedDoc):
+            doc = ParsedDoc.from_doc(doc, CAPITALIZATION_COMPOUND_RULES)
 
-                # We only want the latest SEQUENCE_LENGTH items
-                sequence = sequence[-StructureModel.SEQUENCE_LENGTH:]
+        self._window[:] = 0
+        self._window_length = 0
 
-                self.data.append(sequence.copy())
-                self.labels.append(label)
+        # Offset data by one, making label point to the next data item
+        previous_item = PoSCapitalizationMode(Pos.NONE, CapitalizationMode.NONE).to_embedding()
+        for sentence_idx, sentence in enumerate(doc.sents):
+            for token_idx, token in enumerate(sentence):
+                item = StructureFeatureAnalyzer.analyze_parsed(token)
+                if not self._append(previous_item, item):
+                    return False
 
                 previous_item = item
 
             # Handle EOS after each sentence
             item = PoSCapitalizationMode(Pos.EOS, CapitalizationMode.NONE).to_embedding()
-            label = item
-
-            sequence.append(previous_item)
-
-            # We only want the latest SEQUENCE_LENGTH items
-            sequence = sequence[-StructureModel.SEQUENCE_LENGTH:]
-
-            self.data.append(sequence.copy())
-            self.labels.append(label)
+            if not self._append(previous_item, item):
+                return False
 
             previous_item = item
         return True
@@ -93,10 +146,114 @@ class StructureFeatureAnalyzer(object):
         mode = PoSCapitalizationMode(pos, mode)
         return mode.to_embedding()
 
+    @staticmethod
+    def analyze_parsed(token: ParsedToken):
+        return PoSCapitalizationMode(token.pos, token.mode).to_embedding()
+
 
-class StructureModel(object):
+class StructureInferenceModel(object):
+    """Generates structures from the weights StructureModel exports using NumPy alone, so it can't be trained"""
     SEQUENCE_LENGTH = 16
 
+    def __init__(self):
+        # Exported (spec, weights) of each layer, and the NumPy copy of the layers for generating built from them
+        self._layers = None
+        self._inference = None
+
+    @staticmethod
+    def _from_layers(layers: List[tuple]) -> tuple:
+        (_, embedding_weights), (lstm_spec, lstm_weights), (dense_spec, dense_weights) = layers
+        return (LSTMInference(embedding_weights[0], *lstm_weights, activation=lstm_spec['activation'],
+                              recurrent_activation=lstm_spec['recurrent_activation']),
+                DenseInference(*dense_weights, activation=dense_spec['activation']))
+
+    def _inference_layers(self) -> tuple:
+        return self._inference
+
+    def train(self, data, labels, epochs=1, stream=False):
+        raise RuntimeError("The structure model can't be trained with ML_INFERENCE_ONLY set")
+
+    def predict(self, num_sentences: int) -> List[PoSCapitalizationMode]:
+        return self.predict_batch([num_sentences])[0]
+
+    def predict_batch(self, num_sentences: List[int]) -> List[List[PoSCapitalizationMode]]:
+        """Samples a structure for each number of sentences, advancing all of them one step at a time together"""
+        lstm, dense = self._inference_layers()
+        sequence_length = StructureInferenceModel.SEQUENCE_LENGTH
+        batch_size = len(num_sentences)
+
+        predictions = [[] for _ in range(0, batch_size)]
+
+        # Start each sequence with NONE / NONE
+        sequences = [[0] for _ in range(0, batch_size)]
+        # LSTM state after each whole sequence, carried forward until the sequence outgrows the window
+        h, c = lstm.step(np.zeros(batch_size, dtype=np.int64), lstm.zero_state(batch_size))
+        carried = np.ones(batch_size, dtype=bool)
+
+        eos_counts = np.zeros(batch_size, dtype=np.int64)
+        live = np.flatnonzero(eos_counts < np.array(num_sentences))
+
+        while len(live) > 0:
+            # The model was trained on windows padded with NONE / NONE after the sequence, so run the padding on from
+            # the carried state. Once items fall out of a window it has to be run from the start.
+            tails = [[0] * (sequence_length - len(sequences[row])) if carried[row] else sequences[row] for row in live]
+            steps = max([len(tail) for tail in tails])
+            starts = np.array([steps - len(tail) for tail in tails])
+            tokens = np.zeros((len(live), steps), dtype=np.int64)
+            for tail_idx, tail in enumerate(tails):
+                tokens[tail_idx, starts[tail_idx]:] = tail
+
+            # Tails are aligned to end together, rows with shorter ones hold their state until they start
+            live_carried = carried[live][:, None]
+            window_h = np.where(live_carried, h[live], 0.)
+            window_c = np.where(live_carried, c[live], 0.)
+            for step in range(0, steps):
+                step_h, step_c = lstm.step(tokens[:, step], (window_h, window_c))
+                started = (starts <= step)[:, None]
+                window_h = np.where(started, step_h, window_h)
+                window_c = np.where(started, step_c, window_c)
+
+            indices = sample_rows(dense(window_h), STRUCTURE_MODEL_TEMPERATURE).tolist()
+
+            for row, index in zip(live.tolist(), indices):
+                if PoSCapitalizationMode.from_embedding(index).pos == Pos.EOS:
+                    eos_counts[row] += 1
+
+                predictions[row].append(index)
+                sequences[row].append(index)
+                if len(sequences[row]) > sequence_length:
+                    sequences[row] = sequences[row][-sequence_length:]
+                    carried[row] = False
+
+            carry = carried[live]
+            if np.any(carry):
+                rows = live[carry]
+                h[rows], c[rows] = lstm.step(np.array(indices)[carry], (h[rows], c[rows]))
+
+            live = np.flatnonzero(eos_counts < np.array(num_sentences))
+
+        structures = []
+        for prediction in predictions:
+            modes = []
+            for embedding_idx, embedding in enumerate(prediction):
+                mode = PoSCapitalizationMode.from_embedding(embedding)
+                modes.append(mode)
+            structures.append(modes)
+        return structures
+
+    def load(self, path):
+        self._layers = import_layers(inference_path(path))
+        self._inference = StructureInferenceModel._from_layers(self._layers)
+
+    def save(self, path):
+        if self._layers is None:
+            raise RuntimeError("The structure model has no weights to save until it is loaded")
+        export_layers(inference_path(path), self._layers)
+
+
+class StructureModel(StructureInferenceModel):
+    BATCH_SIZE = 128
+
     def __init__(self, use_gpu: bool = False):
         import tensorflow as tf
         from keras.models import Sequential
@@ -104,6 +261,8 @@ class StructureModel(object):
         from keras.layers import LSTM
         from keras.backend import set_session
 
+        StructureInferenceModel.__init__(self)
+
         latent_dim = StructureModel.SEQUENCE_LENGTH * 8
 
         model = Sequential()
@@ -121,80 +280,138 @@ class StructureModel(object):
             config.gpu_options.allow_growth = True
             set_session(tf.Session(config=config))
 
-    def train(self, data, labels, epochs=1):
-        self.model.fit(data, labels, epochs=epochs, batch_size=128)
+        self._update_inference()
 
-    def predict(self, num_sentences: int) -> List[PoSCapitalizationMode]:
-        from keras.preprocessing.sequence import pad_sequences
+    def _update_inference(self):
+        # Rebuilt whenever the weights change, by whichever thread changed them. Predictions only ever use the NumPy
+        # layers, so they can be served while Keras trains.
+        self._inference = StructureInferenceModel._from_layers(keras_layers(self.model))
 
-        predictions = []
-
-        # Start the sequence with NONE / NONE
-        sequence = [[0]]
-
-        eos_count = 0
-
-        while eos_count < num_sentences:
-            padded_sequence = pad_sequences(sequence, maxlen=StructureModel.SEQUENCE_LENGTH, padding='post')
-
-            prediction = self.model.predict(padded_sequence, batch_size=1)[0]
-
-            index = temp(prediction, STRUCTURE_MODEL_TEMPERATURE)
-
-            if PoSCapitalizationMode.from_embedding(index).pos == Pos.EOS:
-                eos_count += 1
-
-            predictions.append(index)
-            sequence[0].append(index)
-            sequence[0] = sequence[0][-StructureModel.SEQUENCE_LENGTH:]
-
-        modes = []
-        for embedding_idx, embedding in enumerate(predictions):
-            mode = PoSCapitalizationMode.from_embedding(embedding)
-            modes.append(mode)
-        return modes
+    def train(self, data, labels, epochs=1, stream=False):
+        if stream:
+            # Only a block of the (memory mapped) sequences is read in at a time
+            self.model.fit_generator(array_batches(data, labels, StructureModel.BATCH_SIZE),
+                                     steps_per_epoch=-(-len(data) // StructureModel.BATCH_SIZE), epochs=epochs)
+        else:
+            self.model.fit(data, labels, epochs=epochs, batch_size=StructureModel.BATCH_SIZE)
+        self._update_inference()
 
     def load(self, path):
         self.model.load_weights(path)
+        self._update_inference()
 
     def save(self, path):
         self.model.save_weights(path)
+        # Serving only deployments load these with StructureInferenceModel
+        export_layers(inference_path(path), keras_layers(self.model))
 
 
 class StructureModelWorker(MLModelWorker):
-    def __init__(self, read_queue: Queue, write_queue: Queue, use_gpu: bool = False):
+    def __init__(self, read_queue: Queue, write_queue: Queue, use_gpu: bool = False, priority_queue: Queue = None):
         MLModelWorker.__init__(self, name='SentenceStructureModelWorker', read_queue=read_queue,
                                write_queue=write_queue,
-                               use_gpu=use_gpu)
+                               use_gpu=use_gpu, priority_queue=priority_queue)
+        # Structures sampled ahead of time while idle, keyed by the number of sentences that have been requested.
+        # Each one is handed out once.
+        self._pool = {}
 
     def run(self):
-        self._model = StructureModel(use_gpu=self._use_gpu)
+        if ML_INFERENCE_ONLY:
+            self._model = StructureInferenceModel()
+        else:
+            self._model = StructureModel(use_gpu=self._use_gpu)
         MLModelWorker.run(self)
 
+    def idle(self) -> bool:
+        # Refill one pool at a time in a single batch
+        for num_sentences, structures in self._pool.items():
+            if len(structures) < STRUCTURE_MODEL_POOL_SIZE:
+                structures.extend(self._model.predict_batch(
+                    [num_sentences] * (STRUCTURE_MODEL_POOL_SIZE - len(structures))))
+                return True
+        return False
+
     def predict(self, *data) -> List[PoSCapitalizationMode]:
-        return self._model.predict(num_sentences=data[0][0])
+        # A list of numbers of sentences is a batch
+        if isinstance(data[0][0], list):
+            return self._predict_batch(data[0][0])
+        return self._predict_batch([data[0][0]])[0]
+
+    def predict_batch(self, batch: List[tuple]) -> list:
+        # Sample the structures of every request together, then split them back up
+        requests = [data[0] if isinstance(data[0], list) else [data[0]] for data in batch]
+        structures = self._predict_batch([structure_sentences for request in requests
+                                          for structure_sentences in request])
+
+        results = []
+        offset = 0
+        for data, request in zip(batch, requests):
+            results.append(structures[offset:offset + len(request)] if isinstance(data[0], list) else structures[offset])
+            offset += len(request)
+        return results
+
+    def _predict_batch(self, num_sentences: List[int]) -> List[List[PoSCapitalizationMode]]:
+        results = [None] * len(num_sentences)
+        for result_idx, structure_sentences in enumerate(num_sentences):
+            structures = self._pool.setdefault(structure_sentences, deque())
+            if len(structures) > 0:
+                results[result_idx] = structures.popleft()
+
+        # Sample whatever the pool couldn't supply together
+        missing = [result_idx for result_idx, result in enumerate(results) if result is None]
+        if len(missing) > 0:
+            sampled = self._model.predict_batch([num_sentences[result_idx] for result_idx in missing])
+            for result_idx, structure in zip(missing, sampled):
+                results[result_idx] = structure
+        return results
 
     def train(self, *data):
-        return self._model.train(data=data[0][0], labels=data[0][1], epochs=data[0][2])
+        # Predictions keep being served from the old weights while training, but they shouldn't be pooled
+        self._pool = {}
+        path, epochs, stream = data[0]
+        if stream:
+            structure_data, structure_labels = StructurePreprocessor.read_sequences(path)
+        else:
+            _, arrays = read_array_file(path)
+            structure_data, structure_labels = arrays['data'], arrays['labels']
+        result = self._model.train(data=structure_data, labels=structure_labels, epochs=epochs, stream=stream)
+        self._pool = {}
+        return result
 
     def save(self, *data):
         return self._model.save(path=data[0][0])
 
     def load(self, *data):
-        return self._model.load(path=data[0][0])
+        # As when training, anything pooled while loading may come from the old weights
+        self._pool = {}
+        result = self._model.load(path=data[0][0])
+        self._pool = {}
+        return result
 
 
 class StructureModelScheduler(MLModelScheduler):
     def __init__(self, use_gpu: bool = False):
         MLModelScheduler.__init__(self)
         self._worker = StructureModelWorker(read_queue=self._write_queue, write_queue=self._read_queue,
-                                            use_gpu=use_gpu)
+                                            use_gpu=use_gpu, priority_queue=self._priority_queue)
 
     def predict(self, num_sentences: int):
         return self._predict(num_sentences)
 
+    def predict_async(self, num_sentences: int) -> Future:
+        return self._predict_async(num_sentences)
+
+    def predict_batch(self, num_sentences: List[int]):
+        return self._predict(list(num_sentences))
+
     def train(self, data, labels, epochs=1):
-        return self._train(data, labels, epochs)
+        # The worker maps the arrays from shared memory instead of them being pickled through the queue
+        with SharedArrays({'data': data, 'labels': labels}) as path:
+            return self._train(path, epochs, False)
+
+    def train_stream(self, path: str, epochs=1):
+        # Trains from a sequence file written by StructurePreprocessor, which the worker streams from disk
+        return self._train(path, epochs, True)
 
     def save(self, path):
         return self._save(path)
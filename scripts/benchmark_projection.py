@@ -0,0 +1,120 @@
+import argparse
+import time
+
+import numpy as np
+
+from common.nlp import Pos
+from config.ml import MARKOV_WINDOW_SIZE, MARKOV_GENERATION_WEIGHT_COUNT, MARKOV_GENERATION_WEIGHT_RATING
+from markov_engine import MarkovWord, MarkovNeighbor, MarkovProjectionCache, MarkovWordProjection, NeighborValueIdx, \
+    MarkovCSRDb
+
+
+def legacy_project(word: MarkovWord, idx_in_sentence: int, sentence_length: int, pos: Pos) -> MarkovWordProjection:
+    # MarkovWord.project before it was vectorized, kept as the baseline
+    neighbors = word.select_neighbors(pos)
+
+    neighbor_keys = []
+    neighbor_pos = []
+
+    distance_distributions = np.zeros((len(neighbors), sentence_length))
+    neighbor_magnitudes = np.zeros((len(neighbors), 1))
+
+    for neighbor_idx, neighbor in enumerate(neighbors):
+        neighbor_keys.append(neighbor.text)
+        neighbor_pos.append(neighbor.pos)
+
+        for dist_idx, dist_value in enumerate(neighbor.dist):
+            dist_space_index = (dist_idx - MARKOV_WINDOW_SIZE) + idx_in_sentence
+            if not (dist_space_index >= 0 and dist_space_index < sentence_length):
+                continue
+            distance_distributions[neighbor_idx][dist_space_index] = dist_value
+
+        neighbor_magnitudes[neighbor_idx] = neighbor.values[NeighborValueIdx.COUNT.value] * \
+                                            MARKOV_GENERATION_WEIGHT_COUNT + \
+                                            neighbor.values[NeighborValueIdx.RATING.value] * \
+                                            MARKOV_GENERATION_WEIGHT_RATING
+
+    return MarkovWordProjection(neighbor_magnitudes, distance_distributions, neighbor_keys, neighbor_pos)
+
+
+def hub_word(degree: int) -> MarkovWord:
+    choices = [Pos.NOUN, Pos.VERB, Pos.ADJ, Pos.ADV, Pos.PROPN]
+    neighbors = {}
+    for neighbor_idx in range(0, degree):
+        neighbor = MarkovNeighbor('word%d' % neighbor_idx, 'Word%d' % neighbor_idx,
+                                  choices[neighbor_idx % len(choices)], False,
+                                  [int(np.random.randint(1, 100)), 0],
+                                  np.random.randint(0, 10, MARKOV_WINDOW_SIZE * 2 + 1).tolist())
+        key, row = neighbor.to_db_format()
+        neighbors[key] = row
+    return MarkovWord('the', Pos.DET, False, neighbors)
+
+
+def benchmark(f, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(0, repeat):
+        f()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    idx_in_sentence, sentence_length, pos = 3, 12, Pos.NOUN
+
+    print("%8s %12s %12s %12s %12s %12s %12s %9s %9s %9s %9s %9s" % (
+        'degree', 'legacy (ms)', 'cold (ms)', 'build (ms)', 'cached (ms)', 'csr (ms)', 'learned (ms)', 'cold', 'build',
+        'cached', 'csr', 'learned'))
+    for degree in [100, 1000, 10000, 50000]:
+        word = hub_word(degree)
+
+        legacy = legacy_project(word, idx_in_sentence, sentence_length, pos)
+        for projection in [word.project(idx_in_sentence, sentence_length, pos),
+                           word.neighbor_matrix().project(idx_in_sentence, sentence_length, pos)]:
+            assert legacy.keys == projection.keys
+            assert np.array_equal(legacy.distances, projection.distances)
+            assert np.array_equal(legacy.magnitudes, projection.magnitudes)
+
+        def cold_project():
+            # The first projection of a word, which doesn't build its matrix
+            cold_word = MarkovWord(word.text, word.pos, word.compound, word.neighbors,
+                                   projections=MarkovProjectionCache(1))
+            return cold_word.project(idx_in_sentence, sentence_length, pos)
+
+        # Its second projection misses again, and builds the matrix
+        cache = MarkovProjectionCache(1)
+        cached_word = MarkovWord(word.text, word.pos, word.compound, word.neighbors, projections=cache)
+        cached_word.project(idx_in_sentence, sentence_length, pos)
+        cached_word.project(idx_in_sentence, sentence_length, pos)
+
+        csr_db = MarkovCSRDb()
+        csr_db.insert(word)
+        csr_db.compact()
+        csr_word = csr_db.select(word.text)
+
+        # Learning a neighbor between projections, which is written through to the cached matrix
+        learned = MarkovNeighbor.from_db_format(*next(iter(word.neighbors.items())))
+
+        def learn_and_project():
+            learned.values[NeighborValueIdx.COUNT.value] += 1
+            cached_word.set_neighbor(learned)
+            return cached_word.project(idx_in_sentence, sentence_length, pos)
+
+        legacy_time = benchmark(lambda: legacy_project(word, idx_in_sentence, sentence_length, pos), args.repeat)
+        cold_time = benchmark(cold_project, args.repeat)
+        build_time = benchmark(lambda: word.neighbor_matrix().project(idx_in_sentence, sentence_length, pos),
+                               args.repeat)
+        cached_time = benchmark(lambda: cached_word.project(idx_in_sentence, sentence_length, pos), args.repeat)
+        csr_time = benchmark(lambda: csr_word.project(idx_in_sentence, sentence_length, pos), args.repeat)
+        learned_time = benchmark(learn_and_project, args.repeat)
+
+        print("%8d %12.3f %12.3f %12.3f %12.3f %12.3f %12.3f %8.1fx %8.1fx %8.1fx %8.1fx %8.1fx" % (
+            degree, legacy_time * 1000, cold_time * 1000, build_time * 1000, cached_time * 1000, csr_time * 1000,
+            learned_time * 1000, legacy_time / cold_time, legacy_time / build_time, legacy_time / cached_time,
+            legacy_time / csr_time, legacy_time / learned_time))
+
+
+if __name__ == '__main__':
+    main()
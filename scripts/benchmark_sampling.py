@@ -0,0 +1,49 @@
+import argparse
+import time
+
+import numpy as np
+
+from common.ml import temp
+from common.sampling import CumulativeSampler, sample
+
+
+def benchmark(f, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(0, repeat):
+        f()
+    return (time.perf_counter() - start) / repeat
+
+
+def frequencies(f, size: int, draws: int) -> np.ndarray:
+    return np.bincount([f() for _ in range(0, draws)], minlength=size) / draws
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=1000)
+    parser.add_argument('--temperature', type=float, default=0.7)
+    args = parser.parse_args()
+
+    # All three draw from the same distribution
+    p = np.random.dirichlet(np.ones(8))
+    expected = frequencies(lambda: temp(p, args.temperature), len(p), 20000)
+    assert np.allclose(frequencies(lambda: sample(p, args.temperature), len(p), 20000), expected, atol=0.02)
+    sampler = CumulativeSampler(p, args.temperature)
+    assert np.allclose(frequencies(sampler.sample, len(p), 20000), expected, atol=0.02)
+
+    print("%8s %12s %12s %12s %9s %9s" % ('size', 'temp (us)', 'sample (us)', 'cached (us)', 'sample', 'cached'))
+    for size in [10, 100, 1000, 10000, 50000]:
+        p = np.random.dirichlet(np.ones(size))
+        sampler = CumulativeSampler(p, args.temperature)
+
+        temp_time = benchmark(lambda: temp(p, args.temperature), args.repeat)
+        sample_time = benchmark(lambda: sample(p, args.temperature), args.repeat)
+        cached_time = benchmark(sampler.sample, args.repeat)
+
+        print("%8d %12.1f %12.1f %12.1f %8.1fx %8.1fx" % (
+            size, temp_time * 1e6, sample_time * 1e6, cached_time * 1e6, temp_time / sample_time,
+            temp_time / cached_time))
+
+
+if __name__ == '__main__':
+    main()
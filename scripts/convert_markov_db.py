@@ -0,0 +1,24 @@
+import argparse
+
+from markov_engine import MarkovTrieDb, MarkovCSRDb
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('trie_path', help='Path of the existing trie model, e.g. weights/markov.json.zlib')
+    parser.add_argument('csr_path', help='Path to write the csr model to, e.g. weights/markov.bin')
+    args = parser.parse_args()
+
+    print("Loading trie model")
+    trie_db = MarkovTrieDb(args.trie_path)
+
+    print("Converting")
+    csr_db = MarkovCSRDb.from_trie_db(trie_db)
+
+    print("Saving csr model")
+    csr_db.save(args.csr_path)
+
+
+if __name__ == '__main__':
+    main()
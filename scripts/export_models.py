@@ -0,0 +1,31 @@
+import argparse
+
+from config.ml import STRUCTURE_MODEL_PATH, REACTION_MODEL_PATH
+from models.inference import inference_path
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--structure-path', default=STRUCTURE_MODEL_PATH, help='Keras weights of the structure model')
+    parser.add_argument('--reaction-path', default=None, help='Keras weights of the reaction model, e.g. %s' %
+                                                              REACTION_MODEL_PATH)
+    args = parser.parse_args()
+
+    # Saving the Keras models exports their weights for serving without TensorFlow / Keras
+    from models.structure import StructureModel
+    print("Exporting structure model to %s" % inference_path(args.structure_path))
+    structure_model = StructureModel()
+    structure_model.load(args.structure_path)
+    structure_model.save(args.structure_path)
+
+    if args.reaction_path is not None:
+        from models.reaction import AOLReactionModel
+        print("Exporting reaction model to %s" % inference_path(args.reaction_path))
+        reaction_model = AOLReactionModel()
+        reaction_model.load(args.reaction_path)
+        reaction_model.save(args.reaction_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 import time
 
 import numpy as np
-from markov_engine import MarkovTrieDb, MarkovGenerator, MarkovFilters
+from markov_engine import MarkovGenerator, MarkovFilters, create_markov_db
 from config.ml import MARKOV_DB_PATH, STRUCTURE_MODEL_PATH, USE_GPU
 from models.structure import StructureModelScheduler
 from common.nlp import CapitalizationMode
@@ -10,7 +10,7 @@ from common.nlp import CapitalizationMode
 def main():
     np.random.seed(int(time.time()))
 
-    markov_db = MarkovTrieDb(MARKOV_DB_PATH)
+    markov_db = create_markov_db(MARKOV_DB_PATH)
 
     structure_model = StructureModelScheduler(use_gpu=USE_GPU)
     structure_model.start()
@@ -24,13 +24,16 @@ def main():
         else:
             print("Couldn't select %s" % word)
 
-    for i in range(0, 1000):
+    def structure_generator():
+        # Structures are sampled in batches, which costs about as much as sampling one
+        while True:
+            for structure in structure_model.predict_batch([1] * 64):
+                yield structure
 
-        def structure_generator():
-            while True:
-                yield structure_model.predict(num_sentences=1)
+    structures = structure_generator()
+    for i in range(0, 1000):
 
-        markov_generator = MarkovGenerator(structure_generator(), subjects)
+        markov_generator = MarkovGenerator(structures, subjects)
 
         words = []
         sentences = markov_generator.generate(markov_db)
@@ -0,0 +1,33 @@
+import argparse
+
+from config.ml import MARKOV_PRUNE_MAX_NEIGHBORS, MARKOV_PRUNE_DECAY
+from markov_engine import create_markov_db
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='Path of the markov model, e.g. weights/markov.json.zlib')
+    parser.add_argument('--out', help='Path to write the pruned model to, defaults to replacing the model')
+    parser.add_argument('--max-neighbors', type=int, default=MARKOV_PRUNE_MAX_NEIGHBORS,
+                        help='Number of word / neighbor pairs to keep')
+    parser.add_argument('--decay', type=float, default=MARKOV_PRUNE_DECAY,
+                        help='Multiply every count by this before pruning')
+    args = parser.parse_args()
+
+    if args.max_neighbors <= 0:
+        parser.error('--max-neighbors must be set here or with MARKOV_PRUNE_MAX_NEIGHBORS')
+
+    print("Loading model")
+    db = create_markov_db(args.path)
+
+    print("Pruning %d word / neighbor pairs" % db.neighbor_count())
+    removed = db.prune(args.max_neighbors, args.decay)
+    print("Removed %d, %d remain" % (removed, db.neighbor_count()))
+
+    print("Saving model")
+    db.save(args.out if args.out is not None else args.path)
+
+
+if __name__ == '__main__':
+    main()
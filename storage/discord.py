@@ -38,10 +38,10 @@ Session = scoped_session(session_factory)
 
 class DiscordTrainingDataManager(TrainingDataManager):
     def __init__(self):
-        TrainingDataManager.__init__(self, DiscordMessage)
+        TrainingDataManager.__init__(self, DiscordMessage, DISCORD_TRAINING_DB_PATH)
         self._session = Session()
 
-    def store(self, data: Message):
+    def store(self, data: Message, trained: bool = False):
         message = data
 
         filtered_content = DiscordHelper.filter_content(message)
@@ -50,6 +50,6 @@ class DiscordTrainingDataManager(TrainingDataManager):
 
         message = DiscordMessage(server_id=server_id, channel_id=int(message.channel.id),
                                  user_id=int(message.author.id), timestamp=message.timestamp,
-                                 text=filtered_content.encode())
+                                 trained=int(trained), text=filtered_content.encode())
         self._session.add(message)
         self._session.commit()
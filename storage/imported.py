@@ -27,7 +27,7 @@ Session = scoped_session(session_factory)
 
 class ImportTrainingDataManager(TrainingDataManager):
     def __init__(self):
-        TrainingDataManager.__init__(self, ImportedMessage)
+        TrainingDataManager.__init__(self, ImportedMessage, IMPORT_TRAINING_DB_PATH)
         self._session = Session()
 
     def store(self, data: str):
@@ -0,0 +1,191 @@
+import mmap
+import os
+import struct
+import zlib
+from collections import deque
+from typing import Optional, Iterable, Iterator, Tuple, Callable, Union
+
+import numpy as np
+
+from common.nlp import ParsedDoc
+
+
+class ParseCache(object):
+    """
+    Append-only file of the ParsedDoc of each training row, keyed by row id and a hash of the row's text, so rows
+    which have been parsed before never go through spaCy again. Records for a row whose text changed are superseded
+    by the latest one. The whole file is discarded when the parser signature changes.
+    """
+    # Magic, parser signature hash
+    FILE_HEADER = struct.Struct('<4sI')
+    # Row id, text hash, payload length, payload CRC32
+    RECORD_HEADER = struct.Struct('<qIII')
+    MAGIC = b'APC2'
+    # Where to find the payload of a record
+    RECORD_DTYPE = np.dtype([('id', '<i8'), ('hash', '<u4'), ('offset', '<i8'), ('length', '<u4')])
+    # Records appended before they are merged into the index
+    MERGE_SIZE = 4096
+
+    def __init__(self, path: str, signature: str):
+        self.path = path
+        self._signature = zlib.crc32(signature.encode())
+        self._file = None
+
+        # Sorted row ids of the latest record of each row, and where to find them. 24 bytes per row.
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._hashes = np.zeros(0, dtype=np.uint32)
+        self._offsets = np.zeros(0, dtype=np.int64)
+        self._lengths = np.zeros(0, dtype=np.uint32)
+
+        # Records appended since they were last merged into the above: id -> (text hash, offset, length)
+        self._appended = {}
+
+        self._open()
+
+    @staticmethod
+    def text_hash(text: bytes) -> int:
+        return zlib.crc32(text)
+
+    def _open(self):
+        try:
+            self._file = open(self.path, 'r+b')
+        except FileNotFoundError:
+            self._file = open(self.path, 'w+b')
+
+        header = self._file.read(ParseCache.FILE_HEADER.size)
+        if len(header) < ParseCache.FILE_HEADER.size or \
+                ParseCache.FILE_HEADER.unpack(header) != (ParseCache.MAGIC, self._signature):
+            self.clear()
+            return
+
+        size = os.fstat(self._file.fileno()).st_size
+        records = np.zeros(ParseCache.MERGE_SIZE, dtype=ParseCache.RECORD_DTYPE)
+        count = 0
+        offset = ParseCache.FILE_HEADER.size
+        with mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ) as data:
+            while offset + ParseCache.RECORD_HEADER.size <= size:
+                row_id, text_hash, length, _ = ParseCache.RECORD_HEADER.unpack_from(data, offset)
+                if offset + ParseCache.RECORD_HEADER.size + length > size:
+                    break
+                if count == len(records):
+                    records = np.concatenate((records, np.zeros(len(records), dtype=ParseCache.RECORD_DTYPE)))
+                records[count] = (row_id, text_hash, offset + ParseCache.RECORD_HEADER.size, length)
+                count += 1
+                offset += ParseCache.RECORD_HEADER.size + length
+
+        # Drop a record torn by a crash in the middle of a write
+        self._file.truncate(offset)
+
+        # Keep only the latest record of each row
+        ids = records['id'][:count]
+        records = records[count - 1 - np.unique(ids[::-1], return_index=True)[1]]
+        self._ids = records['id'].copy()
+        self._hashes = records['hash'].copy()
+        self._offsets = records['offset'].copy()
+        self._lengths = records['length'].copy()
+
+    def _merge(self):
+        if len(self._appended) == 0:
+            return
+
+        appended = np.array(sorted((row_id,) + location for row_id, location in self._appended.items()),
+                            dtype=ParseCache.RECORD_DTYPE)
+        positions = np.searchsorted(self._ids, appended['id'])
+        found = np.zeros(len(appended), dtype=bool)
+        in_range = positions < len(self._ids)
+        found[in_range] = self._ids[positions[in_range]] == appended['id'][in_range]
+
+        # Rows already in the index are updated in place, the rest are inserted in order
+        replaced = positions[found]
+        self._hashes[replaced] = appended['hash'][found]
+        self._offsets[replaced] = appended['offset'][found]
+        self._lengths[replaced] = appended['length'][found]
+
+        inserted = appended[~found]
+        positions = positions[~found]
+        self._ids = np.insert(self._ids, positions, inserted['id'])
+        self._hashes = np.insert(self._hashes, positions, inserted['hash'])
+        self._offsets = np.insert(self._offsets, positions, inserted['offset'])
+        self._lengths = np.insert(self._lengths, positions, inserted['length'])
+        self._appended = {}
+
+    def _locate(self, row_id: int) -> Optional[tuple]:
+        if row_id in self._appended:
+            return self._appended[row_id]
+        idx = int(np.searchsorted(self._ids, row_id))
+        if idx < len(self._ids) and self._ids[idx] == row_id:
+            return int(self._hashes[idx]), int(self._offsets[idx]), int(self._lengths[idx])
+        return None
+
+    def get_bytes(self, row_id: int, text: bytes) -> Optional[bytes]:
+        location = self._locate(row_id)
+        if location is None or location[0] != ParseCache.text_hash(text):
+            return None
+
+        _, offset, length = location
+        self._file.seek(offset - ParseCache.RECORD_HEADER.size)
+        record = self._file.read(ParseCache.RECORD_HEADER.size + length)
+        payload = record[ParseCache.RECORD_HEADER.size:]
+        if len(payload) < length or zlib.crc32(payload) != ParseCache.RECORD_HEADER.unpack_from(record, 0)[3]:
+            return None
+        return payload
+
+    def get(self, row_id: int, text: bytes) -> Optional[ParsedDoc]:
+        payload = self.get_bytes(row_id, text)
+        return ParsedDoc.from_bytes(payload) if payload is not None else None
+
+    def put_bytes(self, row_id: int, text: bytes, payload: bytes):
+        text_hash = ParseCache.text_hash(text)
+        self._file.seek(0, os.SEEK_END)
+        offset = self._file.tell() + ParseCache.RECORD_HEADER.size
+        self._file.write(ParseCache.RECORD_HEADER.pack(row_id, text_hash, len(payload), zlib.crc32(payload)) + payload)
+
+        self._appended[row_id] = (text_hash, offset, len(payload))
+        if len(self._appended) >= ParseCache.MERGE_SIZE:
+            self._merge()
+
+    def put(self, row_id: int, text: bytes, doc: ParsedDoc):
+        self.put_bytes(row_id, text, doc.to_bytes())
+
+    def parse(self, rows: Iterable[Tuple[bytes, int]],
+              parse: Callable[[Iterable[Union[bytes, ParsedDoc]]], Iterator[ParsedDoc]]) -> Iterator[ParsedDoc]:
+        """
+        Yields the ParsedDoc of each (text, id) row in order. parse is given the cached ParsedDoc of each row which
+        has one and the text of each row which doesn't, and must yield a ParsedDoc for every item in the same order.
+        """
+        pending = deque()
+
+        def items():
+            for text, row_id in rows:
+                doc = self.get(row_id, text)
+                pending.append((row_id, text, doc is None))
+                yield doc if doc is not None else text
+
+        try:
+            for doc in parse(items()):
+                row_id, text, missed = pending.popleft()
+                if missed:
+                    self.put(row_id, text, doc)
+                yield doc
+        finally:
+            self.flush()
+
+    def flush(self):
+        self._file.flush()
+        self._merge()
+
+    def clear(self):
+        self._file.seek(0)
+        self._file.truncate(0)
+        self._file.write(ParseCache.FILE_HEADER.pack(ParseCache.MAGIC, self._signature))
+        self._file.flush()
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._hashes = np.zeros(0, dtype=np.uint32)
+        self._offsets = np.zeros(0, dtype=np.int64)
+        self._lengths = np.zeros(0, dtype=np.uint32)
+        self._appended = {}
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -1,24 +1,51 @@
-from typing import List, Tuple
+from typing import Tuple, Iterator
 from sqlalchemy import desc, asc
+from sqlalchemy.orm import Query
+
+from config.armchair_expert import TRAINING_DATA_BATCH_SIZE
+
+
+class TrainingData(object):
+    """Rows of a training data query, fetched from the DB in batches as they are iterated rather than all at once"""
+
+    def __init__(self, query: Query, batch_size: int = TRAINING_DATA_BATCH_SIZE):
+        self._query = query
+        self._batch_size = batch_size
+        self._count = None
+
+    def __len__(self):
+        if self._count is None:
+            self._count = self._query.count()
+        return self._count
+
+    def __iter__(self) -> Iterator[Tuple[bytes, int]]:
+        return iter(self._query.yield_per(self._batch_size))
 
 
 class TrainingDataManager(object):
-    def __init__(self, table_type):
+    def __init__(self, table_type, db_path: str = None):
         self._table_type = table_type
+        self._db_path = db_path
         self._session = None
 
-    def new_training_data(self) -> List[Tuple[bytes]]:
-        return self._session.query(self._table_type.text).filter(self._table_type.trained == 0).all()
+    @property
+    def parse_cache_path(self) -> str:
+        # Parses of the training rows are cached next to the DB, see storage.parse_cache
+        return self._db_path + '.parses'
+
+    def new_training_data(self) -> TrainingData:
+        return TrainingData(self._session.query(self._table_type.text, self._table_type.id).filter(
+            self._table_type.trained == 0))
 
-    def all_training_data(self, limit: int = None, order_by: str = None, order='desc') -> List[Tuple[bytes]]:
-        query = self._session.query(self._table_type.text)
+    def all_training_data(self, limit: int = None, order_by: str = None, order='desc') -> TrainingData:
+        query = self._session.query(self._table_type.text, self._table_type.id)
         if order_by and order == 'desc':
             query = query.order_by(desc(order_by))
         elif order_by and order == 'asc':
             query = query.order_by(asc(order_by))
         if limit:
             query = query.limit(limit)
-        return query.all()
+        return TrainingData(query)
 
     def mark_trained(self):
         self._session.execute('UPDATE ' + self._table_type.__tablename__ + ' SET TRAINED = 1')
@@ -47,17 +47,17 @@ Session = scoped_session(session_factory)
 
 class TwitterTrainingDataManager(TrainingDataManager):
     def __init__(self):
-        TrainingDataManager.__init__(self, Tweet)
+        TrainingDataManager.__init__(self, Tweet, TWITTER_TRAINING_DB_PATH)
         self._session = Session()
 
-    def store(self, data: Status):
+    def store(self, data: Status, trained: bool = False):
         status = data
 
         tweet = self._session.query(Tweet).filter(Tweet.status_id == status.id).first()
         if tweet is None:
             tweet = Tweet(status_id=status.id, user_id=status.user.id, in_reply_to_user_id=status.in_reply_to_user_id,
                           in_reply_to_status_id=status.in_reply_to_status_id, retweeted=int(status.retweeted),
-                          timestamp=status.created_at, text=status.text.encode())
+                          timestamp=status.created_at, trained=int(trained), text=status.text.encode())
             self._session.add(tweet)
             self._session.commit()
 
@@ -0,0 +1,35 @@
+import unittest
+
+import numpy as np
+
+from common.ml import array_batches
+
+
+class TestArrayBatches(unittest.TestCase):
+    def test_epochs(self):
+        np.random.seed(0)
+        data = np.arange(0, 23 * 2).reshape((23, 2))
+        labels = data[:, 0] * 10
+        batches = array_batches(data, labels, batch_size=4, block_size=2)
+
+        for _ in range(0, 2):
+            # Blocks of 8 rows, the last one short, so an epoch is 6 batches with a partial one last in its block
+            epoch = [next(batches) for _ in range(0, 6)]
+            self.assertEqual(sorted([len(batch_labels) for _, batch_labels in epoch]), [3, 4, 4, 4, 4, 4])
+
+            rows = np.concatenate([batch_data for batch_data, _ in epoch])
+            self.assertEqual(sorted(rows[:, 0].tolist()), data[:, 0].tolist())
+            for batch_data, batch_labels in epoch:
+                self.assertTrue(np.array_equal(batch_labels, batch_data[:, 0] * 10))
+                # Every batch comes from a single block
+                self.assertEqual(len(set((batch_data[:, 0] // 16).tolist())), 1)
+
+    def test_small(self):
+        # Fewer rows than a batch still make a batch
+        data = np.arange(0, 3).reshape((3, 1))
+        batch_data, batch_labels = next(array_batches(data, data[:, 0], batch_size=4))
+        self.assertEqual(sorted(batch_labels.tolist()), [0, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from common.nlp import create_nlp_instance, Pos
+from markov_engine import MarkovTrieDb, MarkovCSRDb, MarkovTrainer
+
+
+class TestMarkovCSRDb(unittest.TestCase):
+    TEXT = ["The quick brown fox jumps over the lazy dog.",
+            "The dog sleeps. The fox runs away quickly!",
+            "I like my dog and my dog likes me."]
+
+    @classmethod
+    def setUpClass(cls):
+        nlp = create_nlp_instance()
+        cls.docs = [nlp(text) for text in TestMarkovCSRDb.TEXT]
+
+    def _train(self, db):
+        for doc in self.docs:
+            MarkovTrainer(db).learn(doc)
+        return db
+
+    def assertSameWords(self, trie_db: MarkovTrieDb, csr_db: MarkovCSRDb):
+        for trie_word in trie_db.words():
+            csr_word = csr_db.select(trie_word.text)
+            self.assertIsNotNone(csr_word)
+            self.assertEqual(csr_word.pos, trie_word.pos)
+            self.assertEqual(csr_word.compound, trie_word.compound)
+
+            # Neighbor text comes from the interned vocabulary, so only compare the remaining fields
+            self.assertEqual({key: row[1:] for key, row in csr_word.neighbors.items()},
+                             {key: row[1:] for key, row in trie_word.neighbors.items()})
+
+            for pos in [None, Pos.NOUN]:
+                self.assertEqual(sorted((neighbor.key, neighbor.values, neighbor.dist)
+                                        for neighbor in csr_word.select_neighbors(pos)),
+                                 sorted((neighbor.key, neighbor.values, neighbor.dist)
+                                        for neighbor in trie_word.select_neighbors(pos)))
+
+                trie_projection = trie_word.project(2, 6, pos)
+                csr_projection = csr_word.project(2, 6, pos)
+                trie_order = np.argsort([key.lower() for key in trie_projection.keys])
+                csr_order = np.argsort([key.lower() for key in csr_projection.keys])
+                self.assertTrue(np.array_equal(trie_projection.distances[trie_order],
+                                               csr_projection.distances[csr_order]))
+                self.assertTrue(np.array_equal(trie_projection.magnitudes[trie_order],
+                                               csr_projection.magnitudes[csr_order]))
+
+    def test_learn(self):
+        # Force compactions in the middle of learning
+        compact_threshold = MarkovCSRDb.COMPACT_THRESHOLD
+        MarkovCSRDb.COMPACT_THRESHOLD = 2
+        try:
+            self.assertSameWords(self._train(MarkovTrieDb()), self._train(MarkovCSRDb()))
+        finally:
+            MarkovCSRDb.COMPACT_THRESHOLD = compact_threshold
+
+    def test_from_trie_db(self):
+        trie_db = self._train(MarkovTrieDb())
+        self.assertSameWords(trie_db, MarkovCSRDb.from_trie_db(trie_db))
+
+    def test_save_load(self):
+        trie_db = self._train(MarkovTrieDb())
+        csr_db = self._train(MarkovCSRDb())
+
+        fd, path = tempfile.mkstemp(suffix=".bin")
+        os.close(fd)
+        try:
+            csr_db.save(path)
+            self.assertSameWords(trie_db, MarkovCSRDb(path))
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
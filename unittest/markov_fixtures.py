@@ -0,0 +1,24 @@
+from common.nlp import Pos, CapitalizationMode, ParsedToken, ParsedDoc
+from markov_engine import MarkovDb, MarkovTrainer
+
+DOCS = [ParsedDoc([[ParsedToken('Hello', Pos.INTJ, CapitalizationMode.UPPER_FIRST),
+                    ParsedToken('world', Pos.NOUN, CapitalizationMode.LOWER_ALL)]]),
+        ParsedDoc([[ParsedToken('hello', Pos.INTJ, CapitalizationMode.LOWER_ALL),
+                    ParsedToken('big', Pos.ADJ, CapitalizationMode.LOWER_ALL),
+                    ParsedToken('world', Pos.NOUN, CapitalizationMode.LOWER_ALL)]]),
+        ParsedDoc([[ParsedToken('I', Pos.PRON, CapitalizationMode.UPPER_ALL),
+                    ParsedToken('like', Pos.VERB, CapitalizationMode.LOWER_ALL),
+                    ParsedToken('🐍', Pos.EMOJI, CapitalizationMode.COMPOUND)],
+                   [ParsedToken('Bye', Pos.INTJ, CapitalizationMode.UPPER_FIRST),
+                    ParsedToken('world', Pos.NOUN, CapitalizationMode.LOWER_ALL)]])]
+
+
+def learn(db: MarkovDb, docs: list) -> MarkovDb:
+    trainer = MarkovTrainer(db)
+    for doc in docs:
+        trainer.learn(doc)
+    return db
+
+
+def dump(db: MarkovDb) -> list:
+    return sorted((word.text, word.pos, word.compound, sorted(word.neighbors.items())) for word in db.words())
@@ -0,0 +1,54 @@
+import unittest
+
+from common.nlp import Pos, CapitalizationMode
+from markov_engine import MarkovTrieDb, MarkovCSRDb, MarkovGenerator, MarkovGenerationView
+from markov_fixtures import DOCS, learn
+from models.structure import PoSCapitalizationMode
+
+
+class TestMarkovGeneration(unittest.TestCase):
+    def _sampler(self, structure: list):
+        self.requests = []
+
+        def sample_structures(count: int) -> list:
+            self.requests.append(count)
+            return [[PoSCapitalizationMode(pos, mode) for pos, mode in structure]] * count
+        return sample_structures
+
+    def test_generate_candidates(self):
+        structure = [(Pos.INTJ, CapitalizationMode.UPPER_FIRST), (Pos.NOUN, CapitalizationMode.LOWER_ALL),
+                     (Pos.EOS, CapitalizationMode.NONE)]
+        for engine in [MarkovTrieDb, MarkovCSRDb]:
+            db = learn(engine(), DOCS)
+            sentences = MarkovGenerator.generate_candidates(self._sampler(structure), [db.select('world')], db,
+                                                            candidates=3)
+
+            # Every candidate's structures are sampled in one request
+            self.assertEqual(self.requests, [3 * -(-MarkovGenerator.STRUCTURE_ATTEMPTS // 3)])
+            self.assertEqual(len(sentences), 1)
+            self.assertIn(sentences[0][0].text.lower(), ['hello', 'bye'])
+            self.assertEqual(sentences[0][0].mode, CapitalizationMode.UPPER_FIRST)
+            self.assertEqual(sentences[0][1].text, 'world')
+
+    def test_no_structure(self):
+        # None of the structures fit the subjects
+        structure = [(Pos.EMOJI, CapitalizationMode.COMPOUND), (Pos.EOS, CapitalizationMode.NONE)]
+        db = learn(MarkovTrieDb(), DOCS)
+        self.assertIsNone(MarkovGenerator.generate_candidates(self._sampler(structure), [db.select('world')], db))
+        self.assertEqual(len(self.requests), 1)
+
+    def test_view(self):
+        db = learn(MarkovCSRDb(), DOCS)
+        view = MarkovGenerationView(db)
+
+        # Words are selected once, and their matrices are built once for the DB and the view
+        word = view.select('World')
+        self.assertIs(view.select('world'), word)
+        self.assertIsNone(view.select('missing'))
+        matrix = word.neighbor_matrix()
+        self.assertIs(db.select('world').neighbor_matrix(), matrix)
+        self.assertIs(MarkovGenerationView(db).select('world').neighbor_matrix(), matrix)
+
+
+if __name__ == '__main__':
+    unittest.main()
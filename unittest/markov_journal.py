@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from markov_engine import MarkovTrieDb, MarkovTrainer, MarkovJournal
+from markov_fixtures import DOCS, learn, dump
+
+
+class TestMarkovJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'markov.json.zlib')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_encode_decode(self):
+        for doc in DOCS:
+            decoded = MarkovJournal.decode(MarkovJournal.encode(doc))
+            self.assertEqual([[(token.text, token.pos, token.mode) for token in sentence] for sentence in decoded.sents],
+                             [[(token.text, token.pos, token.mode) for token in sentence] for sentence in doc.sents])
+
+    def test_replay(self):
+        expected = learn(MarkovTrieDb(), DOCS)
+
+        db = learn(MarkovTrieDb(), DOCS[:1])
+        db.save(self.path)
+        db.open_journal(self.path)
+        for doc in DOCS[1:]:
+            MarkovTrainer(db, journal=True).learn(doc)
+
+        # Simulate a crash in the middle of appending another record
+        with open(self.path + '.journal', 'ab') as f:
+            f.write(MarkovJournal.RECORD_HEADER.pack(100, 0) + b'torn')
+
+        self.assertEqual(dump(MarkovTrieDb(self.path)), dump(expected))
+
+    def test_compacted_journal_ignored(self):
+        db = MarkovTrieDb()
+        db.save(self.path)
+        db.open_journal(self.path)
+        MarkovTrainer(db, journal=True).learn(DOCS[0])
+        journal = open(self.path + '.journal', 'rb').read()
+
+        # A crash after writing a new snapshot but before resetting the journal must not learn the docs twice
+        db.save(self.path)
+        open(self.path + '.journal', 'wb').write(journal)
+
+        self.assertEqual(dump(MarkovTrieDb(self.path)), dump(db))
+
+    def test_empty_record(self):
+        db = MarkovTrieDb()
+        db.save(self.path)
+        db.open_journal(self.path)
+        MarkovTrainer(db, journal=True).learn(DOCS[0])
+
+        # An empty record passes its CRC check, but is still the start of a torn write
+        with open(self.path + '.journal', 'ab') as f:
+            f.write(MarkovJournal.RECORD_HEADER.pack(0, 0) + b'torn')
+        db.close_journal()
+
+        expected = learn(MarkovTrieDb(), DOCS)
+        db = MarkovTrieDb(self.path)
+        db.open_journal(self.path)
+        for doc in DOCS[1:]:
+            MarkovTrainer(db, journal=True).learn(doc)
+        db.close_journal()
+        self.assertEqual(dump(MarkovTrieDb(self.path)), dump(expected))
+
+    def test_shared_loads(self):
+        db = learn(MarkovTrieDb(), DOCS[:1])
+        db.save(self.path)
+        db.open_journal(self.path)
+        MarkovTrainer(db, journal=True).learn(DOCS[1])
+        journal = open(self.path + '.journal', 'rb').read()
+
+        # Other processes load the journaled docs without touching the journal, but can't open it for writing
+        reader = MarkovTrieDb(self.path)
+        self.assertEqual(dump(reader), dump(db))
+        self.assertRaises(RuntimeError, reader.open_journal, self.path)
+        self.assertEqual(open(self.path + '.journal', 'rb').read(), journal)
+
+        # Once it is closed, the next process to open it catches up on whatever was journaled after it loaded
+        MarkovTrainer(db, journal=True).learn(DOCS[2])
+        db.close_journal()
+        reader.open_journal(self.path)
+        self.assertEqual(dump(reader), dump(db))
+        reader.close_journal()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import pickle
+import unittest
+
+from markov_engine import MarkovTrieDb, MarkovCSRDb, MarkovBulkTrainer, MarkovNgramCounter
+from markov_fixtures import DOCS, learn, dump
+
+
+class TestMarkovMerge(unittest.TestCase):
+    def test_merge(self):
+        for engine in [MarkovTrieDb, MarkovCSRDb]:
+            expected = learn(engine(), DOCS)
+
+            # Learn the docs in shards and merge them back together in order
+            db = learn(engine(), DOCS[:1])
+            db.merge(learn(MarkovTrieDb(), DOCS[1:]))
+
+            self.assertEqual(dump(db), dump(expected))
+
+    def test_merge_counts(self):
+        for engine in [MarkovTrieDb, MarkovCSRDb]:
+            expected = engine()
+            MarkovBulkTrainer(expected).learn_batch(DOCS + DOCS)
+
+            # Count shards on their own, the way MarkovParallelTrainer processes do, then learn them in order
+            db = engine()
+            trainer = MarkovBulkTrainer(db)
+            for shard in [DOCS[:1], DOCS[1:] + DOCS[:2], DOCS[2:]]:
+                counter = MarkovNgramCounter()
+                for doc in shard:
+                    counter.add(doc)
+                counter.compact()
+                trainer.learn_counts(pickle.loads(pickle.dumps(counter)))
+            trainer.flush()
+
+            self.assertEqual(dump(db), dump(expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+
+import numpy as np
+
+from common.nlp import Pos
+from markov_engine import MarkovTrieDb, MarkovCSRDb, MarkovProjectionCache
+from markov_fixtures import DOCS, learn
+
+
+class TestMarkovProjection(unittest.TestCase):
+    def test_learn_keeps_matrices(self):
+        for engine in [MarkovTrieDb, MarkovCSRDb]:
+            db = learn(engine(), DOCS[:2])
+            if isinstance(db, MarkovCSRDb):
+                db.compact()
+            matrices = {word.text.lower(): word.neighbor_matrix() for word in db.words()}
+
+            # Learning writes through to the cached matrices rather than dropping them
+            learn(db, DOCS[2:] + DOCS)
+            for word in db.words():
+                matrix = word.neighbor_matrix()
+                if word.text.lower() in matrices:
+                    self.assertIs(matrix, matrices[word.text.lower()])
+
+                rebuilt = MarkovProjectionCache.build(dict(word.neighbors.items()))
+                for pos in [None, Pos.NOUN, Pos.INTJ, Pos.EMOJI]:
+                    for exclude_key in [None, 'world']:
+                        projection = matrix.project(1, 4, pos, exclude_key=exclude_key)
+                        expected = rebuilt.project(1, 4, pos, exclude_key=exclude_key)
+                        self.assertEqual(projection.keys, expected.keys)
+                        self.assertEqual(projection.pos, expected.pos)
+                        self.assertTrue(np.array_equal(projection.distances, expected.distances))
+                        self.assertTrue(np.array_equal(projection.magnitudes, expected.magnitudes))
+
+    def test_lazy_build(self):
+        db = learn(MarkovTrieDb(), DOCS)
+        word = db.select('world')
+
+        # The first projection goes neighbor by neighbor, the second builds the matrix and caches it
+        for pos in [Pos.INTJ, None, Pos.ADJ, Pos.NOUN]:
+            expected = MarkovProjectionCache.build(dict(word.neighbors.items())).project(2, 3, pos, exclude_key='bye')
+            for projection in [word.project(2, 3, pos, exclude_key='bye'), word.project(2, 3, pos, exclude_key='bye')]:
+                self.assertEqual(sorted(projection.keys), sorted(expected.keys))
+                if pos is not None:
+                    self.assertEqual(projection.keys, expected.keys)
+                    self.assertTrue(np.array_equal(projection.distances, expected.distances))
+                    self.assertTrue(np.array_equal(projection.magnitudes, expected.magnitudes))
+            self.assertIsNotNone(db._projections.get('world', word.neighbors, lazy=True))
+
+        self.assertIsNone(db._projections.get('hello', db.select('hello').neighbors, lazy=True))
+        self.assertIsNotNone(db._projections.get('hello', db.select('hello').neighbors, lazy=True))
+
+    def test_compact_drops_views(self):
+        db = learn(MarkovCSRDb(), DOCS[:2])
+        db.compact()
+        matrix = db.select('big').neighbor_matrix()
+        self.assertIs(db.select('big').neighbor_matrix(), matrix)
+
+        # Once compacted, the cached slices of the old arrays are rebuilt from the new ones
+        learn(db, DOCS[2:])
+        db.compact()
+        self.assertIsNot(db.select('big').neighbor_matrix(), matrix)
+
+
+if __name__ == '__main__':
+    unittest.main()
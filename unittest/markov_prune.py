@@ -0,0 +1,45 @@
+import unittest
+
+from common.nlp import Pos, CapitalizationMode, ParsedToken, ParsedDoc
+from markov_engine import MarkovTrieDb, MarkovCSRDb
+from markov_fixtures import DOCS, learn, dump
+
+
+class TestMarkovPrune(unittest.TestCase):
+    COMMON = [ParsedToken('Hello', Pos.INTJ, CapitalizationMode.UPPER_FIRST),
+              ParsedToken('world', Pos.NOUN, CapitalizationMode.LOWER_ALL)]
+    DOCS = [ParsedDoc([COMMON]),
+            ParsedDoc([COMMON]),
+            ParsedDoc([COMMON + [ParsedToken('wrld', Pos.X, CapitalizationMode.LOWER_ALL)]])]
+
+    def test_prune(self):
+        for engine in [MarkovTrieDb, MarkovCSRDb]:
+            db = learn(engine(), TestMarkovPrune.DOCS)
+            self.assertEqual(db.neighbor_count(), 6)
+
+            # Only the pairs seen in every doc survive, the typo goes with them
+            self.assertEqual(db.prune(2), 4)
+            self.assertEqual(db.neighbor_count(), 2)
+            self.assertIsNone(db.select('wrld'))
+            self.assertEqual([neighbor.key for neighbor in db.select('hello').select_neighbors(Pos.NOUN)], ['world'])
+
+            # Decayed counts which reach zero are pruned as well
+            self.assertEqual(db.prune(2, decay=0.5), 0)
+            self.assertEqual(db.select('world').get_neighbor('hello').values[0], 1)
+            self.assertEqual(db.prune(2, decay=0.5), 2)
+            self.assertEqual(dump(db), [])
+
+    def test_no_dangling_neighbors(self):
+        for engine in [MarkovTrieDb, MarkovCSRDb]:
+            for max_neighbors in range(1, 12):
+                db = learn(engine(), DOCS)
+                db.prune(max_neighbors)
+
+                # Generating from a pruned model selects every neighbor it picks
+                for word in db.words():
+                    for key in word.neighbors:
+                        self.assertIsNotNone(db.select(key), (engine.__name__, max_neighbors, word.text, key))
+
+
+if __name__ == '__main__':
+    unittest.main()
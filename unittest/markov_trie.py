@@ -0,0 +1,55 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from common.nlp import Pos
+from markov_engine import MarkovTrieDb, WordKey
+from markov_fixtures import DOCS, learn, dump
+
+
+class TestMarkovTrie(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'markov.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def _character_trie(db: MarkovTrieDb) -> dict:
+        # The version 1 format, a node per character of the lowercased word
+        trie = {}
+        for word in db.words():
+            node = trie
+            for c in word.text.lower():
+                node = node.setdefault(c, {})
+            node[MarkovTrieDb.WORD_KEY] = {WordKey.TEXT: word.text, WordKey.POS: word.pos.value,
+                                           WordKey.COMPOUND: word.compound}
+            node[MarkovTrieDb.NEIGHBORS_KEY] = word.neighbors
+        return trie
+
+    def _read(self) -> dict:
+        return json.loads(zlib.decompress(open(self.path, 'rb').read()).decode())
+
+    def test_migrate(self):
+        expected = learn(MarkovTrieDb(), DOCS)
+        with open(self.path, 'wb') as f:
+            f.write(zlib.compress(json.dumps(self._character_trie(expected)).encode()))
+
+        db = MarkovTrieDb(self.path)
+        self.assertEqual(dump(db), dump(expected))
+        self.assertEqual(db.select('HELLO').text, 'Hello')
+        self.assertEqual([neighbor.key for neighbor in db.select('world').select_neighbors(Pos.ADJ)], ['big'])
+        self.assertIsNone(db.select('hell'))
+
+        # Saving writes the flat format, which loads back the same
+        db.save(self.path)
+        self.assertEqual(self._read()[MarkovTrieDb.VERSION_KEY], MarkovTrieDb.VERSION)
+        self.assertEqual(dump(MarkovTrieDb(self.path)), dump(expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
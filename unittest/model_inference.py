@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from common.nlp import Pos
+from models.inference import LSTMInference, inference_path, export_layers, import_layers
+from models.reaction import AOLReactionFeatureAnalyzer, AOLReactionInferenceModel
+from models.structure import StructureFeatureAnalyzer, StructureInferenceModel
+
+
+class TestModelInference(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'model.h5')
+        self.random = np.random.RandomState(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _weights(self, *shapes) -> list:
+        return [self.random.randn(*shape).astype(np.float32) for shape in shapes]
+
+    def test_lstm_step(self):
+        lstm = LSTMInference(*self._weights((10, 10), (10, 32), (8, 32), (32,)))
+        sequences = self.random.randint(0, 10, (3, 5))
+
+        # Carrying the state forward matches running the whole sequence
+        state = lstm.run(sequences[:, :2])
+        state = lstm.run(sequences[:, 2:], state)
+        for expected, actual in zip(lstm.run(sequences), state):
+            self.assertTrue(np.allclose(expected, actual))
+
+    def test_structure(self):
+        features = StructureFeatureAnalyzer.NUM_FEATURES
+        export_layers(inference_path(self.path),
+                      [({'type': 'Embedding'}, self._weights((features, features))),
+                       ({'type': 'LSTM', 'activation': 'tanh', 'recurrent_activation': 'hard_sigmoid'},
+                        self._weights((features, 64), (16, 64), (64,))),
+                       ({'type': 'Dense', 'activation': 'softmax'}, self._weights((16, features), (features,)))])
+
+        model = StructureInferenceModel()
+        model.load(self.path)
+        structure = model.predict(num_sentences=2)
+        self.assertEqual(len([mode for mode in structure if mode.pos == Pos.EOS]), 2)
+        self.assertEqual(structure[-1].pos, Pos.EOS)
+
+        # Each structure of a batch stops at its own number of sentences
+        num_sentences = [1, 4, 2]
+        for sentences, structure in zip(num_sentences, model.predict_batch(num_sentences)):
+            self.assertEqual(len([mode for mode in structure if mode.pos == Pos.EOS]), sentences)
+            self.assertEqual(structure[-1].pos, Pos.EOS)
+
+    def test_reaction(self):
+        features = AOLReactionFeatureAnalyzer.NUM_FEATURES
+        layers = [({'type': 'Dense', 'activation': 'relu'}, self._weights((features, features), (features,))),
+                  ({'type': 'Dense', 'activation': 'sigmoid'}, self._weights((features, 1), (1,)))]
+        export_layers(inference_path(self.path), layers)
+
+        for (spec, weights), (imported_spec, imported_weights) in zip(layers, import_layers(inference_path(self.path))):
+            self.assertEqual(spec, imported_spec)
+            for weight, imported_weight in zip(weights, imported_weights):
+                self.assertTrue(np.array_equal(weight, imported_weight))
+
+        model = AOLReactionInferenceModel()
+        with self.assertRaises(RuntimeError):
+            model.save(self.path)
+        model.load(self.path)
+        self.assertIn(model.predict("lol wut"), [True, False])
+
+        # Saving writes the loaded weights back out, but nothing can be trained without Keras
+        saved_path = os.path.join(self.directory, 'saved.h5')
+        model.save(saved_path)
+        for (_, weights), (_, saved_weights) in zip(layers, import_layers(inference_path(saved_path))):
+            for weight, saved_weight in zip(weights, saved_weights):
+                self.assertTrue(np.array_equal(weight, saved_weight))
+        with self.assertRaises(RuntimeError):
+            model.train([[0.] * features], [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
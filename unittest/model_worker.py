@@ -0,0 +1,205 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Queue
+from typing import List
+
+from config.ml import ML_PREDICT_BATCH_MAX_SIZE
+from models.model_common import MLModelScheduler, MLModelWorker
+from models.structure import StructureModelWorker
+
+
+class UnpicklableError(Exception):
+    def __init__(self):
+        Exception.__init__(self, "holds a handle")
+        self.handle = threading.Lock()
+
+
+class FakeWorker(MLModelWorker):
+    """Predicts (value, size of the batch it was predicted in), some values have side effects"""
+
+    def __init__(self, read_queue, write_queue, priority_queue, idle_error: bool = False):
+        MLModelWorker.__init__(self, name='FakeWorker', read_queue=read_queue, write_queue=write_queue,
+                               use_gpu=False, priority_queue=priority_queue)
+        self._idle_error = idle_error
+
+    def idle(self) -> bool:
+        if self._idle_error:
+            raise ValueError('idle')
+        return False
+
+    @staticmethod
+    def _predict(value, batch_size: int):
+        if value == 'slow':
+            time.sleep(0.5)
+        elif value == 'bad':
+            raise ValueError(value)
+        elif value == 'unpicklable':
+            raise UnpicklableError()
+        return value, batch_size
+
+    def predict(self, *data):
+        return FakeWorker._predict(data[0][0], 1)
+
+    def predict_batch(self, batch: List[tuple]) -> list:
+        return [FakeWorker._predict(data[0], len(batch)) for data in batch]
+
+    def train(self, *data):
+        time.sleep(data[0][0])
+        return 'trained'
+
+    def load(self, *data):
+        raise IOError(data[0][0])
+
+
+class FakeScheduler(MLModelScheduler):
+    def __init__(self, idle_error: bool = False):
+        MLModelScheduler.__init__(self)
+        self._worker = FakeWorker(read_queue=self._write_queue, write_queue=self._read_queue,
+                                  priority_queue=self._priority_queue, idle_error=idle_error)
+
+    def predict_async(self, value):
+        return self._predict_async(value)
+
+    def train(self, seconds: float):
+        return self._train(seconds)
+
+    def load(self, path: str):
+        return self._load(path)
+
+
+class TestModelWorker(unittest.TestCase):
+    TIMEOUT = 10
+
+    def setUp(self):
+        self.scheduler = FakeScheduler()
+        self.scheduler.start()
+
+    def tearDown(self):
+        if self.scheduler._worker.is_alive():
+            self.scheduler.shutdown()
+            self.scheduler._worker.join(TestModelWorker.TIMEOUT)
+
+    def test_predict_while_training(self):
+        training = ThreadPoolExecutor(1).submit(self.scheduler.train, 2.)
+        time.sleep(0.2)
+
+        # The priority lane answers while the normal lane is busy training
+        start = time.time()
+        self.assertEqual(self.scheduler.predict_async(1).result(TestModelWorker.TIMEOUT)[0], 1)
+        self.assertLess(time.time() - start, 1.)
+        self.assertFalse(training.done())
+        self.assertEqual(self.scheduler.metrics()['queue_depth'], {'priority': 0, 'normal': 1})
+
+        self.assertEqual(training.result(TestModelWorker.TIMEOUT), 'trained')
+        metrics = self.scheduler.metrics()
+        self.assertEqual(metrics['queue_depth'], {'priority': 0, 'normal': 0})
+        self.assertEqual(metrics['latency']['PREDICT']['count'], 1)
+        self.assertGreaterEqual(metrics['latency']['TRAIN']['max'], 2.)
+
+    def test_errors(self):
+        # Each error is only raised by the future of the request causing it
+        bad = self.scheduler.predict_async('bad')
+        with self.assertRaises(ValueError):
+            bad.result(TestModelWorker.TIMEOUT)
+        with self.assertRaises(IOError):
+            self.scheduler.load('missing')
+        self.assertEqual(self.scheduler.predict_async(2).result(TestModelWorker.TIMEOUT)[0], 2)
+
+        # Errors which can't be pickled are still reported
+        with self.assertRaisesRegex(RuntimeError, 'UnpicklableError'):
+            self.scheduler.predict_async('unpicklable').result(TestModelWorker.TIMEOUT)
+        self.assertEqual(self.scheduler.predict_async(3).result(TestModelWorker.TIMEOUT)[0], 3)
+
+    def _results(self, futures: list) -> list:
+        return [future.result(TestModelWorker.TIMEOUT) for future in futures]
+
+    def test_batch_window(self):
+        # Predictions arriving within the window of the first one are predicted together
+        self.assertEqual(self._results([self.scheduler.predict_async(value) for value in range(0, 2)]),
+                         [(0, 2), (1, 2)])
+
+        # Ones arriving after it are not held back for each other
+        self.assertEqual(self._results([self.scheduler.predict_async(2)]), [(2, 1)])
+        time.sleep(0.1)
+        self.assertEqual(self._results([self.scheduler.predict_async(3)]), [(3, 1)])
+
+    def test_batch_max_size(self):
+        # Everything queued up while the worker is busy is split into batches of at most the max size
+        slow = self.scheduler.predict_async('slow')
+        time.sleep(0.1)
+        futures = [self.scheduler.predict_async(value) for value in range(0, ML_PREDICT_BATCH_MAX_SIZE + 3)]
+        self.assertEqual(slow.result(TestModelWorker.TIMEOUT), ('slow', 1))
+        self.assertEqual(self._results(futures),
+                         [(value, ML_PREDICT_BATCH_MAX_SIZE) for value in range(0, ML_PREDICT_BATCH_MAX_SIZE)] +
+                         [(value, 3) for value in range(ML_PREDICT_BATCH_MAX_SIZE, ML_PREDICT_BATCH_MAX_SIZE + 3)])
+
+    def test_batch_error(self):
+        # A batch which fails is predicted one request at a time, so only the bad one fails
+        slow = self.scheduler.predict_async('slow')
+        time.sleep(0.1)
+        futures = [self.scheduler.predict_async(value) for value in [1, 'bad', 3]]
+        slow.result(TestModelWorker.TIMEOUT)
+        self.assertEqual(futures[0].result(TestModelWorker.TIMEOUT), (1, 1))
+        with self.assertRaises(ValueError):
+            futures[1].result(TestModelWorker.TIMEOUT)
+        self.assertEqual(futures[2].result(TestModelWorker.TIMEOUT), (3, 1))
+
+    def test_batch_ended_by_command(self):
+        # Shutting down ends the batch being gathered, which is still answered before the worker exits
+        slow = self.scheduler.predict_async('slow')
+        time.sleep(0.1)
+        futures = [self.scheduler.predict_async(value) for value in range(0, 3)]
+        self.scheduler.shutdown()
+        slow.result(TestModelWorker.TIMEOUT)
+        self.assertEqual(self._results(futures), [(0, 3), (1, 3), (2, 3)])
+        self.scheduler._worker.join(TestModelWorker.TIMEOUT)
+        self.assertEqual(self.scheduler._worker.exitcode, 0)
+
+    def test_idle_error(self):
+        self.scheduler.shutdown()
+        self.scheduler._worker.join(TestModelWorker.TIMEOUT)
+        self.scheduler = FakeScheduler(idle_error=True)
+        self.scheduler.start()
+
+        # Failing idle work is logged, the priority lane keeps serving
+        for value in range(0, 3):
+            self.assertEqual(self.scheduler.predict_async(value).result(TestModelWorker.TIMEOUT), (value, 1))
+
+    def test_shutdown(self):
+        self.assertEqual(self.scheduler.predict_async(1).result(TestModelWorker.TIMEOUT)[0], 1)
+        self.scheduler.shutdown()
+
+        # The worker only exits once its lane thread has, and its last message stops the dispatcher
+        self.scheduler._worker.join(TestModelWorker.TIMEOUT)
+        self.assertEqual(self.scheduler._worker.exitcode, 0)
+        self.scheduler._dispatcher.join(TestModelWorker.TIMEOUT)
+        self.assertFalse(self.scheduler._dispatcher.is_alive())
+
+
+class FakeStructureModel(object):
+    def __init__(self, worker: StructureModelWorker):
+        self.worker = worker
+        self.weights = 'old'
+
+    def predict_batch(self, num_sentences: list) -> list:
+        return [(self.weights, sentences) for sentences in num_sentences]
+
+    def load(self, path: str):
+        # The priority lane keeps predicting and refilling the pool while the normal lane loads
+        self.worker.predict((2,))
+        self.worker.idle()
+        self.weights = 'new'
+
+
+class TestStructureModelWorker(unittest.TestCase):
+    def test_load_clears_pool(self):
+        worker = StructureModelWorker(read_queue=Queue(), write_queue=Queue())
+        worker._model = FakeStructureModel(worker)
+        worker.load(('model.h5',))
+        self.assertEqual(worker.predict((2,)), ('new', 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
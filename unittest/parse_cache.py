@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from common.nlp import Pos, CapitalizationMode, ParsedToken, ParsedDoc
+from storage.parse_cache import ParseCache
+
+
+class TestParseCache(unittest.TestCase):
+    DOC = ParsedDoc([[ParsedToken('Hello', Pos.INTJ, CapitalizationMode.UPPER_FIRST),
+                      ParsedToken('world', Pos.NOUN, CapitalizationMode.LOWER_ALL)],
+                     [ParsedToken('🐍', Pos.EMOJI, CapitalizationMode.COMPOUND)]])
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'import.db.parses')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def _tokens(doc: ParsedDoc) -> list:
+        return [[(token.text, token.pos, token.mode) for token in sentence] for sentence in doc.sents]
+
+    def test_get_put(self):
+        cache = ParseCache(self.path, 'parser')
+        self.assertIsNone(cache.get(1, b'Hello world'))
+        cache.put(1, b'Hello world', TestParseCache.DOC)
+        cache.close()
+
+        cache = ParseCache(self.path, 'parser')
+        self.assertEqual(self._tokens(cache.get(1, b'Hello world')), self._tokens(TestParseCache.DOC))
+
+        # Edited rows and rows parsed by a different parser have to be parsed again
+        self.assertIsNone(cache.get(1, b'Goodbye world'))
+        cache.close()
+        self.assertIsNone(ParseCache(self.path, 'other parser').get(1, b'Hello world'))
+
+    def test_long_doc(self):
+        # Sentences and token texts longer than 16 bit lengths allow
+        doc = ParsedDoc([[ParsedToken('a', Pos.X, CapitalizationMode.LOWER_ALL)] * 70000,
+                         [ParsedToken('🐍' * 20000, Pos.EMOJI, CapitalizationMode.COMPOUND)]])
+        cache = ParseCache(self.path, 'parser')
+        cache.put(1, b'long', doc)
+        self.assertEqual(self._tokens(cache.get(1, b'long')), self._tokens(doc))
+
+    def test_torn_record(self):
+        cache = ParseCache(self.path, 'parser')
+        cache.put(1, b'Hello world', TestParseCache.DOC)
+        cache.close()
+
+        # Simulate a crash in the middle of appending another record
+        with open(self.path, 'ab') as f:
+            f.write(ParseCache.RECORD_HEADER.pack(2, 0, 100, 0) + b'torn')
+
+        cache = ParseCache(self.path, 'parser')
+        self.assertIsNone(cache.get(2, b'torn'))
+        cache.put(2, b'Hello world', TestParseCache.DOC)
+        cache.close()
+
+        cache = ParseCache(self.path, 'parser')
+        for row_id in [1, 2]:
+            self.assertEqual(self._tokens(cache.get(row_id, b'Hello world')), self._tokens(TestParseCache.DOC))
+
+    def test_merge(self):
+        merge_size = ParseCache.MERGE_SIZE
+        ParseCache.MERGE_SIZE = 2
+        try:
+            cache = ParseCache(self.path, 'parser')
+            for row_id in [5, 1, 3, 1, 4]:
+                cache.put(row_id, b'Hello world %d' % row_id, TestParseCache.DOC)
+            cache.put(3, b'Edited', TestParseCache.DOC)
+
+            # Appended records are found the same before and after being merged into the index
+            for _ in range(2):
+                for row_id in [1, 4, 5]:
+                    self.assertIsNotNone(cache.get(row_id, b'Hello world %d' % row_id))
+                self.assertIsNone(cache.get(3, b'Hello world 3'))
+                self.assertIsNotNone(cache.get(3, b'Edited'))
+                self.assertIsNone(cache.get(2, b'Hello world 2'))
+                cache.flush()
+            cache.close()
+
+            cache = ParseCache(self.path, 'parser')
+            self.assertIsNotNone(cache.get(3, b'Edited'))
+            self.assertIsNotNone(cache.get(5, b'Hello world 5'))
+        finally:
+            ParseCache.MERGE_SIZE = merge_size
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+
+import numpy as np
+
+from common.sampling import CumulativeSampler, sample_rows, sample, tempered
+
+
+class TestSampling(unittest.TestCase):
+    DRAWS = 100000
+
+    def setUp(self):
+        np.random.seed(0)
+
+    def _frequencies(self, indices: np.ndarray, size: int) -> np.ndarray:
+        return np.bincount(indices, minlength=size) / len(indices)
+
+    def test_distribution(self):
+        p = np.array([0.1, 0.2, 0.7])
+        sampler = CumulativeSampler(p)
+        self.assertEqual(len(sampler), 3)
+        self.assertTrue(np.allclose(self._frequencies(sampler.sample_n(TestSampling.DRAWS), 3), p, atol=0.01))
+        self.assertTrue(np.allclose(self._frequencies([sampler.sample() for _ in range(0, 10000)], 3), p, atol=0.02))
+
+        # Each row of a matrix is its own distribution
+        rows = np.array([p, p[::-1]] * (TestSampling.DRAWS // 2))
+        indices = sample_rows(rows)
+        self.assertTrue(np.allclose(self._frequencies(indices[0::2], 3), p, atol=0.01))
+        self.assertTrue(np.allclose(self._frequencies(indices[1::2], 3), p[::-1], atol=0.01))
+
+    def test_temperature(self):
+        p = np.array([0.1, 0.2, 0.7])
+        for temperature in [0.5, 2.0]:
+            # Drawn from p ** (1 / temperature) normalized, like temp()
+            expected = p ** (1 / temperature) / np.sum(p ** (1 / temperature))
+            self.assertTrue(np.allclose(tempered(p, temperature) / np.sum(tempered(p, temperature)), expected))
+            frequencies = self._frequencies(CumulativeSampler(p, temperature).sample_n(TestSampling.DRAWS), 3)
+            self.assertTrue(np.allclose(frequencies, expected, atol=0.01))
+            frequencies = self._frequencies(sample_rows(np.tile(p, (TestSampling.DRAWS, 1)), temperature), 3)
+            self.assertTrue(np.allclose(frequencies, expected, atol=0.01))
+
+        # Lower temperatures favor the likeliest choice
+        self.assertGreater(np.mean(CumulativeSampler(p, 0.5).sample_n(TestSampling.DRAWS) == 2),
+                           np.mean(CumulativeSampler(p, 2.0).sample_n(TestSampling.DRAWS) == 2))
+
+    def test_zero_probability(self):
+        # Choices without any probability are never drawn, wherever they are
+        p = np.array([0., 0.5, 0., 0.5, 0.])
+        self.assertEqual(set(CumulativeSampler(p).sample_n(TestSampling.DRAWS).tolist()), {1, 3})
+        self.assertEqual(set(sample_rows(np.tile(p, (TestSampling.DRAWS, 1))).tolist()), {1, 3})
+
+        # There is nothing to draw from a distribution without any probability at all
+        with self.assertRaises(ValueError):
+            CumulativeSampler(np.zeros(3))
+        with self.assertRaises(ValueError):
+            CumulativeSampler([])
+        with self.assertRaises(ValueError):
+            sample_rows(np.array([p, np.zeros(5)]))
+
+    def test_single_choice(self):
+        self.assertEqual(CumulativeSampler([0.3]).sample_n(100).tolist(), [0] * 100)
+        self.assertEqual(sample([5.]), 0)
+        self.assertEqual(sample_rows(np.full((100, 1), 0.2), 0.5).tolist(), [0] * 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
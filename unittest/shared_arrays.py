@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from common.ml import SharedArrays, SHARED_ARRAY_DIR, read_array_file
+
+
+class TestSharedArrays(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        arrays = {'data': np.arange(0, 48, dtype=np.uint8).reshape((3, 16)), 'labels': np.array([1., 2., 3.])}
+        with SharedArrays(arrays) as path:
+            if SHARED_ARRAY_DIR is not None:
+                self.assertEqual(os.path.dirname(path), SHARED_ARRAY_DIR)
+            _, read = read_array_file(path)
+            for name, array in arrays.items():
+                self.assertEqual(read[name].dtype, array.dtype)
+                self.assertTrue(np.array_equal(read[name], array))
+            del read
+        self.assertFalse(os.path.exists(path))
+
+    def test_removed_on_error(self):
+        with self.assertRaises(KeyError):
+            with SharedArrays({'data': np.zeros(4)}) as path:
+                raise KeyError('data')
+        self.assertFalse(os.path.exists(path))
+
+        # Including when the arrays can't be written
+        with mock.patch('common.ml.SHARED_ARRAY_DIR', self.directory):
+            with self.assertRaises(OSError):
+                SharedArrays({'data': np.array([object()])})
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
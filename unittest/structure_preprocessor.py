@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+from multiprocessing import Queue
+
+import numpy as np
+
+from common.nlp import Pos, CapitalizationMode, ParsedToken, ParsedDoc
+from models.structure import StructurePreprocessor, StructureInferenceModel, PoSCapitalizationMode, \
+    StructureModelWorker
+
+
+class TestStructurePreprocessor(unittest.TestCase):
+    @staticmethod
+    def _embedding(pos: Pos, mode: CapitalizationMode = CapitalizationMode.NONE) -> int:
+        return PoSCapitalizationMode(pos, mode).to_embedding()
+
+    def test_preprocess(self):
+        tokens = [ParsedToken('word', Pos.NOUN, CapitalizationMode.LOWER_ALL)] * 20
+        preprocessor = StructurePreprocessor()
+        self.assertTrue(preprocessor.preprocess(ParsedDoc([tokens])))
+        self.assertTrue(preprocessor.preprocess(ParsedDoc([tokens[:1]])))
+        data, labels = preprocessor.get_preprocessed_data()
+
+        noun = self._embedding(Pos.NOUN, CapitalizationMode.LOWER_ALL)
+        start = self._embedding(Pos.NONE)
+        eos = self._embedding(Pos.EOS)
+
+        # 20 tokens and an EOS, then one token and an EOS
+        self.assertEqual(len(data), 23)
+        self.assertEqual(list(labels), [noun] * 20 + [eos, noun, eos])
+
+        # Each row holds the latest items before its label, post padded until the window fills up
+        self.assertEqual(list(data[0]), [start] + [0] * (StructureInferenceModel.SEQUENCE_LENGTH - 1))
+        self.assertEqual(list(data[2]), [start, noun, noun] + [0] * (StructureInferenceModel.SEQUENCE_LENGTH - 3))
+        self.assertTrue(np.array_equal(data[20], [noun] * StructureInferenceModel.SEQUENCE_LENGTH))
+
+        # Every doc starts over
+        self.assertEqual(list(data[22]), [start, noun] + [0] * (StructureInferenceModel.SEQUENCE_LENGTH - 2))
+
+    def test_read_sequences(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'sequences')
+        chunk_size = StructurePreprocessor.CHUNK_SIZE
+        try:
+            # Small chunks so the sequence file is appended to several times, the last chunk partially filled
+            StructurePreprocessor.CHUNK_SIZE = 6
+            docs = [ParsedDoc([[ParsedToken('word', pos, CapitalizationMode.LOWER_ALL)] * (i % 7 + 1)])
+                    for i, pos in enumerate([Pos.NOUN, Pos.VERB, Pos.ADJ] * 3)]
+            memory = StructurePreprocessor()
+            streamed = StructurePreprocessor(path=path)
+            for doc in docs:
+                self.assertTrue(memory.preprocess(doc))
+                self.assertTrue(streamed.preprocess(doc))
+            data, labels = memory.get_preprocessed_data()
+            streamed_data, streamed_labels = streamed.get_preprocessed_data()
+
+            self.assertEqual(len(data), 40)
+            self.assertTrue(np.array_equal(streamed_data, data))
+            self.assertTrue(np.array_equal(streamed_labels, labels))
+
+            # The worker trains the model on the mapped sequences when streaming
+            worker = StructureModelWorker(read_queue=Queue(), write_queue=Queue())
+            worker._model = FakeTrainingModel()
+            self.assertEqual(worker.train((path, 2, True)), 'trained')
+            self.assertTrue(np.array_equal(worker._model.data, data))
+            self.assertTrue(np.array_equal(worker._model.labels, labels))
+            self.assertEqual((worker._model.epochs, worker._model.stream), (2, True))
+        finally:
+            StructurePreprocessor.CHUNK_SIZE = chunk_size
+            shutil.rmtree(directory)
+
+    def test_read_empty(self):
+        directory = tempfile.mkdtemp()
+        try:
+            data, labels = StructurePreprocessor(path=os.path.join(directory, 'sequences')).get_preprocessed_data()
+            self.assertEqual(data.shape, (0, StructureInferenceModel.SEQUENCE_LENGTH))
+            self.assertEqual(len(labels), 0)
+        finally:
+            shutil.rmtree(directory)
+
+
+class FakeTrainingModel(object):
+    def train(self, data, labels, epochs=1, stream=False):
+        self.data, self.labels, self.epochs, self.stream = np.array(data), np.array(labels), epochs, stream
+        return 'trained'
+
+
+if __name__ == '__main__':
+    unittest.main()